@@ -0,0 +1,90 @@
+'''
+benchmarks/bench_codec.py
+Per-request cost of turning an inbound /v1/messages body into the bytes POSTed
+to Ollama, by request size: request.json() + translation + httpx json= (before)
+vs the byte codec (_read_json decoding + translation + _encode_chat), with the
+stdlib and, when installed, orjson.
+
+Each request is a Claude Code-like session (system prompt, tools, tool results)
+resent with its history, so the translation cache is warm as in steady state.
+Reports p50 latency and the peak traced allocation of one request.
+
+Usage:  python benchmarks/bench_codec.py --sizes 10 100 500
+'''
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import proxy  # noqa: E402
+from bench_translation_cache import session  # noqa: E402
+
+_TOOLS = [
+    {'name': f'Tool{i}', 'description': 'Performs an operation on the workspace. ' * 20,
+     'input_schema': {'type': 'object', 'properties': {'path': {'type': 'string'}, 'limit': {'type': 'integer'}}}}
+    for i in range(8)
+]
+
+
+def request_bytes(kb: int) -> bytes:
+    turns = 1
+    while True:
+        raw = json.dumps({
+            'model': 'bench', 'system': 'You are a coding agent. ' * 100, 'tools': _TOOLS,
+            'messages': session(turns), 'max_tokens': 4096, 'stream': True,
+        }).encode()
+        if len(raw) >= kb * 1024 or turns > 2000:
+            return raw
+        turns += 1
+
+
+def before(raw: bytes) -> bytes:
+    ollama_body = proxy._anthropic_to_ollama(json.loads(raw))
+    return httpx.Request('POST', 'http://ollama/api/chat', json=ollama_body).content
+
+
+def codec(raw: bytes) -> bytes:
+    return proxy._encode_chat(proxy._anthropic_to_ollama(proxy._json_loads(raw)))
+
+
+def measure(fn, raw: bytes, repeat: int) -> tuple:
+    proxy._translation_cache = proxy._TranslationCache(proxy.TRANSLATION_CACHE_MAX_BYTES)
+    fn(raw)  # warm the translation cache, as the previous turn would have
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(raw)
+        timings.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    fn(raw)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(timings), peak
+
+
+def main(args):
+    cases = [('json= (before)', before, json.loads, proxy._json_body_std), ('codec stdlib', codec, json.loads, proxy._json_body_std)]
+    if proxy.orjson is not None:
+        cases.append(('codec orjson', codec, proxy.orjson.loads, proxy._json_body_orjson))
+    print(f'{"size KB":>8}  {"case":<16}{"p50 ms":>10}{"peak alloc KB":>16}')
+    for kb in args.sizes:
+        raw = request_bytes(kb)
+        for name, fn, loads, json_body in cases:
+            proxy._json_loads, proxy._json_body = loads, json_body
+            p50, peak = measure(fn, raw, args.repeat)
+            print(f'{len(raw) // 1024:>8}  {name:<16}{p50 * 1000:>10.2f}{peak / 1024:>16.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Request decode/encode codec benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 500], help='request sizes in KB')
+    parser.add_argument('--repeat', type=int, default=50)
+    main(parser.parse_args())
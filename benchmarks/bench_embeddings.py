@@ -0,0 +1,97 @@
+'''
+benchmarks/bench_embeddings.py
+Embeddings/sec through /v1/embeddings with per-request forwarding
+(EMBED_BATCH_WINDOW=0, one /api/embed call per request) vs micro-batching.
+
+N concurrent clients each send single-input requests, the way RAG indexers
+usually call an embeddings API. The adapter runs under uvicorn against the fake
+Ollama server, which serializes /api/embed calls per model and charges a fixed
+cost per call plus a small cost per input, like a real embedding runner.
+The client, the fake server and the adapter share one machine, so with very
+small --embed-latency values the client side becomes the bottleneck.
+
+Usage:  python benchmarks/bench_embeddings.py --concurrency 32 --requests 2000
+        python benchmarks/bench_embeddings.py --window 0.002 --max-inputs 32 --embed-latency 0.01
+'''
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_ollama import FakeOllama  # noqa: E402
+from load_test import _free_port, _pct, _start_adapter  # noqa: E402
+
+
+async def _drive(base_url: str, args) -> dict:
+    latencies = []
+    remaining = args.requests
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def worker(w: int):
+            nonlocal remaining
+            n = 0
+            while remaining > 0:
+                remaining -= 1
+                n += 1
+                body = {'model': 'bench-model', 'input': f'chunk {w}-{n}: ' + 'lorem ipsum ' * args.words}
+                t0 = time.perf_counter()
+                (await client.post('/v1/embeddings', json=body)).raise_for_status()
+                latencies.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker(w) for w in range(args.concurrency)))
+        elapsed = time.perf_counter() - t0
+    return {
+        'embeddings_per_s': round(len(latencies) / elapsed, 1),
+        'p50_ms': _pct(latencies, 0.50), 'p99_ms': _pct(latencies, 0.99),
+    }
+
+
+async def _run(fake: FakeOllama, env: dict, args) -> dict:
+    port = _free_port()
+    proc = await _start_adapter(port, fake.base_url, env)
+    try:
+        calls = fake.embeds
+        result = await _drive(f'http://127.0.0.1:{port}', args)
+        result['upstream_calls'] = fake.embeds - calls
+        return result
+    finally:
+        proc.terminate()
+        await proc.wait()
+
+
+async def main(args):
+    fake = await FakeOllama(embed_latency=args.embed_latency, embed_item_latency=args.embed_item_latency,
+                            embed_dimensions=args.dimensions).start()
+    try:
+        rows = [
+            ('per-request', await _run(fake, {'EMBED_BATCH_WINDOW': '0'}, args)),
+            ('micro-batched', await _run(fake, {
+                'EMBED_BATCH_WINDOW': str(args.window), 'EMBED_BATCH_MAX_INPUTS': str(args.max_inputs),
+            }, args)),
+        ]
+    finally:
+        await fake.stop()
+    print(f'{args.requests} single-input requests, concurrency {args.concurrency}, '
+          f'{args.dimensions} dimensions, window {args.window}s, max {args.max_inputs} inputs')
+    print(f'{"mode":<16}{"embeddings/s":>14}{"p50 ms":>10}{"p99 ms":>10}{"/api/embed calls":>18}')
+    for name, r in rows:
+        print(f'{name:<16}{r["embeddings_per_s"]:>14}{r["p50_ms"]:>10}{r["p99_ms"]:>10}{r["upstream_calls"]:>18}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Embeddings throughput, per-request forwarding vs micro-batching')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--words', type=int, default=40, help='repetitions of filler text per input')
+    parser.add_argument('--window', type=float, default=0.005, help='EMBED_BATCH_WINDOW for the batched run')
+    parser.add_argument('--max-inputs', type=int, default=64, help='EMBED_BATCH_MAX_INPUTS for the batched run')
+    parser.add_argument('--dimensions', type=int, default=768)
+    parser.add_argument('--embed-latency', type=float, default=0.02, help='fake seconds per /api/embed call')
+    parser.add_argument('--embed-item-latency', type=float, default=0.0005, help='fake seconds per input')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,98 @@
+'''
+benchmarks/bench_ndjson_parser.py
+CPU time per upstream chunk for decoding Ollama's streamed /api/chat body:
+httpx aiter_lines() + json.loads against proxy._NDJSONParser over
+aiter_bytes(), with and without the content/thinking fast path and with the
+stdlib and (when installed) orjson fallback parsers.
+
+Reads arrive either one line at a time (a slow model, one flush per token)
+or batched into 16 KiB buffers (a fast model outrunning the proxy).
+
+Usage:  python benchmarks/bench_ndjson_parser.py --tokens 200000
+'''
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import proxy  # noqa: E402
+
+
+def ollama_lines(tokens: int) -> list:
+    words = ['def', ' foo', '(x', '):', '\n   ', ' return', ' "bar"', ' +', ' x', '\t# é']
+    lines = []
+    for i in range(tokens):
+        message = {'role': 'assistant', 'content': words[i % len(words)]}
+        if i < tokens // 4:
+            message = {'role': 'assistant', 'content': '', 'thinking': words[i % len(words)]}
+        lines.append({'model': 'qwen3:8b', 'created_at': '2025-06-01T12:00:00.123456789Z', 'message': message, 'done': False})
+    lines.append({'model': 'qwen3:8b', 'created_at': '2025-06-01T12:00:01Z', 'message': {
+        'role': 'assistant', 'content': '', 'tool_calls': [{'function': {'name': 'Read', 'arguments': {'path': 'a.py'}}}]}, 'done': False})
+    lines.append({'model': 'qwen3:8b', 'created_at': '2025-06-01T12:00:01Z', 'message': {'role': 'assistant', 'content': ''},
+                  'done': True, 'done_reason': 'stop', 'eval_count': tokens, 'prompt_eval_count': 10})
+    return [json.dumps(line, ensure_ascii=False, separators=(',', ':')).encode() + b'\n' for line in lines]
+
+
+def reads(lines: list, batch: int) -> list:
+    if not batch:
+        return lines
+    raw = b''.join(lines)
+    return [raw[i:i + batch] for i in range(0, len(raw), batch)]
+
+
+def response(buffers: list) -> httpx.Response:
+    async def body():
+        for b in buffers:
+            yield b
+    return httpx.Response(200, content=body())
+
+
+async def legacy(buffers: list) -> int:
+    n = 0
+    async for line in response(buffers).aiter_lines():
+        if not line.strip(): continue
+        json.loads(line)
+        n += 1
+    return n
+
+
+async def parser(buffers: list, fast_path: bool) -> int:
+    n = 0
+    p = proxy._NDJSONParser(fast_path)
+    async for data in response(buffers).aiter_bytes():
+        n += len(p.feed(data))
+    return n + len(p.close())
+
+
+def _cpu_ns_per_chunk(coro_fn, *args) -> float:
+    t0 = time.process_time_ns()
+    n = asyncio.run(coro_fn(*args))
+    return (time.process_time_ns() - t0) / n
+
+
+def main(args):
+    lines = ollama_lines(args.tokens)
+    loaders = [('stdlib', json.loads)]
+    if proxy.orjson is not None:
+        loaders.append(('orjson', proxy.orjson.loads))
+
+    print(f'{"case":<34}{"per-line ns":>12}{"16KiB ns":>12}')
+    for_reads = [reads(lines, 0), reads(lines, 16384)]
+    print(f'{"aiter_lines + json.loads":<34}' + ''.join(f'{_cpu_ns_per_chunk(legacy, b):>12.0f}' for b in for_reads))
+    for name, loads in loaders:
+        proxy._json_loads = loads
+        for fast_path in (False, True):
+            label = f'parser/{name}' + (' + fast path' if fast_path else '')
+            print(f'{label:<34}' + ''.join(f'{_cpu_ns_per_chunk(parser, b, fast_path):>12.0f}' for b in for_reads))
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='Upstream NDJSON parsing benchmark')
+    ap.add_argument('--tokens', type=int, default=200000)
+    main(ap.parse_args())
@@ -0,0 +1,73 @@
+'''
+benchmarks/bench_sse_encoder.py
+Microbenchmark of per-token SSE frame construction: the previous nested
+f-string + json.dumps frames against proxy._AnthropicEncoder / _OpenAIEncoder,
+with the stdlib and (when installed) orjson backends.
+
+Usage:  python benchmarks/bench_sse_encoder.py --tokens 200000
+'''
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import proxy  # noqa: E402
+
+_SSE_SEP = chr(10) + chr(10)
+
+
+def legacy_anthropic(tokens: list):
+    for t in tokens:
+        yield 'event: content_block_delta' + chr(10) + f'data: {json.dumps({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": t}})}' + _SSE_SEP
+
+
+def legacy_openai(tokens: list, cid: str, model: str):
+    for t in tokens:
+        yield 'data: ' + json.dumps({
+            'id': cid, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+            'choices': [{'index': 0, 'delta': {'content': t}, 'finish_reason': None}]
+        }) + _SSE_SEP
+
+
+def encoder_anthropic(tokens: list):
+    enc = proxy._AnthropicEncoder('msg_bench', 'bench-model')
+    for t in tokens:
+        yield enc.delta(0, 'text', t)
+
+
+def encoder_openai(tokens: list, cid: str, model: str):
+    enc = proxy._OpenAIEncoder(cid, model, int(time.time()))
+    for t in tokens:
+        yield enc.content(t)
+
+
+def _cpu_ns_per_token(fn, tokens: list, *args) -> float:
+    t0 = time.process_time_ns()
+    for _ in fn(tokens, *args):
+        pass
+    return (time.process_time_ns() - t0) / len(tokens)
+
+
+def main(args):
+    words = ['def', ' foo', '(x', '):', '\n   ', ' return', ' "bar"', ' +', ' x', '\t# é']
+    tokens = [words[i % len(words)] for i in range(args.tokens)]
+    backends = [('stdlib', proxy._json_bytes_std, proxy._json_str_std)]
+    if proxy.orjson is not None:
+        backends.append(('orjson', proxy.orjson.dumps, proxy.orjson.dumps))
+
+    print(f'{"case":<28}{"ns/token":>10}')
+    print(f'{"anthropic legacy":<28}{_cpu_ns_per_token(legacy_anthropic, tokens):>10.0f}')
+    print(f'{"openai legacy":<28}{_cpu_ns_per_token(legacy_openai, tokens, "chatcmpl-bench", "bench-model"):>10.0f}')
+    for name, json_bytes, json_str in backends:
+        proxy._json_bytes, proxy._json_str = json_bytes, json_str
+        print(f'{"anthropic encoder/" + name:<28}{_cpu_ns_per_token(encoder_anthropic, tokens):>10.0f}')
+        print(f'{"openai encoder/" + name:<28}{_cpu_ns_per_token(encoder_openai, tokens, "chatcmpl-bench", "bench-model"):>10.0f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SSE frame encoding microbenchmark')
+    parser.add_argument('--tokens', type=int, default=200000)
+    main(parser.parse_args())
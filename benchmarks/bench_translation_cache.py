@@ -0,0 +1,71 @@
+'''
+benchmarks/bench_translation_cache.py
+Per-turn Anthropic -> Ollama translation cost over a synthetic agent session
+whose history grows every turn, with proxy._TranslationCache disabled (full
+conversion every turn) and enabled (only the new tail is converted).
+
+Each turn's body is decoded afresh from JSON, as request.json() would do.
+
+Usage:  python benchmarks/bench_translation_cache.py --turns 200
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import proxy  # noqa: E402
+
+
+def session(turns: int, seed: int = 1) -> list:
+    rng = random.Random(seed)
+    messages = []
+    for i in range(turns):
+        output = ''.join(rng.choice('abcdefgh \n') for _ in range(rng.randint(2000, 20000)))
+        messages.append({'role': 'user', 'content': [
+            {'type': 'tool_result', 'tool_use_id': f'toolu_{i}', 'content': [{'type': 'text', 'text': output}]},
+            {'type': 'text', 'text': f'Continue with step {i}. ' * 5},
+        ]})
+        messages.append({'role': 'assistant', 'content': [
+            {'type': 'text', 'text': f'Reading the next file for step {i}. ' * 8},
+            {'type': 'tool_use', 'id': f'toolu_{i + 1}', 'name': 'Read', 'input': {'path': f'/src/{i}.py'}},
+        ]})
+    return messages
+
+
+def run(messages: list, max_bytes: int, system: str) -> tuple:
+    proxy._translation_cache = proxy._TranslationCache(max_bytes)
+    per_turn = []
+    for n in range(2, len(messages) + 1, 2):
+        raw = json.dumps({'model': 'bench', 'system': system, 'messages': messages[:n], 'max_tokens': 1024})
+        body = json.loads(raw)
+        t0 = time.perf_counter()
+        proxy._anthropic_to_ollama(body)
+        per_turn.append(time.perf_counter() - t0)
+    body = json.loads(raw)
+    tracemalloc.start()
+    proxy._anthropic_to_ollama(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return per_turn, peak, proxy._translation_cache.size
+
+
+def main(args):
+    messages = session(args.turns)
+    system = 'You are a coding agent. ' * 800
+    print(f'{args.turns} turns, final body {len(json.dumps(messages)) / 1e6:.1f} MB')
+    print(f'{"case":<14}{"total ms":>10}{"last turn ms":>14}{"last turn alloc KB":>20}{"cache MB":>10}')
+    for name, max_bytes in (('uncached', 0), ('incremental', args.max_bytes)):
+        per_turn, peak, size = run(messages, max_bytes, system)
+        print(f'{name:<14}{sum(per_turn) * 1000:>10.1f}{per_turn[-1] * 1000:>14.2f}{peak / 1024:>20.1f}{size / 1e6:>10.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Incremental message translation benchmark')
+    parser.add_argument('--turns', type=int, default=200)
+    parser.add_argument('--max-bytes', type=int, default=proxy.TRANSLATION_CACHE_MAX_BYTES)
+    main(parser.parse_args())
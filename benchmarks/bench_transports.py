@@ -0,0 +1,169 @@
+'''
+benchmarks/bench_transports.py
+Adapter-to-Ollama transport comparison: OLLAMA_BASE_URL as http:// (TCP,
+HTTP/1.1), unix:// (Unix socket, HTTP/1.1) and h2c:// (TCP, cleartext HTTP/2
+with every stream on one connection).
+
+For each transport the fake Ollama is started in that mode in its own process,
+and the adapter runs under uvicorn in another. Streaming /v1/messages clients
+at --concurrency report TTFT, p50/p99 latency and the adapter's I/O syscalls
+per streamed token. /proc/<pid>/io does not see socket send/recv, so the
+adapter is started through a bootstrap that counts its socket recv/send calls
+and selector polls (one syscall each on the default asyncio loop; not
+meaningful under uvloop). The adapter's side of the client connections is
+counted too, but it is the same for every transport.
+
+Usage:  python benchmarks/bench_transports.py --concurrency 32 --requests 400
+        python benchmarks/bench_transports.py --tokens 256 --token-rate 100 --transports tcp h2c
+'''
+import argparse
+import asyncio
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_workers import _wait_ready  # noqa: E402
+from load_test import _free_port, _pct  # noqa: E402
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+_FAKE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_ollama.py')
+
+
+# Runs the adapter with counted socket I/O; SIGUSR1 writes the running count to argv[1]
+_BOOTSTRAP = '''
+import selectors, signal, socket, sys
+import uvicorn
+count = [0]
+def counted(cls, name):
+    original = getattr(cls, name)
+    def wrapper(*args, **kwargs):
+        count[0] += 1
+        return original(*args, **kwargs)
+    setattr(cls, name, wrapper)
+for name in ('recv', 'recv_into', 'send', 'sendmsg', 'sendto'):
+    counted(socket.socket, name)
+counted(selectors.DefaultSelector, 'select')
+def dump(*_):
+    with open(sys.argv[1], 'w') as f:
+        f.write(str(count[0]))
+signal.signal(signal.SIGUSR1, dump)
+uvicorn.run('proxy:app', host='127.0.0.1', port=int(sys.argv[2]), log_level='warning')
+'''
+
+
+def _syscalls(proc: subprocess.Popen, path: str) -> int:
+    if os.path.exists(path): os.unlink(path)
+    proc.send_signal(signal.SIGUSR1)
+    for _ in range(100):
+        if os.path.exists(path):
+            with open(path) as f:
+                if (text := f.read()): return int(text)
+        time.sleep(0.05)
+    raise RuntimeError('adapter did not report its syscall count')
+
+
+def _start_fake(transport: str, tmp: str, args) -> tuple:
+    port = _free_port()
+    cmd = [sys.executable, _FAKE, '--port', str(port), '--tokens', str(args.tokens),
+           '--token-delay', str(1 / args.token_rate if args.token_rate > 0 else 0.0)]
+    if transport == 'unix':
+        sock = os.path.join(tmp, 'ollama.sock')
+        cmd += ['--uds', sock]
+        url = f'unix://{sock}'
+    else:
+        if transport == 'h2c': cmd.append('--h2c')
+        url = f'{"h2c" if transport == "h2c" else "http"}://127.0.0.1:{port}'
+    proc = subprocess.Popen(cmd)
+    for _ in range(300):
+        if proc.poll() is not None:
+            raise RuntimeError(f'fake Ollama ({transport}) exited with {proc.returncode}')
+        if os.path.exists(sock) if transport == 'unix' else _port_open(port):
+            return proc, url
+        time.sleep(0.1)
+    raise RuntimeError(f'fake Ollama ({transport}) did not start')
+
+
+def _port_open(port: int) -> bool:
+    with socket.socket() as s:
+        return s.connect_ex(('127.0.0.1', port)) == 0
+
+
+async def _drive(url: str, args) -> tuple:
+    latencies, ttfts = [], []
+    body = {'model': 'bench-model', 'max_tokens': 1024, 'stream': True,
+            'messages': [{'role': 'user', 'content': 'Summarise the repository layout.'}]}
+    remaining = iter(range(args.requests))
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=300) as client:
+        async def worker():
+            for _ in remaining:
+                t0 = time.perf_counter()
+                first = None
+                async with client.stream('POST', '/v1/messages', json=body) as resp:
+                    resp.raise_for_status()
+                    async for chunk in resp.aiter_raw():
+                        if first is None and b'text_delta' in chunk:
+                            first = time.perf_counter()
+                done = time.perf_counter()
+                latencies.append(done - t0)
+                ttfts.append((first or done) - t0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return latencies, ttfts, time.perf_counter() - t0
+
+
+def run(transport: str, args) -> dict:
+    tmp = tempfile.mkdtemp(prefix='bench-transports-')
+    fake, ollama_url = _start_fake(transport, tmp, args)
+    port = _free_port()
+    counts = os.path.join(tmp, 'syscalls')
+    adapter = subprocess.Popen([sys.executable, '-c', _BOOTSTRAP, counts, str(port)], cwd=_ROOT,
+                               env={**os.environ, 'OLLAMA_BASE_URL': ollama_url, 'PYTHONPATH': _ROOT})
+    url = f'http://127.0.0.1:{port}'
+    try:
+        _wait_ready(url + '/health', adapter)
+        asyncio.run(_drive(url, argparse.Namespace(**{**vars(args), 'requests': args.concurrency})))  # warm pools
+        before = _syscalls(adapter, counts)
+        latencies, ttfts, elapsed = asyncio.run(_drive(url, args))
+        syscalls = _syscalls(adapter, counts) - before
+    finally:
+        adapter.terminate()
+        adapter.wait(30)
+        fake.terminate()
+        fake.wait(10)
+        shutil.rmtree(tmp, ignore_errors=True)
+    return {
+        'transport': transport, 'req_per_s': round(len(latencies) / elapsed, 1),
+        'ttft_p50_ms': _pct(ttfts, 0.50), 'ttft_p99_ms': _pct(ttfts, 0.99),
+        'latency_p50_ms': _pct(latencies, 0.50), 'latency_p99_ms': _pct(latencies, 0.99),
+        'syscalls_per_token': round(syscalls / (len(latencies) * args.tokens), 2),
+    }
+
+
+def main(args):
+    print(f'{args.requests} streaming requests, concurrency {args.concurrency}, {args.tokens} tokens each')
+    cols = ('req_per_s', 'ttft_p50_ms', 'ttft_p99_ms', 'latency_p50_ms', 'latency_p99_ms', 'syscalls_per_token')
+    print(f'{"transport":<10}' + ''.join(f'{c:>20}' for c in cols))
+    for transport in args.transports:
+        r = run(transport, args)
+        print(f'{transport:<10}' + ''.join(f'{r[c]:>20}' for c in cols))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Adapter upstream transport benchmark: tcp vs unix vs h2c')
+    parser.add_argument('--transports', nargs='+', choices=('tcp', 'unix', 'h2c'), default=['tcp', 'unix', 'h2c'])
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--tokens', type=int, default=128, help='output tokens per response')
+    parser.add_argument('--token-rate', type=float, default=0.0, help='fake tokens/sec per stream (0 = unthrottled)')
+    main(parser.parse_args())
@@ -0,0 +1,79 @@
+'''
+benchmarks/bench_upstream_pool.py
+Compares the old per-request httpx.AsyncClient pattern against the shared
+pooled client built by proxy._build_http_client(), against a local fake Ollama.
+Reports upstream TCP connections opened and p50/p99 request latency.
+
+Usage:  python benchmarks/bench_upstream_pool.py --requests 2000 --concurrency 32
+'''
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import proxy  # noqa: E402
+from fake_ollama import FakeOllama  # noqa: E402
+
+
+def _pct(samples: list, p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000
+
+
+async def _drive(fake: FakeOllama, n: int, concurrency: int, shared: bool) -> dict:
+    url = fake.base_url + '/api/chat'
+    body = {'model': 'bench-model', 'messages': [{'role': 'user', 'content': 'hi'}], 'stream': False}
+    client = proxy._build_http_client() if shared else None
+    latencies = []
+    sem = asyncio.Semaphore(concurrency)
+    start_conns = fake.connections
+
+    async def one():
+        async with sem:
+            t0 = time.perf_counter()
+            if shared:
+                r = await client.post(url, json=body)
+            else:
+                async with httpx.AsyncClient(timeout=120) as c:
+                    r = await c.post(url, json=body)
+            r.raise_for_status()
+            latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(n)))
+    elapsed = time.perf_counter() - t0
+    if client is not None:
+        await client.aclose()
+    return {
+        'mode': 'pooled' if shared else 'per-request',
+        'connections': fake.connections - start_conns,
+        'req_per_s': n / elapsed,
+        'p50_ms': _pct(latencies, 0.50),
+        'p99_ms': _pct(latencies, 0.99),
+    }
+
+
+async def main(args):
+    fake = await FakeOllama(tokens=args.tokens, latency=args.latency).start()
+    try:
+        for shared in (False, True):
+            r = await _drive(fake, args.requests, args.concurrency, shared)
+            print(f"{r['mode']:>12}: connections={r['connections']:>6}  "
+                  f"req/s={r['req_per_s']:>8.1f}  p50={r['p50_ms']:.2f}ms  p99={r['p99_ms']:.2f}ms")
+    finally:
+        await fake.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-request vs pooled upstream client benchmark')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--tokens', type=int, default=32)
+    parser.add_argument('--latency', type=float, default=0.0)
+    asyncio.run(main(parser.parse_args()))
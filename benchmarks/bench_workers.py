@@ -0,0 +1,128 @@
+'''
+benchmarks/bench_workers.py
+Adapter throughput from 1 to N worker processes (`python proxy.py --workers N`).
+
+The fake Ollama server runs in its own process and streams its tokens
+unthrottled, and each request carries a --body-kb history, so translation,
+JSON and SSE work in the adapter dominate. Load comes from --client-procs
+processes, each with its own share of --concurrency streaming clients, so the
+load generator is not the bottleneck. Workers only scale when there are free
+cores: on a machine with fewer cores than adapter workers plus the fake server
+and the clients, extra workers mostly add coordinator round trips.
+
+Usage:  python benchmarks/bench_workers.py --max-workers 4 --concurrency 64
+        python benchmarks/bench_workers.py --max-workers 8 --body-kb 200 --tokens 256 --client-procs 4
+'''
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_translation_cache import session  # noqa: E402
+from load_test import _free_port, _pct  # noqa: E402
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def _body(kb: int) -> dict:
+    turns = 1
+    while len(json.dumps(session(turns))) < kb * 1024 and turns < 2000:
+        turns += 1
+    return {'model': 'bench-model', 'max_tokens': 1024, 'stream': True, 'messages': session(turns)}
+
+
+async def _drive(url: str, body: dict, concurrency: int, seconds: float) -> list:
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=120) as client:
+        async def worker():
+            while time.perf_counter() < deadline:
+                t0 = time.perf_counter()
+                async with client.stream('POST', '/v1/messages', json=body) as resp:
+                    resp.raise_for_status()
+                    async for _ in resp.aiter_raw():
+                        pass
+                latencies.append(time.perf_counter() - t0)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+def _client_proc(url: str, kb: int, concurrency: int, seconds: float) -> list:
+    return asyncio.run(_drive(url, _body(kb), concurrency, seconds))
+
+
+def _wait_ready(url: str, proc: subprocess.Popen):
+    for _ in range(300):
+        if proc.poll() is not None:
+            raise RuntimeError(f'{proc.args} exited with {proc.returncode}')
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f'{url} did not become ready')
+
+
+def run(workers: int, ollama_url: str, args) -> dict:
+    port = _free_port()
+    env = {**os.environ, 'OLLAMA_BASE_URL': ollama_url}
+    proc = subprocess.Popen(
+        [sys.executable, 'proxy.py', '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers),
+         '--log-level', 'warning'], cwd=_ROOT, env=env,
+    )
+    url = f'http://127.0.0.1:{port}'
+    try:
+        _wait_ready(url + '/health', proc)
+        share = [args.concurrency // args.client_procs + (i < args.concurrency % args.client_procs) for i in range(args.client_procs)]
+        with concurrent.futures.ProcessPoolExecutor(args.client_procs) as pool:
+            futures = [pool.submit(_client_proc, url, args.body_kb, n, args.seconds) for n in share if n]
+            latencies = [x for f in futures for x in f.result()]
+    finally:
+        proc.terminate()
+        proc.wait(30)
+    return {
+        'workers': workers, 'requests': len(latencies), 'req_per_s': round(len(latencies) / args.seconds, 1),
+        'latency_p50_ms': _pct(latencies, 0.50), 'latency_p99_ms': _pct(latencies, 0.99),
+    }
+
+
+def main(args):
+    fake_port = _free_port()
+    fake = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_ollama.py'),
+                             '--port', str(fake_port), '--tokens', str(args.tokens)])
+    ollama_url = f'http://127.0.0.1:{fake_port}'
+    try:
+        _wait_ready(ollama_url + '/api/tags', fake)
+        print(f'{os.cpu_count()} CPUs, {args.body_kb} KB bodies, {args.tokens} tokens, concurrency {args.concurrency}')
+        print(f'{"workers":>8}{"requests":>10}{"req/s":>10}{"p50 ms":>10}{"p99 ms":>10}{"speedup":>10}')
+        base = None
+        for workers in range(1, args.max_workers + 1):
+            r = run(workers, ollama_url, args)
+            base = base or r['req_per_s']
+            print(f'{workers:>8}{r["requests"]:>10}{r["req_per_s"]:>10}{r["latency_p50_ms"]:>10}{r["latency_p99_ms"]:>10}'
+                  f'{r["req_per_s"] / base if base else 0:>9.2f}x')
+    finally:
+        fake.terminate()
+        fake.wait(10)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Adapter throughput by worker count')
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--client-procs', type=int, default=2)
+    parser.add_argument('--body-kb', type=int, default=100)
+    parser.add_argument('--tokens', type=int, default=128)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    main(parser.parse_args())
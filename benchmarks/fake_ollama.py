@@ -0,0 +1,307 @@
+'''
+benchmarks/fake_ollama.py
+Minimal stand-in for Ollama's HTTP API used by the benchmark scripts.
+Speaks just enough HTTP/1.1 (keep-alive, chunked NDJSON streaming) to serve
+/api/chat, /api/embed, /api/tags, /api/show and /api/ps, and counts accepted
+TCP connections so benchmarks can report connection churn.
+
+Chat responses follow Ollama's wire format (compact JSON, a separate
+tool_calls chunk, load/prompt_eval/eval/total durations in the done chunk).
+A request whose body contains a "[bench:<id>]" marker has its server-side
+handling time recorded in .timings[<id>], so a client can subtract it from
+its own latency to get per-request proxy overhead.
+
+/api/embed calls for a model run one at a time, like a single Ollama runner,
+and take embed_latency plus embed_item_latency per input.
+
+With uds set it listens on a Unix socket instead of TCP. With h2c it speaks
+cleartext HTTP/2 with prior knowledge, which needs the h2 package.
+
+Run standalone:  python benchmarks/fake_ollama.py --port 11434
+                 python benchmarks/fake_ollama.py --uds /tmp/ollama.sock
+'''
+import argparse
+import asyncio
+import json
+import re
+import time
+from typing import Dict, Optional
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+except ImportError:  # only needed for h2c
+    h2 = None
+
+_CRLF = b'\r\n'
+_BENCH_ID = re.compile(rb'\[bench:([0-9A-Za-z_-]+)\]')
+
+
+class _H1Response:
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+
+    async def json(self, status: int, data: bytes):
+        self.writer.write(
+            f'HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n'
+            f'Content-Length: {len(data)}\r\n\r\n'.encode() + data
+        )
+        await self.writer.drain()
+
+    def start_stream(self):
+        self.writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n\r\n')
+
+    async def chunk(self, data: bytes):
+        self.writer.write(b'%x\r\n' % len(data) + data + _CRLF)
+        await self.writer.drain()
+
+    async def end_stream(self):
+        self.writer.write(b'0\r\n\r\n')
+        await self.writer.drain()
+
+
+class _H2Response:
+    '''One HTTP/2 stream; DATA frames wait for flow-control window like a real server.'''
+
+    def __init__(self, conn, stream_id: int, writer: asyncio.StreamWriter, window: asyncio.Event):
+        self.conn = conn
+        self.stream_id = stream_id
+        self.writer = writer
+        self.window = window
+
+    async def _send(self, data: bytes, end: bool = False):
+        while data:
+            size = min(len(data), self.conn.max_outbound_frame_size, self.conn.local_flow_control_window(self.stream_id))
+            if size == 0:
+                self.window.clear()
+                await self.window.wait()
+                continue
+            self.conn.send_data(self.stream_id, data[:size])
+            data = data[size:]
+        if end: self.conn.end_stream(self.stream_id)
+        self.writer.write(self.conn.data_to_send())
+        await self.writer.drain()
+
+    async def json(self, status: int, data: bytes):
+        self.conn.send_headers(self.stream_id, [(':status', str(status)), ('content-type', 'application/json'),
+                                                ('content-length', str(len(data)))])
+        await self._send(data, end=True)
+
+    def start_stream(self):
+        self.conn.send_headers(self.stream_id, [(':status', '200'), ('content-type', 'application/x-ndjson')])
+
+    async def chunk(self, data: bytes):
+        await self._send(data)
+
+    async def end_stream(self):
+        self.conn.end_stream(self.stream_id)
+        self.writer.write(self.conn.data_to_send())
+        await self.writer.drain()
+
+
+class FakeOllama:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, tokens: int = 32,
+                 token_delay: float = 0.0, latency: float = 0.0, models: Optional[list] = None,
+                 tool_call_every: int = 0, context_length: int = 8192,
+                 embed_latency: float = 0.005, embed_item_latency: float = 0.0002, embed_dimensions: int = 768,
+                 uds: Optional[str] = None, h2c: bool = False):
+        self.host = host
+        self.port = port
+        self.uds = uds
+        self.h2c = h2c
+        self.tokens = tokens
+        self.token_delay = token_delay
+        self.latency = latency
+        self.models = models or ['bench-model']
+        # Every Nth chat response ends in a tool call (0 = never)
+        self.tool_call_every = tool_call_every
+        self.context_length = context_length
+        self.embed_latency = embed_latency
+        self.embed_item_latency = embed_item_latency
+        self.embed_dimensions = embed_dimensions
+        self.embeds = 0
+        self._runners: Dict[str, asyncio.Lock] = {}
+        self.connections = 0
+        self.requests = 0
+        self.chats = 0
+        self.timings: Dict[str, float] = {}
+        self._server: Optional[asyncio.base_events.Server] = None
+
+    @property
+    def base_url(self) -> str:
+        if self.uds:
+            return f'unix://{self.uds}'
+        return f'{"h2c" if self.h2c else "http"}://{self.host}:{self.port}'
+
+    async def start(self):
+        handle = self._handle_h2 if self.h2c else self._handle
+        if self.uds:
+            self._server = await asyncio.start_unix_server(handle, path=self.uds)
+        else:
+            self._server = await asyncio.start_server(handle, self.host, self.port)
+            self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(_CRLF + _CRLF)
+                lines = head.decode('latin-1').split('\r\n')
+                method, path, _ = lines[0].split(' ', 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        k, v = line.split(':', 1)
+                        headers[k.strip().lower()] = v.strip()
+                length = int(headers.get('content-length', '0'))
+                body = await reader.readexactly(length) if length else b''
+                self.requests += 1
+                await self._dispatch(method, path, body, _H1Response(writer))
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_h2(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding='utf-8'))
+        conn.initiate_connection()
+        writer.write(conn.data_to_send())
+        window = asyncio.Event()
+        requests: Dict[int, tuple] = {}
+        tasks = set()
+        try:
+            while data := await reader.read(65536):
+                for event in conn.receive_data(data):
+                    if isinstance(event, h2.events.RequestReceived):
+                        requests[event.stream_id] = (dict(event.headers), [])
+                    elif isinstance(event, h2.events.DataReceived):
+                        requests[event.stream_id][1].append(event.data)
+                        conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, h2.events.StreamEnded):
+                        headers, body = requests.pop(event.stream_id)
+                        self.requests += 1
+                        out = _H2Response(conn, event.stream_id, writer, window)
+                        task = asyncio.create_task(self._dispatch(headers[':method'], headers[':path'], b''.join(body), out))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+                    elif isinstance(event, (h2.events.WindowUpdated, h2.events.RemoteSettingsChanged)):
+                        window.set()
+                    elif isinstance(event, h2.events.ConnectionTerminated):
+                        return
+                writer.write(conn.data_to_send())
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            for task in tasks: task.cancel()
+            writer.close()
+
+    async def _dispatch(self, method: str, path: str, body: bytes, out):
+        if method == 'GET' and path == '/api/tags':
+            payload = {'models': [{'name': m, 'model': m} for m in self.models]}
+            return await self._send_json(out, 200, payload)
+        if method == 'GET' and path == '/api/ps':
+            return await self._send_json(out, 200, {'models': []})
+        if method == 'POST' and path == '/api/show':
+            return await self._send_json(out, 200, {
+                'capabilities': ['completion', 'tools'],
+                'model_info': {'general.architecture': 'bench', 'bench.context_length': self.context_length},
+            })
+        if method == 'POST' and path == '/api/chat':
+            started = time.perf_counter()
+            req = json.loads(body or b'{}')
+            self.chats += 1
+            tool_call = self.tool_call_every > 0 and self.chats % self.tool_call_every == 0
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if req.get('stream'):
+                await self._send_chat_stream(out, req, started, tool_call)
+            else:
+                eval_started = time.perf_counter()
+                if self.token_delay:
+                    await asyncio.sleep(self.token_delay * self.tokens)
+                message = self._message(' '.join(['tok'] * self.tokens), tool_call)
+                await self._send_json(out, 200, self._final_chunk(req, started, eval_started, message))
+            marker = _BENCH_ID.search(body)
+            if marker:
+                self.timings[marker.group(1).decode()] = time.perf_counter() - started
+            return
+        if method == 'POST' and path == '/api/embed':
+            req = json.loads(body or b'{}')
+            inputs = req.get('input', [])
+            if isinstance(inputs, str): inputs = [inputs]
+            runner = self._runners.setdefault(req.get('model', ''), asyncio.Lock())
+            async with runner:
+                self.embeds += 1
+                await asyncio.sleep(self.embed_latency + self.embed_item_latency * len(inputs))
+            vectors = [[(len(text) + i) % 13 / 13 for i in range(self.embed_dimensions)] for text in inputs]
+            return await self._send_json(out, 200, {
+                'model': req.get('model', ''), 'embeddings': vectors,
+                'prompt_eval_count': sum(len(text) // 4 + 1 for text in inputs),
+            })
+        return await self._send_json(out, 404, {'error': 'not found'})
+
+    @staticmethod
+    def _message(content: str, tool_call: bool) -> dict:
+        message = {'role': 'assistant', 'content': content}
+        if tool_call:
+            message['tool_calls'] = [{'function': {'name': 'Read', 'arguments': {'file_path': 'README.md'}}}]
+        return message
+
+    def _final_chunk(self, req: dict, started: float, eval_started: float, message: dict) -> dict:
+        now = time.perf_counter()
+        return {
+            'model': req.get('model', ''), 'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'message': message, 'done': True, 'done_reason': 'stop',
+            'total_duration': int((now - started) * 1e9), 'load_duration': 0,
+            'prompt_eval_count': 10, 'prompt_eval_duration': int((eval_started - started) * 1e9),
+            'eval_count': self.tokens, 'eval_duration': int((now - eval_started) * 1e9),
+        }
+
+    async def _send_json(self, out, status: int, payload: dict):
+        await out.json(status, json.dumps(payload, separators=(',', ':')).encode())
+
+    async def _send_chat_stream(self, out, req: dict, started: float, tool_call: bool):
+        out.start_stream()
+        eval_started = time.perf_counter()
+        head = {'model': req.get('model', ''), 'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ')}
+        for _ in range(self.tokens):
+            line = json.dumps({**head, 'message': {'role': 'assistant', 'content': 'tok '}, 'done': False}, separators=(',', ':'))
+            await out.chunk(line.encode() + b'\n')
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+        if tool_call:
+            line = json.dumps({**head, 'message': self._message('', True), 'done': False}, separators=(',', ':'))
+            await out.chunk(line.encode() + b'\n')
+        final = self._final_chunk(req, started, eval_started, self._message('', False))
+        await out.chunk(json.dumps(final, separators=(',', ':')).encode() + b'\n')
+        await out.end_stream()
+
+
+async def _serve(args):
+    server = await FakeOllama(args.host, args.port, args.tokens, args.token_delay, args.latency,
+                              tool_call_every=args.tool_call_every, uds=args.uds, h2c=args.h2c).start()
+    print(f'fake ollama listening on {server.base_url}')
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Ollama server for benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11434)
+    parser.add_argument('--tokens', type=int, default=32)
+    parser.add_argument('--token-delay', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--tool-call-every', type=int, default=0)
+    parser.add_argument('--uds', help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--h2c', action='store_true', help='speak cleartext HTTP/2 (needs h2)')
+    asyncio.run(_serve(parser.parse_args()))
@@ -0,0 +1,202 @@
+'''
+benchmarks/load_test.py
+End-to-end load test. Starts the fake Ollama server in this process and the
+adapter under uvicorn in a subprocess pointed at it, then drives the adapter
+with N concurrent Anthropic and OpenAI clients, streaming and non-streaming.
+
+Per scenario it reports throughput, time to first token, p50/p99 latency,
+p50/p99 proxy overhead (client latency minus the fake server's own handling
+time for the same request) and the adapter's RSS. Results are written to a
+JSON file; pass an earlier file as --baseline to print the change per metric.
+
+Usage:  python benchmarks/load_test.py --concurrency 16 --requests 400 --output load.json
+        python benchmarks/load_test.py --token-rate 50 --tool-call-every 4 --baseline load.json
+'''
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import sys
+import time
+import uuid
+
+import httpx
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, _ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import proxy  # noqa: E402
+from fake_ollama import FakeOllama  # noqa: E402
+
+_COMPARED = ('req_per_s', 'tokens_per_s', 'ttft_p50_ms', 'overhead_p50_ms', 'overhead_p99_ms', 'rss_mb')
+
+
+def _pct(samples: list, p: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 2)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _rss_mb(pid: int) -> dict:
+    '''Current and peak resident set size of pid from /proc (Linux only).'''
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return {'rss_mb': None, 'peak_rss_mb': None}
+    return {key: round(int(fields[name].split()[0]) / 1024, 1) for key, name in (('rss_mb', 'VmRSS'), ('peak_rss_mb', 'VmHWM'))}
+
+
+async def _start_adapter(port: int, ollama_url: str, env: dict = None) -> asyncio.subprocess.Process:
+    env = {**os.environ, 'OLLAMA_BASE_URL': ollama_url, **(env or {})}
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'uvicorn', 'proxy:app', '--host', '127.0.0.1', '--port', str(port),
+        '--log-level', 'warning', cwd=_ROOT, env=env,
+    )
+    async with httpx.AsyncClient() as client:
+        for _ in range(300):
+            try:
+                if (await client.get(f'http://127.0.0.1:{port}/health')).status_code == 200:
+                    return proc
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError('adapter did not become healthy')
+
+
+def _request(protocol: str, stream: bool, bench_id: str, tools: bool) -> tuple:
+    prompt = f'[bench:{bench_id}] Summarise the repository layout.'
+    if protocol == 'anthropic':
+        body = {'model': 'bench-model', 'max_tokens': 512, 'stream': stream, 'messages': [{'role': 'user', 'content': prompt}]}
+        if tools:
+            body['tools'] = [{'name': 'Read', 'description': 'Read a file', 'input_schema': {'type': 'object'}}]
+        return '/v1/messages', body
+    body = {'model': 'bench-model', 'stream': stream, 'messages': [{'role': 'user', 'content': prompt}]}
+    if tools:
+        body['tools'] = [{'type': 'function', 'function': {'name': 'Read', 'parameters': {'type': 'object'}}}]
+    return '/v1/chat/completions', body
+
+
+async def _scenario(base_url: str, fake: FakeOllama, proc, protocol: str, stream: bool, args) -> dict:
+    latencies, ttfts, overheads = [], [], []
+    errors = 0
+    queue = asyncio.Queue()
+    for _ in range(args.requests):
+        queue.put_nowait(uuid.uuid4().hex[:16])
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300) as client:
+        async def worker():
+            nonlocal errors
+            while not queue.empty():
+                bench_id = queue.get_nowait()
+                path, body = _request(protocol, stream, bench_id, args.tool_call_every > 0)
+                t0 = time.perf_counter()
+                first = None
+                try:
+                    if stream:
+                        async with client.stream('POST', path, json=body) as resp:
+                            resp.raise_for_status()
+                            async for line in resp.aiter_lines():
+                                if first is None and 'tok' in line:
+                                    first = time.perf_counter()
+                    else:
+                        (await client.post(path, json=body)).raise_for_status()
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                done = time.perf_counter()
+                latencies.append(done - t0)
+                ttfts.append((first or done) - t0)
+                server = fake.timings.pop(bench_id, None)
+                if server is not None:
+                    overheads.append(max(0.0, done - t0 - server))
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - t0
+
+    return {
+        'protocol': protocol, 'stream': stream, 'concurrency': args.concurrency,
+        'requests': len(latencies), 'errors': errors, 'seconds': round(elapsed, 3),
+        'req_per_s': round(len(latencies) / elapsed, 1),
+        'tokens_per_s': round(len(latencies) * args.tokens / elapsed, 1),
+        'ttft_p50_ms': _pct(ttfts, 0.50), 'ttft_p99_ms': _pct(ttfts, 0.99),
+        'latency_p50_ms': _pct(latencies, 0.50), 'latency_p99_ms': _pct(latencies, 0.99),
+        'overhead_p50_ms': _pct(overheads, 0.50), 'overhead_p99_ms': _pct(overheads, 0.99),
+        **_rss_mb(proc.pid),
+    }
+
+
+def _name(scenario: dict) -> str:
+    return f"{scenario['protocol']}/{'stream' if scenario['stream'] else 'json'}"
+
+
+def _print(results: dict, baseline: dict = None):
+    before = {_name(s): s for s in (baseline or {}).get('scenarios', [])}
+    cols = ('req_per_s', 'tokens_per_s', 'ttft_p50_ms', 'ttft_p99_ms', 'overhead_p50_ms', 'overhead_p99_ms', 'rss_mb')
+    print(f'{"scenario":<18}' + ''.join(f'{c:>17}' for c in cols))
+    for s in results['scenarios']:
+        cells = []
+        for c in cols:
+            cell = f'{s[c]}'
+            old = before.get(_name(s), {}).get(c)
+            if c in _COMPARED and old and s[c] is not None:
+                cell += f' ({(s[c] - old) / old * 100:+.0f}%)'
+            cells.append(f'{cell:>17}')
+        print(f'{_name(s):<18}' + ''.join(cells))
+
+
+async def main(args):
+    token_delay = 1 / args.token_rate if args.token_rate > 0 else 0.0
+    fake = await FakeOllama(tokens=args.tokens, token_delay=token_delay, latency=args.latency,
+                            tool_call_every=args.tool_call_every).start()
+    port = _free_port()
+    proc = await _start_adapter(port, fake.base_url)
+    scenarios = []
+    try:
+        for protocol in ('anthropic', 'openai'):
+            for stream in (False, True):
+                scenarios.append(await _scenario(f'http://127.0.0.1:{port}', fake, proc, protocol, stream, args))
+    finally:
+        proc.terminate()
+        await proc.wait()
+        await fake.stop()
+
+    results = {
+        'version': proxy.VERSION, 'python': platform.python_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'config': vars(args), 'scenarios': scenarios,
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    _print(results, baseline)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'results written to {args.output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End-to-end adapter load test against a fake Ollama')
+    parser.add_argument('--requests', type=int, default=400, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--tokens', type=int, default=64, help='output tokens per response')
+    parser.add_argument('--token-rate', type=float, default=0.0, help='fake tokens/sec per stream (0 = unthrottled)')
+    parser.add_argument('--latency', type=float, default=0.0, help='fake seconds before the first token')
+    parser.add_argument('--tool-call-every', type=int, default=0, help='every Nth response ends in a tool call')
+    parser.add_argument('--output', default='load_test_results.json')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,122 @@
+'''
+benchmarks/replay_capture.py
+Replays traffic recorded with CAPTURE_PATH against a running adapter. Requests
+are sent in capture order at their original relative start times, divided by
+--speed (use --speed 0 to send back to back). Each captured inbound body is
+sent unchanged to its original endpoint, except for an optional --model
+override.
+
+Reports achieved vs captured latency per endpoint, and optionally writes the
+per-request results as JSON.
+
+Usage:  python benchmarks/replay_capture.py captures/traffic.jsonl --target http://localhost:4000
+        python benchmarks/replay_capture.py captures/traffic.jsonl* --speed 10 --model qwen3:8b
+'''
+import argparse
+import asyncio
+import glob
+import json
+import re
+import time
+
+import httpx
+
+
+def _rotation_index(path: str) -> int:
+    '''traffic.jsonl.2 is older than traffic.jsonl.1, which is older than traffic.jsonl.'''
+    m = re.search(r'\.(\d+)$', path)
+    return int(m.group(1)) if m else 0
+
+
+def load(patterns: list) -> list:
+    paths = sorted({p for pattern in patterns for p in glob.glob(pattern)}, key=_rotation_index, reverse=True)
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda r: r['ts'])
+    return records
+
+
+def _pct(samples: list, p: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))], 1)
+
+
+async def _send(client: httpx.AsyncClient, record: dict, model: str) -> dict:
+    body = dict(record['request'])
+    if model: body['model'] = model
+    t0 = time.perf_counter()
+    status = None
+    try:
+        if body.get('stream'):
+            async with client.stream('POST', record['endpoint'], json=body) as resp:
+                status = resp.status_code
+                async for _ in resp.aiter_raw():
+                    pass
+        else:
+            status = (await client.post(record['endpoint'], json=body)).status_code
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    return {
+        'endpoint': record['endpoint'], 'stream': bool(body.get('stream')), 'status': status,
+        'captured_status': record.get('status'), 'captured_ms': record.get('duration_ms'),
+        'replayed_ms': round((time.perf_counter() - t0) * 1000, 3),
+    }
+
+
+async def replay(records: list, target: str, speed: float, model: str) -> list:
+    if not records:
+        return []
+    origin = records[0]['ts']
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=64)
+    async with httpx.AsyncClient(base_url=target, limits=limits, timeout=None) as client:
+        started = time.perf_counter()
+
+        async def paced(record: dict) -> dict:
+            if speed > 0:
+                delay = (record['ts'] - origin) / speed - (time.perf_counter() - started)
+                if delay > 0: await asyncio.sleep(delay)
+            return await _send(client, record, model)
+
+        return await asyncio.gather(*(paced(r) for r in records))
+
+
+def report(results: list):
+    print(f'{"endpoint":<24}{"stream":>7}{"sent":>6}{"errors":>7}{"captured p50/p99 ms":>22}{"replayed p50/p99 ms":>22}')
+    groups = {}
+    for r in results:
+        groups.setdefault((r['endpoint'], r['stream']), []).append(r)
+    for (endpoint, stream), rs in sorted(groups.items()):
+        errors = sum(1 for r in rs if r['status'] != 200)
+        captured = [r['captured_ms'] for r in rs if r['captured_ms'] is not None]
+        replayed = [r['replayed_ms'] for r in rs]
+        print(f'{endpoint:<24}{str(stream):>7}{len(rs):>6}{errors:>7}'
+              f'{f"{_pct(captured, 0.5)}/{_pct(captured, 0.99)}":>22}{f"{_pct(replayed, 0.5)}/{_pct(replayed, 0.99)}":>22}')
+
+
+def main(args):
+    records = load(args.files)
+    if args.limit: records = records[:args.limit]
+    span = records[-1]['ts'] - records[0]['ts'] if records else 0.0
+    print(f'replaying {len(records)} requests spanning {span:.1f}s at speed {args.speed or "max"} against {args.target}')
+    t0 = time.perf_counter()
+    results = asyncio.run(replay(records, args.target, args.speed, args.model))
+    print(f'done in {time.perf_counter() - t0:.1f}s')
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay captured adapter traffic')
+    parser.add_argument('files', nargs='+', help='capture files or globs (rotated files included)')
+    parser.add_argument('--target', default='http://localhost:4000')
+    parser.add_argument('--speed', type=float, default=1.0, help='pacing multiplier; 0 sends without pauses')
+    parser.add_argument('--model', default='', help='send every request to this model instead')
+    parser.add_argument('--limit', type=int, default=0)
+    parser.add_argument('--output', help='write per-request results as JSON')
+    main(parser.parse_args())
@@ -3,18 +3,42 @@ claude-code-ollama-adapter - proxy.py
 Exposes OpenAI-compatible (/v1/chat/completions) AND Anthropic-compatible (/v1/messages) endpoints.
 Translates incoming requests to Ollama's native /api/chat format, including streaming and tools.
 '''
+import argparse
+import asyncio
+import base64
+import bisect
+import collections
+import fnmatch
+import hashlib
+import itertools
 import json
+import logging
+import math
 import os
+import random
 import re
+import shutil
+import struct
+import tempfile
+import threading
 import time
 import uuid
+from contextlib import asynccontextmanager
 from typing import AsyncIterator, Optional, List, Dict, Any
+from json.encoder import encode_basestring_ascii
 import httpx
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+
+try:
+    import orjson
+except ImportError:  # optional fast JSON backend
+    orjson = None
 
 OLLAMA_BASE_URL = os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434')
-_SSE_SEP = chr(10) + chr(10)
+
+logger = logging.getLogger('proxy')
 
 # Think models: opt-in only via THINK_MODELS env var
 _DEFAULT_THINK_MODELS: set[str] = {'glm-5:cloud', 'glm4:thinking'}
@@ -22,17 +46,1217 @@ THINK_MODELS: set[str] = _DEFAULT_THINK_MODELS | {
     m.strip() for m in os.getenv('THINK_MODELS', '').split(',') if m.strip()
 }
 
+def _parse_model_map(raw: str) -> Dict[str, str]:
+    '''Parses "model=value,model=value" env var syntax.'''
+    result = {}
+    for item in raw.split(','):
+        if '=' in item:
+            k, v = item.split('=', 1)
+            if k.strip(): result[k.strip()] = v.strip()
+    return result
+
 _ANTHROPIC_DROP_PARAMS = {'output_config', 'thinking', 'metadata', 'anthropic_version', 'betas'}
 
+# Thinking capability registry: learned from /api/show and "does not support thinking" errors
+THINK_CAPABILITY_TTL = float(os.getenv('THINK_CAPABILITY_TTL', '3600'))
+
+# Model catalog: /api/tags + /api/show metadata, served stale while revalidating
+MODEL_CATALOG_TTL = float(os.getenv('MODEL_CATALOG_TTL', '60'))
+MODEL_CATALOG_REJECT_UNKNOWN = os.getenv('MODEL_CATALOG_REJECT_UNKNOWN', '1').lower() in ('1', 'true', 'yes')
+
+# Warm pool: preload models, pin them with keep_alive and evict cold ones under a memory budget
+WARM_MODELS: List[str] = [m.strip() for m in os.getenv('WARM_MODELS', '').split(',') if m.strip()]
+MODEL_KEEP_ALIVE = os.getenv('MODEL_KEEP_ALIVE', '')
+MODEL_KEEP_ALIVE_OVERRIDES: Dict[str, str] = _parse_model_map(os.getenv('MODEL_KEEP_ALIVE_OVERRIDES', ''))
+WARM_POOL_MEMORY_BUDGET_MB = int(os.getenv('WARM_POOL_MEMORY_BUDGET_MB', '0'))
+WARM_POOL_POLL_INTERVAL = float(os.getenv('WARM_POOL_POLL_INTERVAL', '30'))
+
+# Shared upstream connection pool (built once per process in the lifespan hook)
+OLLAMA_MAX_CONNECTIONS = int(os.getenv('OLLAMA_MAX_CONNECTIONS', '100'))
+OLLAMA_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('OLLAMA_MAX_KEEPALIVE_CONNECTIONS', '20'))
+OLLAMA_KEEPALIVE_EXPIRY = float(os.getenv('OLLAMA_KEEPALIVE_EXPIRY', '30'))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv('OLLAMA_CONNECT_TIMEOUT', '10'))
+OLLAMA_READ_TIMEOUT = float(os.getenv('OLLAMA_READ_TIMEOUT', '120'))
+OLLAMA_POOL_TIMEOUT = float(os.getenv('OLLAMA_POOL_TIMEOUT', '10'))
+
+# Backend pool: OLLAMA_BASE_URL may list several comma-separated Ollama servers
+OLLAMA_BACKEND_MAX_FAILURES = int(os.getenv('OLLAMA_BACKEND_MAX_FAILURES', '3'))
+OLLAMA_BACKEND_PROBE_INTERVAL = float(os.getenv('OLLAMA_BACKEND_PROBE_INTERVAL', '15'))
+
+# Admission control: 0 disables a limit; waiting requests queue FIFO up to ADMISSION_QUEUE_SIZE
+ADMISSION_MODEL_CONCURRENCY = int(os.getenv('ADMISSION_MODEL_CONCURRENCY', '0'))
+ADMISSION_MODEL_LIMITS: Dict[str, int] = {
+    k: int(v) for k, v in _parse_model_map(os.getenv('ADMISSION_MODEL_LIMITS', '')).items()
+}
+ADMISSION_BACKEND_CONCURRENCY = int(os.getenv('ADMISSION_BACKEND_CONCURRENCY', '0'))
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', '32'))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '30'))
+
+# Response cache: opt-in, only for deterministic requests (temperature 0 or a fixed seed)
+RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', '').lower() in ('1', 'true', 'yes')
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+RESPONSE_CACHE_DIR = os.getenv('RESPONSE_CACHE_DIR', '')
+
+# SSE coalescing: merge consecutive token deltas up to a byte threshold or flush interval (0 = off)
+SSE_COALESCE_BYTES = int(os.getenv('SSE_COALESCE_BYTES', '0'))
+SSE_COALESCE_INTERVAL = float(os.getenv('SSE_COALESCE_INTERVAL', '0.05'))
+
+# Incremental translation: memoize converted Anthropic messages by content hash (0 = off)
+TRANSLATION_CACHE_MAX_BYTES = int(os.getenv('TRANSLATION_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+
+# Single-flight: identical in-flight requests share one generation (opt-in per model, "*" for all)
+SINGLE_FLIGHT_MODELS: List[str] = [m.strip() for m in os.getenv('SINGLE_FLIGHT_MODELS', '').split(',') if m.strip()]
+
+# Traffic capture: opt-in, sampled JSONL of inbound/translated bodies, chunk timings and usage
+CAPTURE_PATH = os.getenv('CAPTURE_PATH', '')
+CAPTURE_SAMPLE_RATE = float(os.getenv('CAPTURE_SAMPLE_RATE', '1.0'))
+CAPTURE_MAX_BYTES = int(os.getenv('CAPTURE_MAX_BYTES', str(100 * 1024 * 1024)))
+CAPTURE_BACKUPS = int(os.getenv('CAPTURE_BACKUPS', '5'))
+CAPTURE_FLUSH_INTERVAL = float(os.getenv('CAPTURE_FLUSH_INTERVAL', '1.0'))
+
+# Context budget: estimate prompt tokens, compact old oversized tool results (off | trim | elide) and size num_ctx
+CONTEXT_COMPACTION = os.getenv('CONTEXT_COMPACTION', 'off').lower()
+CONTEXT_CHARS_PER_TOKEN = float(os.getenv('CONTEXT_CHARS_PER_TOKEN', '4'))
+CONTEXT_OUTPUT_RESERVE = int(os.getenv('CONTEXT_OUTPUT_RESERVE', '4096'))
+CONTEXT_KEEP_RECENT = int(os.getenv('CONTEXT_KEEP_RECENT', '4'))
+CONTEXT_TOOL_RESULT_MAX_TOKENS = int(os.getenv('CONTEXT_TOOL_RESULT_MAX_TOKENS', '1024'))
+NUM_CTX_BUCKETS = sorted(int(b) for b in os.getenv('NUM_CTX_BUCKETS', '').split(',') if b.strip())
+
+# Model routing: map requested (e.g. Claude) model names to local models; keys may be glob patterns like claude-*haiku*
+MODEL_ALIASES = _parse_model_map(os.getenv('MODEL_ALIASES', ''))
+# Lightweight requests (no tools, small max_tokens / prompt) go to MODEL_DOWNGRADE; 0 disables a threshold
+MODEL_DOWNGRADE = os.getenv('MODEL_DOWNGRADE', '')
+MODEL_DOWNGRADE_MAX_TOKENS = int(os.getenv('MODEL_DOWNGRADE_MAX_TOKENS', '0'))
+MODEL_DOWNGRADE_MAX_PROMPT_TOKENS = int(os.getenv('MODEL_DOWNGRADE_MAX_PROMPT_TOKENS', '0'))
+MODEL_DOWNGRADE_WITH_TOOLS = os.getenv('MODEL_DOWNGRADE_WITH_TOOLS', '').lower() in ('1', 'true', 'yes')
+
+# Embeddings: concurrent /v1/embeddings requests per model are micro-batched into one /api/embed call
+EMBED_BATCH_MAX_INPUTS = int(os.getenv('EMBED_BATCH_MAX_INPUTS', '64'))
+EMBED_BATCH_WINDOW = float(os.getenv('EMBED_BATCH_WINDOW', '0.005'))
+EMBED_BATCH_CONCURRENCY = int(os.getenv('EMBED_BATCH_CONCURRENCY', '1'))
+
+# Cancellation: upstream work stops when the client disconnects or its deadline (seconds, from headers) passes
+REQUEST_TIMEOUT_HEADERS = [h.strip().lower() for h in os.getenv('REQUEST_TIMEOUT_HEADERS', 'x-request-timeout,x-stainless-timeout').split(',') if h.strip()]
+REQUEST_TIMEOUT_MAX = float(os.getenv('REQUEST_TIMEOUT_MAX', '3600'))
+# The SDKs send this on every request as their httpx timeout, which bounds each read, not the whole response
+_READ_TIMEOUT_HEADERS = {'x-stainless-timeout'}
+
+# Workers: `python proxy.py` runs ADAPTER_WORKERS processes on one socket; ADAPTER_COORDINATOR is set for them
+ADAPTER_WORKERS = int(os.getenv('ADAPTER_WORKERS', '1'))
+ADAPTER_COORDINATOR = os.getenv('ADAPTER_COORDINATOR', '')
+
 VERSION = '0.4.4'
-app = FastAPI(title='Claude Code Ollama Adapter', version=VERSION)
 
-def _should_think(model: str, request_think: Optional[bool]) -> bool:
-    if request_think is False:
+_http_client: Optional[httpx.AsyncClient] = None
+
+def _build_http_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=OLLAMA_MAX_CONNECTIONS,
+        max_keepalive_connections=OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(
+        connect=OLLAMA_CONNECT_TIMEOUT,
+        read=OLLAMA_READ_TIMEOUT,
+        write=OLLAMA_READ_TIMEOUT,
+        pool=OLLAMA_POOL_TIMEOUT,
+    )
+    mounts = {}
+    for backend in _backends.backends:
+        if backend.transport is not None:
+            url = httpx.URL(backend.url)
+            mounts[f'{url.scheme}://{url.netloc.decode()}'] = _upstream_transport(backend, limits)
+    return httpx.AsyncClient(limits=limits, timeout=timeout, mounts=mounts or None)
+
+# Upstream transports: unix:///path/to/ollama.sock and h2c://host:port backends get their own mounted transports
+def _upstream_target(address: str) -> tuple:
+    '''Maps a configured backend address to (request base URL, transport kind or None, socket path).'''
+    if address.startswith('unix://'):
+        path = address[len('unix://'):]
+        # Ollama only accepts loopback-looking Host headers on a socket listener, so the name ends in .localhost
+        return f'http://ollama-{hashlib.sha1(path.encode()).hexdigest()[:12]}.localhost', 'unix', path
+    if address.startswith('h2c://'):
+        return 'http://' + address[len('h2c://'):], 'h2c', None
+    return address, None, None
+
+def _upstream_transport(backend: '_Backend', limits: httpx.Limits) -> httpx.AsyncHTTPTransport:
+    if backend.transport == 'unix':
+        return httpx.AsyncHTTPTransport(uds=backend.socket, limits=limits)
+    try:
+        # HTTP/2 with prior knowledge over cleartext: concurrent streams share one connection
+        return httpx.AsyncHTTPTransport(http1=False, http2=True, limits=limits)
+    except ImportError:
+        logger.warning('h2c backend %s needs the h2 package; falling back to HTTP/1.1', backend.address)
+        return httpx.AsyncHTTPTransport(limits=limits)
+
+def _client() -> httpx.AsyncClient:
+    # Lazily built when the app runs without its lifespan (e.g. mounted or called directly)
+    global _http_client
+    if _http_client is None:
+        _http_client = _build_http_client()
+    return _http_client
+
+def _model_key(model: str) -> str:
+    return model if ':' in model else model + ':latest'
+
+# Metrics: Prometheus text exposition served at /metrics, no client library or external service needed
+_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+_OVERHEAD_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+_RATE_BUCKETS = (1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 50.0, 75.0, 100.0, 150.0, 250.0)
+_REQUEST_LABELS = ('model', 'endpoint', 'stream')
+
+def _label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class _Histogram:
+    def __init__(self, name: str, help: str, labels: tuple, buckets: tuple):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> per-bucket counts (last slot is +Inf), sum, count
+        self.series: Dict[tuple, list] = {}
+
+    def observe(self, labels: tuple, value: float):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def merge(self, labels: tuple, data: list):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0] = [a + b for a, b in zip(series[0], data[0])]
+        series[1] += data[1]
+        series[2] += data[2]
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for values, (counts, total, count) in sorted(self.series.items()):
+            labels = ','.join(f'{k}="{_label_value(v)}"' for k, v in zip(self.labels, values))
+            sep = ',' if labels else ''
+            cumulative = 0
+            for le, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{{{labels}{sep}le="{le}"}} {cumulative}')
+            suffix = f'{{{labels}}}' if labels else ''
+            lines.append(f'{self.name}_sum{suffix} {total}')
+            lines.append(f'{self.name}_count{suffix} {count}')
+        return lines
+
+class _Counter:
+    def __init__(self, name: str, help: str, labels: tuple):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series: Dict[tuple, float] = {}
+
+    def inc(self, labels: tuple, value: float = 1):
+        self.series[labels] = self.series.get(labels, 0) + value
+
+    merge = inc
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for values, total in sorted(self.series.items()):
+            labels = ','.join(f'{k}="{_label_value(v)}"' for k, v in zip(self.labels, values))
+            lines.append(f'{self.name}{{{labels}}} {total}')
+        return lines
+
+class _Metrics:
+    '''Request histograms fed by proxy timings and the durations in Ollama's final done chunk.'''
+
+    def __init__(self):
+        h = _Histogram
+        self.histograms = [
+            h('adapter_time_to_first_token_seconds', 'Request start to first upstream token', _REQUEST_LABELS, _LATENCY_BUCKETS),
+            h('adapter_request_duration_seconds', 'Request start to final upstream chunk', _REQUEST_LABELS, _LATENCY_BUCKETS),
+            h('adapter_output_tokens_per_second', 'Ollama eval_count / eval_duration', _REQUEST_LABELS, _RATE_BUCKETS),
+            h('adapter_proxy_overhead_seconds', 'Request duration not covered by Ollama total_duration', _REQUEST_LABELS, _OVERHEAD_BUCKETS),
+            h('adapter_queue_wait_seconds', 'Time spent waiting for admission', ('model',), _OVERHEAD_BUCKETS + (5.0, 10.0, 30.0)),
+            h('ollama_load_duration_seconds', 'Ollama load_duration', _REQUEST_LABELS, _LATENCY_BUCKETS),
+            h('ollama_prompt_eval_duration_seconds', 'Ollama prompt_eval_duration', _REQUEST_LABELS, _LATENCY_BUCKETS),
+            h('ollama_eval_duration_seconds', 'Ollama eval_duration', _REQUEST_LABELS, _LATENCY_BUCKETS),
+            h('adapter_embedding_batch_inputs', 'Inputs per /api/embed call', ('model',), (1, 2, 4, 8, 16, 32, 64, 128, 256)),
+        ]
+        (self.ttft, self.duration, self.tokens_per_second, self.overhead,
+         self.queue_wait, self.load, self.prompt_eval, self.eval, self.embed_batch) = self.histograms
+        self.counters = [
+            _Counter('adapter_cancelled_generations_total', 'Upstream generations stopped by client disconnect or deadline',
+                     _REQUEST_LABELS + ('reason',)),
+            _Counter('adapter_cancelled_tokens_saved_total', 'Unused num_predict budget of cancelled generations', _REQUEST_LABELS),
+            _Counter('adapter_model_routes_total', 'Requests by routing decision', ('alias', 'model', 'route')),
+        ]
+        self.cancelled, self.tokens_saved, self.routes = self.counters
+
+    def observe(self, labels: tuple, started: float, first_token: Optional[float], done: dict):
+        '''Records one upstream-served request; first_token is None for non-streaming calls.'''
+        elapsed = time.monotonic() - started
+        eval_seconds = done.get('eval_duration', 0) / 1e9
+        if first_token is None:
+            first_token = started + max(0.0, elapsed - eval_seconds)
+        self.ttft.observe(labels, first_token - started)
+        self.duration.observe(labels, elapsed)
+        if eval_seconds > 0:
+            self.tokens_per_second.observe(labels, done.get('eval_count', 0) / eval_seconds)
+        if 'total_duration' in done:
+            self.overhead.observe(labels, max(0.0, elapsed - done['total_duration'] / 1e9))
+        for histogram, field in ((self.load, 'load_duration'), (self.prompt_eval, 'prompt_eval_duration'), (self.eval, 'eval_duration')):
+            if field in done: histogram.observe(labels, done[field] / 1e9)
+
+    async def track(self, labels: tuple, started: float, chunks: AsyncIterator[dict]) -> AsyncIterator[dict]:
+        first_token = None
+        async for chunk in chunks:
+            if first_token is None:
+                msg = chunk.get('message', {})
+                if chunk.get('done') or msg.get('content') or msg.get('thinking') or msg.get('tool_calls'):
+                    first_token = time.monotonic()
+            if chunk.get('done'): self.observe(labels, started, first_token, chunk)
+            yield chunk
+
+    def snapshot(self) -> dict:
+        '''JSON-safe copy of every series, for merging across worker processes.'''
+        return {m.name: [[list(labels), data] for labels, data in m.series.items()] for m in self.histograms + self.counters}
+
+    def merge(self, snapshot: dict):
+        for metric in self.histograms + self.counters:
+            for labels, data in snapshot.get(metric.name, ()):
+                metric.merge(tuple(labels), data)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.histograms + self.counters:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+_metrics = _Metrics()
+
+_USAGE_FIELDS = ('prompt_eval_count', 'eval_count', 'total_duration', 'load_duration', 'prompt_eval_duration', 'eval_duration', 'done_reason')
+
+class _TrafficCapture:
+    '''Samples requests into a rotating JSONL file.
+
+    Records are queued in memory and serialized and written in batches on a worker thread, so
+    the event loop never blocks on disk; when the queue is full new records are dropped.
+    '''
+
+    def __init__(self, path: str, sample_rate: float, max_bytes: int, backups: int, max_pending: int = 10000):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.max_pending = max_pending
+        self._pending: List[dict] = []
+        self.captured = 0
+        self.dropped = 0
+        self._dropped_reported = 0
+
+    def start(self, endpoint: str, body: dict, ollama_body: dict) -> Optional[dict]:
+        if not self.path or random.random() >= self.sample_rate:
+            return None
+        return {
+            'ts': time.time(), 'endpoint': endpoint, 'model': body.get('model', ''), 'stream': bool(body.get('stream')),
+            'request': dict(body), 'ollama_request': ollama_body,
+        }
+
+    def finish(self, entry: Optional[dict], outcome: str, started: float, done: Optional[dict] = None,
+               chunk_ms: Optional[List[float]] = None, status: Optional[int] = None):
+        if entry is None:
+            return
+        entry['outcome'] = outcome
+        if status is not None: entry['status'] = status
+        entry['duration_ms'] = round((time.monotonic() - started) * 1000, 3)
+        if chunk_ms is not None: entry['chunk_ms'] = chunk_ms
+        if done: entry['usage'] = {k: done[k] for k in _USAGE_FIELDS if k in done}
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._pending.append(entry)
+
+    async def track(self, entry: dict, started: float, chunks: AsyncIterator[dict]) -> AsyncIterator[dict]:
+        '''Records each upstream chunk's arrival, in ms since the request started.'''
+        offsets: List[float] = []
+        done, outcome, status = None, 'aborted', None
+        try:
+            async for chunk in chunks:
+                offsets.append(round((time.monotonic() - started) * 1000, 3))
+                if chunk.get('done'): done, outcome, status = chunk, 'ok', 200
+                yield chunk
+        except _UpstreamError as e:
+            outcome, status = 'upstream_error', e.status_code
+            raise
+        finally:
+            self.finish(entry, outcome, started, done, offsets, status)
+
+    async def flush(self):
+        if self.dropped > self._dropped_reported:
+            logger.warning('Traffic capture queue full, dropped %d records', self.dropped - self._dropped_reported)
+            self._dropped_reported = self.dropped
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        try:
+            await asyncio.to_thread(self._write, batch)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning('Traffic capture write to %s failed: %s', self.path, e)
+
+    def _write(self, batch: List[dict]):
+        data = ''.join(json.dumps(e, ensure_ascii=False, separators=(',', ':')) + '\n' for e in batch).encode()
+        directory = os.path.dirname(self.path)
+        if directory: os.makedirs(directory, exist_ok=True)
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        if size and size + len(data) > self.max_bytes:
+            self._rotate()
+        with open(self.path, 'ab') as f:
+            f.write(data)
+        self.captured += len(batch)
+
+    def _rotate(self):
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        os.replace(self.path, self.path + '.1')
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(CAPTURE_FLUSH_INTERVAL)
+            await self.flush()
+
+_capture = _TrafficCapture(CAPTURE_PATH, CAPTURE_SAMPLE_RATE, CAPTURE_MAX_BYTES, CAPTURE_BACKUPS)
+
+class _Backend:
+    def __init__(self, address: str):
+        self.address = address.rstrip('/')
+        self.url, self.transport, self.socket = _upstream_target(self.address)
+        self.models: set[str] = set()
+        self.tags: Dict[str, dict] = {}
+        self.outstanding = 0
+        self.failures = 0
+        self.healthy = True
+
+    def serves(self, model: str) -> bool:
+        return model in self.models or _model_key(model) in self.models
+
+    def status(self) -> dict:
+        return {
+            'url': self.address, 'healthy': self.healthy, 'outstanding': self.outstanding,
+            'failures': self.failures, 'models': sorted(self.models),
+        }
+
+class _BackendPool:
+    '''Routes each request to the least-outstanding healthy backend serving its model.'''
+
+    def __init__(self, urls: List[str]):
+        self.backends = [_Backend(u) for u in urls]
+
+    def pick(self, model: str) -> _Backend:
+        # Never refuse outright: with every backend ejected, fall back to all of them
+        healthy = [b for b in self.backends if b.healthy] or self.backends
+        candidates = (
+            [b for b in healthy if b.serves(model)]
+            or [b for b in healthy if not b.models]
+            or healthy
+        )
+        return min(candidates, key=lambda b: b.outstanding)
+
+    def lease(self, model: str) -> '_Lease':
+        return _Lease(self, self.pick(model))
+
+    def observe(self, backend: _Backend, status_code: int):
+        if status_code >= 500:
+            self.mark_failure(backend)
+        else:
+            backend.failures = 0
+
+    def mark_failure(self, backend: _Backend):
+        backend.failures += 1
+        if backend.healthy and backend.failures >= OLLAMA_BACKEND_MAX_FAILURES:
+            backend.healthy = False
+            logger.warning('ejecting Ollama backend %s after %d failures', backend.address, backend.failures)
+
+    async def refresh(self, backend: _Backend) -> bool:
+        try:
+            r = await _client().get(backend.url + '/api/tags', timeout=5)
+            r.raise_for_status()
+            backend.tags = {m['name']: m for m in r.json().get('models', [])}
+            backend.models = set(backend.tags)
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            if backend.healthy:
+                logger.warning('Ollama backend %s probe failed: %s', backend.address, e)
+            backend.healthy = False
+            return False
+        if not backend.healthy:
+            logger.info('Ollama backend %s is healthy again', backend.address)
+        backend.healthy = True
+        backend.failures = 0
+        return True
+
+    async def refresh_all(self) -> bool:
+        '''Refreshes every backend; True if at least one answered.'''
+        return any(await asyncio.gather(*(self.refresh(b) for b in self.backends)))
+
+    async def probe_loop(self):
+        while True:
+            await asyncio.sleep(OLLAMA_BACKEND_PROBE_INTERVAL)
+            await self.refresh_all()
+
+_backends = _BackendPool([u.strip() for u in OLLAMA_BASE_URL.split(',') if u.strip()])
+
+class _Overloaded(Exception):
+    def __init__(self, limiter: '_Limiter', reason: str):
+        super().__init__(f'{limiter.name}: {reason}')
+        self.retry_after = limiter.retry_after()
+
+class _Limiter:
+    '''Concurrency slots with a bounded FIFO wait queue and a queue-wait deadline.'''
+
+    def __init__(self, name: str, limit: int, queue_size: int):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self._waiters: collections.deque = collections.deque()
+        self._hold_ewma = 1.0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._wait_total = 0.0
+        self.max_wait = 0.0
+
+    async def acquire(self, timeout: float) -> float:
+        '''Waits for a slot and returns the acquisition time.'''
+        started = time.monotonic()
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+        elif len(self._waiters) >= self.queue_size:
+            self.rejected += 1
+            raise _Overloaded(self, 'queue full')
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            self._waiters.append(fut)
+            try:
+                await asyncio.wait_for(asyncio.shield(fut), timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if fut.done() and not fut.cancelled():
+                    # The slot was handed over as we gave up; pass it on
+                    self.release()
+                else:
+                    fut.cancel()
+                    self._waiters.remove(fut)
+                if isinstance(e, asyncio.TimeoutError):
+                    self.timed_out += 1
+                    raise _Overloaded(self, 'queue wait deadline exceeded') from None
+                raise
+        now = time.monotonic()
+        waited = now - started
+        self.admitted += 1
+        self._wait_total += waited
+        self.max_wait = max(self.max_wait, waited)
+        return now
+
+    def release(self, acquired_at: Optional[float] = None):
+        if acquired_at is not None:
+            self._hold_ewma = 0.8 * self._hold_ewma + 0.2 * (time.monotonic() - acquired_at)
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self._hold_ewma * (len(self._waiters) + 1) / max(self.limit, 1)))
+
+    def stats(self) -> dict:
+        return {
+            'limit': self.limit, 'active': self.active, 'queued': len(self._waiters),
+            'queue_size': self.queue_size, 'admitted': self.admitted, 'rejected': self.rejected,
+            'timed_out': self.timed_out, 'max_wait_ms': round(self.max_wait * 1000, 1),
+            'avg_wait_ms': round(self._wait_total / self.admitted * 1000, 1) if self.admitted else 0.0,
+        }
+
+class _Lease:
+    '''A backend (plus any admission slots) held for one upstream request; release() is idempotent.'''
+
+    def __init__(self, pool: _BackendPool, backend: _Backend, slots: Optional[list] = None):
+        self.pool = pool
+        self.backend = backend
+        self._slots = slots or []
+        self._released = False
+        backend.outstanding += 1
+
+    async def __aenter__(self) -> _Backend:
+        return self.backend
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None and issubclass(exc_type, httpx.TransportError):
+            self.pool.mark_failure(self.backend)
+        self.release()
         return False
-    if model not in THINK_MODELS:
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self.backend.outstanding -= 1
+        for limiter, acquired_at in reversed(self._slots):
+            limiter.release(acquired_at)
+
+class _Admission:
+    '''Per-model and per-backend concurrency limits in front of the backend pool.'''
+
+    def __init__(self, pool: _BackendPool):
+        self.pool = pool
+        self.limiters: Dict[str, _Limiter] = {}
+
+    def _limiter(self, name: str, limit: int) -> Optional[_Limiter]:
+        if limit <= 0:
+            return None
+        limiter = self.limiters.get(name)
+        if limiter is None:
+            limiter = self.limiters[name] = _Limiter(name, limit, ADMISSION_QUEUE_SIZE)
+        return limiter
+
+    @staticmethod
+    def _model_limit(key: str) -> int:
+        # "qwen3" and "qwen3:latest" name the same model, in the config and in requests
+        for name, limit in ADMISSION_MODEL_LIMITS.items():
+            if _model_key(name) == key:
+                return limit
+        return ADMISSION_MODEL_CONCURRENCY
+
+    async def admit(self, model: str) -> _Lease:
+        started = time.monotonic()
+        deadline = started + ADMISSION_QUEUE_TIMEOUT
+        key = _model_key(model)
+        slots = []
+        try:
+            model_limiter = self._limiter('model:' + key, self._model_limit(key))
+            if model_limiter:
+                slots.append((model_limiter, await model_limiter.acquire(deadline - time.monotonic())))
+            backend = self.pool.pick(model)
+            backend_limiter = self._limiter('backend:' + backend.address, ADMISSION_BACKEND_CONCURRENCY)
+            if backend_limiter:
+                slots.append((backend_limiter, await backend_limiter.acquire(max(0.0, deadline - time.monotonic()))))
+        except BaseException:
+            for limiter, acquired_at in reversed(slots):
+                limiter.release(acquired_at)
+            raise
+        _metrics.queue_wait.observe((key,), time.monotonic() - started)
+        return _Lease(self.pool, backend, slots)
+
+    def stats(self) -> dict:
+        return {name: limiter.stats() for name, limiter in sorted(self.limiters.items())}
+
+_admission = _Admission(_backends)
+
+def _body_digest(ollama_body: dict, exclude: tuple) -> str:
+    canonical = {k: v for k, v in ollama_body.items() if k not in exclude}
+    raw = json.dumps(canonical, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+class _ResponseCache:
+    '''LRU of final Ollama responses bounded by bytes and TTL, with an optional on-disk tier.'''
+
+    def __init__(self, enabled: bool, max_bytes: int, ttl: float, directory: str = ''):
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, ollama_body: dict) -> Optional[str]:
+        if not self.enabled:
+            return None
+        options = ollama_body.get('options') or {}
+        if options.get('temperature') != 0 and options.get('seed') is None:
+            return None
+        # Streaming and non-streaming calls share entries
+        return _body_digest(ollama_body, ('stream', 'keep_alive'))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.json')
+
+    async def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, raw = entry
+            if expires > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(raw)
+            self._evict(key)
+        if self.directory:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is not None:
+                # The memory copy expires with the file, not a fresh TTL from now
+                expires, raw = entry
+                self._store(key, raw, expires)
+                self.hits += 1
+                return json.loads(raw)
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, ollama_data: dict):
+        raw = json.dumps(ollama_data, separators=(',', ':')).encode()
+        self._store(key, raw)
+        if self.directory:
+            await asyncio.to_thread(self._write_disk, key, raw)
+
+    def _store(self, key: str, raw: bytes, expires: Optional[float] = None):
+        if len(raw) > self.max_bytes:
+            return
+        self._evict(key)
+        self._entries[key] = (expires or time.time() + self.ttl, raw)
+        self.size += len(raw)
+        while self.size > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+
+    def _evict(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def _read_disk(self, key: str) -> Optional[tuple]:
+        path = self._path(key)
+        try:
+            expires = os.path.getmtime(path) + self.ttl
+            if expires < time.time():
+                os.remove(path)
+                return None
+            with open(path, 'rb') as f:
+                return expires, f.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, key: str, raw: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self._path(key) + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(raw)
+        os.replace(tmp, self._path(key))
+
+    async def record(self, key: str, chunks: AsyncIterator[dict]) -> AsyncIterator[dict]:
+        '''Passes a chunk stream through and caches the assembled response once it completes.'''
+        thinking, content, tool_calls = [], [], []
+        async for chunk in chunks:
+            msg = chunk.get('message', {})
+            if msg.get('thinking'): thinking.append(msg['thinking'])
+            if msg.get('content'): content.append(msg['content'])
+            if msg.get('tool_calls'): tool_calls.extend(msg['tool_calls'])
+            if chunk.get('done'):
+                message = {'role': 'assistant', 'content': ''.join(content)}
+                if thinking: message['thinking'] = ''.join(thinking)
+                if tool_calls: message['tool_calls'] = tool_calls
+                await self.put(key, {**chunk, 'message': message})
+            yield chunk
+
+async def _replay_chunks(ollama_data: dict) -> AsyncIterator[dict]:
+    '''Replays a cached final response as the chunk sequence a live stream would produce.'''
+    msg = ollama_data.get('message', {})
+    if msg.get('thinking'):
+        yield {'message': {'role': 'assistant', 'thinking': msg['thinking']}, 'done': False}
+    if msg.get('content'):
+        yield {'message': {'role': 'assistant', 'content': msg['content']}, 'done': False}
+    final = {'role': 'assistant', 'content': ''}
+    if msg.get('tool_calls'): final['tool_calls'] = msg['tool_calls']
+    yield {**ollama_data, 'message': final, 'done': True}
+
+_response_cache = _ResponseCache(RESPONSE_CACHE, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DIR)
+
+class _Broadcast:
+    '''Drains one chunk stream in the background and fans it out to any number of subscribers.
+
+    Late subscribers first receive the buffered prefix, then the live tail. When the last
+    subscriber leaves early the upstream stream is closed, and anyone who joins after that
+    gets an error rather than a truncated stream.
+    '''
+
+    def __init__(self, chunks: AsyncIterator[dict], on_close):
+        self.chunks: List[dict] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self._on_close = on_close
+        self._task = asyncio.ensure_future(self._pump(chunks))
+
+    async def _pump(self, chunks: AsyncIterator[dict]):
+        try:
+            async for chunk in chunks:
+                self.chunks.append(chunk)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        except asyncio.CancelledError:
+            self.error = _UpstreamError(502, 'Upstream stream was closed before it finished')
+        finally:
+            self.done = True
+            self._notify()
+            self._on_close()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def subscribe(self) -> '_Subscription':
+        return _Subscription(self)
+
+    def _leave(self):
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.done:
+            self._task.cancel()
+
+class _Subscription:
+    '''One subscriber's iterator over a _Broadcast, counted from the moment it joins.
+
+    Not an async generator: one that is never iterated never runs its finally, and an
+    uncounted joiner would let the upstream close underneath it.
+    '''
+
+    def __init__(self, broadcast: _Broadcast):
+        self.broadcast = broadcast
+        self.index = 0
+        self.active = True
+        broadcast.subscribers += 1
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict:
+        b = self.broadcast
+        try:
+            while True:
+                if self.index < len(b.chunks):
+                    self.index += 1
+                    return b.chunks[self.index - 1]
+                if b.done:
+                    if b.error is not None: raise b.error
+                    raise StopAsyncIteration
+                await b._changed.wait()
+        except BaseException:
+            self._leave()
+            raise
+
+    async def aclose(self):
+        self._leave()
+
+    def __del__(self):
+        self._leave()
+
+    def _leave(self):
+        if self.active:
+            self.active = False
+            self.broadcast._leave()
+
+class _SingleFlight:
+    '''Deduplicates identical in-flight upstream requests, keyed by the canonical translated body.'''
+
+    def __init__(self, models: List[str]):
+        self.all_models = '*' in models
+        self.models = {_model_key(m) for m in models if m != '*'}
+        self._calls: Dict[str, list] = {}  # key -> [task, waiters]
+        self._streams: Dict[str, list] = {}  # key -> [task opening the broadcast, waiters]
+        self.leaders = 0
+        self.shared = 0
+
+    def key(self, ollama_body: dict) -> Optional[str]:
+        if not (self.all_models or _model_key(ollama_body.get('model', '')) in self.models):
+            return None
+        return _body_digest(ollama_body, ('keep_alive',))
+
+    async def call(self, key: str, fetch):
+        '''Awaits the in-flight fetch() for key, starting it if there is none.
+
+        The fetch runs as its own task so a disconnecting leader does not cancel it for the others;
+        it is cancelled once every waiter has left.
+        '''
+        entry = self._calls.get(key)
+        if entry is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(fetch())
+            entry = self._calls[key] = [task, 0]
+            task.add_done_callback(lambda t: self._call_done(key, t))
+        else:
+            self.shared += 1
+        return await self._wait(entry)
+
+    @staticmethod
+    async def _wait(entry: list):
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done(): task.cancel()
+
+    def _call_done(self, key: str, task: asyncio.Future):
+        if self._calls.get(key, [None])[0] is task: del self._calls[key]
+        if not task.cancelled(): task.exception()
+
+    async def stream(self, key: str, start) -> AsyncIterator[dict]:
+        '''Subscribes to the broadcast for key, starting it from ``await start()`` if there is none.
+
+        start() returns (chunks, release) and may raise _Overloaded, which every waiter then sees.
+        Like call(), it runs as its own task, so a leader that leaves while it waits for admission
+        does not cancel it for the others.
+        '''
+        entry = self._streams.get(key)
+        if entry is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(self._open(key, start))
+            entry = self._streams[key] = [task, 0]
+            task.add_done_callback(lambda t: self._open_done(key, t))
+        else:
+            self.shared += 1
+        broadcast = await self._wait(entry)
+        return broadcast.subscribe()
+
+    async def _open(self, key: str, start) -> _Broadcast:
+        chunks, release = await start()
+        task = asyncio.current_task()
+
+        def close():
+            if self._streams.get(key, [None])[0] is task: del self._streams[key]
+            release()
+        return _Broadcast(chunks, close)
+
+    def _open_done(self, key: str, task: asyncio.Future):
+        # A broadcast stays joinable until it closes; a failed or abandoned start leaves at once
+        if task.cancelled() or task.exception() is not None:
+            if self._streams.get(key, [None])[0] is task: del self._streams[key]
+
+    def stats(self) -> dict:
+        return {
+            'models': ['*'] if self.all_models else sorted(self.models),
+            'in_flight': len(self._calls) + len(self._streams),
+            'leaders': self.leaders, 'shared': self.shared,
+        }
+
+_single_flight = _SingleFlight(SINGLE_FLIGHT_MODELS)
+
+class _ThinkRegistry:
+    '''Per-model thinking support, learned from /api/show and from upstream rejections.'''
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries: Dict[str, tuple] = {}
+
+    def supports(self, model: str) -> Optional[bool]:
+        '''True/False when known and fresh, None when the model has not been observed.'''
+        for key in (model, _model_key(model)):
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            supported, expires, _ = entry
+            if expires > time.time():
+                return supported
+            del self._entries[key]
+        return None
+
+    def record(self, model: str, supported: bool, source: str):
+        previous = self.supports(model)
+        self._entries[model] = (supported, time.time() + self.ttl, source)
+        if previous != supported:
+            logger.info('model %s %s thinking (from %s)', model, 'supports' if supported else 'does not support', source)
+
+    def invalidate(self, model: Optional[str] = None):
+        if model is None:
+            self._entries.clear()
+            return
+        for key in (model, _model_key(model)):
+            self._entries.pop(key, None)
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        return {
+            model: {'thinking': supported, 'source': source, 'expires_in': round(expires - now)}
+            for model, (supported, expires, source) in sorted(self._entries.items()) if expires > now
+        }
+
+_think_registry = _ThinkRegistry(THINK_CAPABILITY_TTL)
+
+class _ModelCatalog:
+    '''Models across all backends with /api/show metadata, refreshed stale-while-revalidate.'''
+
+    _RECHECK_INTERVAL = 5.0
+
+    def __init__(self, pool: _BackendPool, ttl: float):
+        self.pool = pool
+        self.ttl = ttl
+        self.models: Dict[str, dict] = {}
+        self.loaded = False
+        self.refreshed_at = 0.0
+        self.checked_at = 0.0
+        self._show_cache: Dict[tuple, dict] = {}
+        self._refreshing: Optional[asyncio.Task] = None
+
+    async def refresh(self):
+        if not await self.pool.refresh_all():
+            return
+        models: Dict[str, dict] = {}
+        for backend in self.pool.backends:
+            for name, tag in backend.tags.items():
+                entry = models.setdefault(name, {'name': name, 'tag': tag, 'backends': []})
+                entry['backends'].append(backend)
+        sem = asyncio.Semaphore(4)
+
+        async def describe(name: str, entry: dict) -> dict:
+            key = (name, entry['tag'].get('digest'))
+            show = self._show_cache.get(key)
+            if show is None:
+                async with sem:
+                    show = await self._show(entry['backends'][0], name)
+                # A failed /api/show comes back empty and is retried on the next refresh
+                if show: self._show_cache[key] = show
+            return self._metadata(name, entry['tag'], show)
+
+        self._install(await asyncio.gather(*(describe(n, e) for n, e in models.items())))
+
+    def _install(self, described: List[dict]):
+        self.models = {m['id']: m for m in described}
+        self.loaded = True
+        self.refreshed_at = time.time()
+        for meta in described:
+            if meta['capabilities'] is not None:
+                _think_registry.record(meta['id'], 'thinking' in meta['capabilities'], 'api/show')
+
+    async def _show(self, backend: _Backend, model: str) -> dict:
+        try:
+            r = await _client().post(backend.url + '/api/show', json={'model': model}, timeout=10)
+            r.raise_for_status()
+            return r.json()
+        except (httpx.HTTPError, ValueError) as e:
+            logger.debug('/api/show for %s on %s failed: %s', model, backend.address, e)
+            return {}
+
+    @staticmethod
+    def _metadata(name: str, tag: dict, show: dict) -> dict:
+        details = show.get('details') or tag.get('details') or {}
+        info = show.get('model_info') or {}
+        arch = info.get('general.architecture')
+        return {
+            'id': name,
+            'context_length': info.get(f'{arch}.context_length') if arch else None,
+            # Older Ollama releases do not report capabilities
+            'capabilities': show.get('capabilities'),
+            'quantization': details.get('quantization_level'),
+            'parameter_size': details.get('parameter_size'),
+            'family': details.get('family'),
+            'size': tag.get('size'),
+            'modified_at': tag.get('modified_at'),
+        }
+
+    def lookup(self, model: str) -> Optional[dict]:
+        return self.models.get(model) or self.models.get(_model_key(model))
+
+    def _revalidate(self) -> asyncio.Task:
+        # One refresh at a time; the attempt is timed even if it fails, so a down backend is not re-swept per request
+        if self._refreshing is None or self._refreshing.done():
+            self.checked_at = time.time()
+            self._refreshing = asyncio.create_task(self.refresh())
+            self._refreshing.add_done_callback(self._refreshed)
+        return self._refreshing
+
+    @staticmethod
+    def _refreshed(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning('model catalog refresh failed: %s', task.exception())
+
+    async def recheck(self):
+        '''Waits for a refresh unless one was attempted within _RECHECK_INTERVAL, joining one in flight.'''
+        running = self._refreshing is not None and not self._refreshing.done()
+        if running or time.time() - self.checked_at > self._RECHECK_INTERVAL:
+            await asyncio.shield(self._revalidate())
+
+    async def list(self) -> Dict[str, dict]:
+        if not self.loaded:
+            await self.recheck()
+        elif time.time() - self.checked_at > self.ttl:
+            self._revalidate()
+        return self.models
+
+    async def knows(self, model: str) -> bool:
+        '''False only when a loaded catalog, rechecked recently, lacks the model.'''
+        if not MODEL_CATALOG_REJECT_UNKNOWN or not self.loaded or self.lookup(model):
+            # An unloaded catalog (no backend answered yet) is retried in the background too
+            stale_after = self.ttl if self.loaded else self._RECHECK_INTERVAL
+            if time.time() - self.checked_at > stale_after:
+                self._revalidate()
+            return True
+        await self.recheck()
+        return self.lookup(model) is not None
+
+_catalog = _ModelCatalog(_backends, MODEL_CATALOG_TTL)
+
+class _WarmPool:
+    '''Keeps configured models resident: preloads them, tracks /api/ps and unloads cold models over budget.'''
+
+    _COLD_LOAD_SECONDS = 0.5
+
+    def __init__(self, pool: _BackendPool, warm_models: List[str], budget_bytes: int):
+        self.pool = pool
+        self.warm_models = warm_models
+        self.budget_bytes = budget_bytes
+        self.resident: Dict[str, Dict[str, dict]] = {}
+        self.last_used: Dict[str, float] = {}
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.evictions = 0
+
+    def _is_warm(self, model: str) -> bool:
+        return model in self.warm_models or _model_key(model) in self.warm_models
+
+    def keep_alive(self, model: str) -> Optional[Any]:
+        value = MODEL_KEEP_ALIVE_OVERRIDES.get(model) or MODEL_KEEP_ALIVE_OVERRIDES.get(_model_key(model))
+        if value is None and self._is_warm(model):
+            return -1
+        value = value or MODEL_KEEP_ALIVE
+        if not value:
+            return None
+        # Ollama parses string keep_alive as a Go duration, which needs a unit; bare numbers are seconds
+        return int(value) if re.fullmatch(r'-?\d+', value) else value
+
+    def touch(self, model: str):
+        self.last_used[_model_key(model)] = time.monotonic()
+
+    def observe(self, model: str, backend: _Backend, ollama_data: dict):
+        '''Records a cold load reported by Ollama's load_duration (nanoseconds) in a final chunk.'''
+        load_s = (ollama_data.get('load_duration') or 0) / 1e9
+        if load_s < self._COLD_LOAD_SECONDS:
+            return
+        self.loads += 1
+        self.load_seconds += load_s
+        logger.info('model %s loaded on %s in %.1fs', model, backend.address, load_s)
+
+    async def preload(self):
+        for model in self.warm_models:
+            for backend in [b for b in self.pool.backends if b.healthy and b.serves(model)]:
+                body = {'model': model, 'messages': [], 'keep_alive': self.keep_alive(model)}
+                started = time.monotonic()
+                try:
+                    r = await _client().post(backend.url + '/api/chat', json=body)
+                    r.raise_for_status()
+                except httpx.HTTPError as e:
+                    logger.warning('preloading %s on %s failed: %s', model, backend.address, e)
+                    continue
+                logger.info('preloaded %s on %s in %.1fs', model, backend.address, time.monotonic() - started)
+                self.observe(model, backend, r.json())
+
+    async def poll(self):
+        for backend in [b for b in self.pool.backends if b.healthy]:
+            try:
+                r = await _client().get(backend.url + '/api/ps', timeout=5)
+                r.raise_for_status()
+                running = {m['name']: m for m in r.json().get('models', [])}
+            except (httpx.HTTPError, ValueError, KeyError) as e:
+                logger.debug('/api/ps on %s failed: %s', backend.address, e)
+                continue
+            previous = self.resident.get(backend.address, {})
+            for name in running.keys() - previous.keys():
+                logger.info('model %s became resident on %s', name, backend.address)
+            for name in previous.keys() - running.keys():
+                logger.info('model %s was unloaded from %s', name, backend.address)
+            self.resident[backend.address] = running
+            await self.enforce_budget(backend)
+
+    async def enforce_budget(self, backend: _Backend):
+        if self.budget_bytes <= 0:
+            return
+        running = self.resident.get(backend.address, {})
+        used = sum(m.get('size_vram') or m.get('size') or 0 for m in running.values())
+        # Least recently used first; configured warm models are never evicted
+        cold = sorted(
+            (name for name in running if not self._is_warm(name)),
+            key=lambda name: self.last_used.get(name, 0.0),
+        )
+        for name in cold:
+            if used <= self.budget_bytes:
+                break
+            try:
+                r = await _client().post(backend.url + '/api/generate', json={'model': name, 'keep_alive': 0})
+                r.raise_for_status()
+            except httpx.HTTPError as e:
+                logger.warning('unloading %s from %s failed: %s', name, backend.address, e)
+                continue
+            info = running.pop(name)
+            used -= info.get('size_vram') or info.get('size') or 0
+            self.evictions += 1
+            logger.info('unloaded cold model %s from %s to stay within the memory budget', name, backend.address)
+
+    async def poll_loop(self):
+        while True:
+            await self.poll()
+            await asyncio.sleep(WARM_POOL_POLL_INTERVAL)
+
+    def stats(self) -> dict:
+        return {
+            'warm_models': self.warm_models, 'budget_bytes': self.budget_bytes,
+            'resident': {url: sorted(models) for url, models in self.resident.items()},
+            'loads': self.loads, 'load_seconds': round(self.load_seconds, 3), 'evictions': self.evictions,
+        }
+
+_warm_pool = _WarmPool(_backends, WARM_MODELS, WARM_POOL_MEMORY_BUDGET_MB * 1024 * 1024)
+
+async def _warm_up():
+    await _catalog.recheck()
+    await _warm_pool.preload()
+    await _warm_pool.poll_loop()
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    global _http_client
+    _http_client = _build_http_client()
+    if _coordinator is not None:
+        # Probing, preloading and catalog refreshes run once, in the coordinator; workers copy its catalog
+        await _coordinator.connect()
+        try:
+            await _catalog.recheck()
+        except ConnectionError as e:
+            logger.warning('could not load the model catalog from the coordinator: %s', e)
+        tasks = []
+    else:
+        tasks = [asyncio.create_task(_warm_up()), asyncio.create_task(_backends.probe_loop())]
+    capture_task = asyncio.create_task(_capture.flush_loop()) if _capture.path else None
+    try:
+        yield
+    finally:
+        for task in tasks: task.cancel()
+        if _coordinator is not None: await _coordinator.close()
+        if capture_task is not None:
+            capture_task.cancel()
+            await _capture.flush()
+        await _http_client.aclose()
+        _http_client = None
+
+app = FastAPI(title='Claude Code Ollama Adapter', version=VERSION, lifespan=_lifespan)
+
+def _should_think(model: str, request_think: Optional[bool]) -> bool:
+    # THINK_MODELS turns thinking on by default; the registry vetoes it and unlocks explicit requests
+    supports = _think_registry.supports(model)
+    if request_think is False or supports is False:
         return False
-    return True
+    return model in THINK_MODELS or (request_think is True and supports is True)
+
+def _anthropic_think(thinking: Any) -> Optional[bool]:
+    if isinstance(thinking, dict):
+        if thinking.get('type') == 'enabled': return True
+        if thinking.get('type') == 'disabled': return False
+    return None
 
 def _normalize_messages(messages: list) -> list:
     normalized = []
@@ -54,6 +1278,10 @@ def _openai_to_ollama(body: dict) -> dict:
 
     if _should_think(model, body.get('think')):
         ollama_body['think'] = True
+
+    keep_alive = _warm_pool.keep_alive(model)
+    if keep_alive is not None:
+        ollama_body['keep_alive'] = keep_alive
     
     if 'tools' in body:
         ollama_body['tools'] = body['tools']
@@ -67,6 +1295,218 @@ def _openai_to_ollama(body: dict) -> dict:
     return ollama_body
 
 
+# Context budget: token counts are estimated from characters, the context length comes from the catalog
+_MESSAGE_OVERHEAD_TOKENS = 4
+
+def _estimate_tokens(text: str) -> int:
+    return int(len(text) / CONTEXT_CHARS_PER_TOKEN) + 1
+
+def _message_tokens(m: dict) -> int:
+    tokens = _MESSAGE_OVERHEAD_TOKENS + _estimate_tokens(str(m.get('content') or ''))
+    if m.get('tool_calls'): tokens += _estimate_tokens(json.dumps(m['tool_calls']))
+    return tokens
+
+def _tools_tokens(ollama_body: dict) -> int:
+    return _estimate_tokens(json.dumps(ollama_body['tools'])) if ollama_body.get('tools') else 0
+
+def _compact_tool_result(content: str, policy: str) -> str:
+    if policy == 'elide':
+        return f'[tool result elided: {len(content)} characters]'
+    keep = int(CONTEXT_TOOL_RESULT_MAX_TOKENS * CONTEXT_CHARS_PER_TOKEN)
+    head, tail = keep * 2 // 3, keep // 3
+    return f'{content[:head]}\n[... {len(content) - head - tail} characters trimmed ...]\n{content[len(content) - tail:]}'
+
+def _fit_context(ollama_body: dict) -> dict:
+    '''Compacts old oversized tool results while the estimated prompt exceeds the model's context and
+    sets options.num_ctx to the smallest configured bucket that holds the prompt plus the reply.
+
+    Translated messages may be shared with the translation cache, so compacted ones are copies.
+    '''
+    if CONTEXT_COMPACTION == 'off' and not NUM_CTX_BUCKETS:
+        return ollama_body
+    messages = ollama_body['messages']
+    sizes = [_message_tokens(m) for m in messages]
+    prompt = sum(sizes) + _tools_tokens(ollama_body)
+    options = ollama_body.get('options') or {}
+    meta = _catalog.lookup(ollama_body['model'])
+    context_length = (meta or {}).get('context_length')
+    num_predict = options.get('num_predict')
+    reserve = num_predict if isinstance(num_predict, int) and num_predict > 0 else CONTEXT_OUTPUT_RESERVE
+    if context_length: reserve = min(reserve, context_length // 2)
+
+    if CONTEXT_COMPACTION in ('trim', 'elide') and context_length and prompt + reserve > context_length:
+        before, budget = prompt, context_length - reserve
+        compacted = list(messages)
+        count = 0
+        for i in range(len(compacted) - CONTEXT_KEEP_RECENT):
+            if prompt <= budget:
+                break
+            m = compacted[i]
+            if m.get('role') != 'tool' or sizes[i] <= CONTEXT_TOOL_RESULT_MAX_TOKENS + _MESSAGE_OVERHEAD_TOKENS:
+                continue
+            compacted[i] = {**m, 'content': _compact_tool_result(str(m.get('content') or ''), CONTEXT_COMPACTION)}
+            prompt -= sizes[i] - _message_tokens(compacted[i])
+            count += 1
+        if count:
+            ollama_body['messages'] = compacted
+            logger.info('Compacted %d tool results for %s: ~%d -> ~%d prompt tokens (context %d)',
+                        count, ollama_body['model'], before, prompt, context_length)
+
+    if NUM_CTX_BUCKETS and 'num_ctx' not in options:
+        needed = prompt + reserve
+        fits = [b for b in NUM_CTX_BUCKETS if b >= needed and (not context_length or b <= context_length)]
+        num_ctx = fits[0] if fits else context_length or NUM_CTX_BUCKETS[-1]
+        ollama_body['options'] = {**options, 'num_ctx': num_ctx}
+    return ollama_body
+
+# Token counting: word/punctuation pieces per message, memoized, scaled by a per-model ratio learned from prompt_eval_count
+_TOKEN_PIECES = re.compile(r'\w+|[^\w\s]')
+
+class _TokenCounter:
+    '''Local prompt token estimates for /v1/messages/count_tokens.
+
+    Piece counts are memoized per message in a bounded LRU, so a long history is scanned once
+    and later turns only cost their new messages. Ollama's prompt_eval_count leaves out tokens
+    reused from its prompt cache, so observations well below the current ratio are skipped.
+    '''
+
+    _DEFAULT_RATIO = 1.1
+    _ALPHA = 0.2
+    _CACHED_BELOW = 0.7
+    _MIN_PIECES = 16
+
+    def __init__(self, max_entries: int = 65536):
+        self.max_entries = max_entries
+        self._memo: collections.OrderedDict = collections.OrderedDict()
+        self.ratios: Dict[str, float] = {}
+        self.samples: Dict[str, int] = {}
+        self.skipped = 0
+
+    def _text_pieces(self, role: Optional[str], text: str) -> int:
+        key = (role, len(text), hash(text))
+        pieces = self._memo.get(key)
+        if pieces is not None:
+            self._memo.move_to_end(key)
+            return pieces
+        pieces = self._memo[key] = len(_TOKEN_PIECES.findall(text))
+        if len(self._memo) > self.max_entries: self._memo.popitem(last=False)
+        return pieces
+
+    def pieces(self, ollama_body: dict) -> int:
+        total = 0
+        for m in ollama_body.get('messages', ()):
+            total += _MESSAGE_OVERHEAD_TOKENS + self._text_pieces(m.get('role'), str(m.get('content') or ''))
+            if m.get('tool_calls'): total += self._text_pieces('tool_calls', json.dumps(m['tool_calls']))
+        if ollama_body.get('tools'): total += self._text_pieces('tools', json.dumps(ollama_body['tools']))
+        return total
+
+    def count(self, ollama_body: dict) -> int:
+        ratio = self.ratios.get(_model_key(ollama_body.get('model', '')), self._DEFAULT_RATIO)
+        return round(self.pieces(ollama_body) * ratio)
+
+    def observe(self, ollama_body: dict, done: dict):
+        '''Calibrates the model's ratio from the prompt_eval_count Ollama reported for ollama_body.'''
+        observed = done.get('prompt_eval_count')
+        if not observed:
+            return
+        pieces = self.pieces(ollama_body)
+        if pieces < self._MIN_PIECES:
+            return
+        model = _model_key(ollama_body.get('model', ''))
+        ratio = observed / pieces
+        current = self.ratios.get(model)
+        if current is not None and ratio < current * self._CACHED_BELOW:
+            self.skipped += 1
+            return
+        self.ratios[model] = ratio if current is None else current + self._ALPHA * (ratio - current)
+        self.samples[model] = self.samples.get(model, 0) + 1
+
+    def stats(self) -> dict:
+        return {
+            'ratios': {m: round(r, 4) for m, r in sorted(self.ratios.items())},
+            'samples': dict(sorted(self.samples.items())), 'skipped': self.skipped, 'memoized': len(self._memo),
+        }
+
+_token_counter = _TokenCounter()
+
+class _ModelRouter:
+    '''Aliases requested model names to local models and downgrades lightweight requests.
+
+    A request is downgraded when it carries no tools (unless allowed) and meets every configured
+    threshold: num_predict at most max_tokens and an estimated prompt of at most max_prompt_tokens.
+    '''
+
+    def __init__(self, aliases: Dict[str, str], downgrade: str, max_tokens: int, max_prompt_tokens: int, with_tools: bool):
+        self.exact = {k: v for k, v in aliases.items() if not any(c in k for c in '*?[')}
+        self.patterns = [(k, v) for k, v in aliases.items() if k not in self.exact]
+        self.downgrade_model = downgrade if max_tokens > 0 or max_prompt_tokens > 0 else ''
+        self.max_tokens = max_tokens
+        self.max_prompt_tokens = max_prompt_tokens
+        self.with_tools = with_tools
+        self.enabled = bool(aliases or self.downgrade_model)
+
+    def match(self, model: str) -> tuple:
+        '''(configured alias key or pattern, target), or ('', model) when no alias applies.'''
+        target = self.exact.get(model)
+        if target is not None:
+            return model, target
+        for pattern, target in self.patterns:
+            if fnmatch.fnmatchcase(model, pattern):
+                return pattern, target
+        return '', model
+
+    def alias(self, model: str) -> str:
+        return self.match(model)[1]
+
+    def downgrade(self, ollama_body: dict) -> Optional[str]:
+        if not self.downgrade_model or ollama_body.get('model') == self.downgrade_model:
+            return None
+        if ollama_body.get('tools') and not self.with_tools:
+            return None
+        if self.max_tokens > 0:
+            num_predict = (ollama_body.get('options') or {}).get('num_predict')
+            if not isinstance(num_predict, int) or not 0 < num_predict <= self.max_tokens:
+                return None
+        if self.max_prompt_tokens > 0:
+            prompt = sum(_message_tokens(m) for m in ollama_body['messages']) + _tools_tokens(ollama_body)
+            if prompt > self.max_prompt_tokens:
+                return None
+        return self.downgrade_model
+
+    def route(self, body: dict, translate) -> tuple:
+        '''Translates body for the model the table picks; returns (ollama_body, decision or None).
+
+        The decision is (alias key or pattern, model, route). It never holds the free-form requested
+        name, so metric labels stay bounded. Pass it to accept() once the model is known to exist.
+        '''
+        if not self.enabled:
+            return translate(body), None
+        requested = body.get('model', '')
+        matched, model = self.match(requested)
+        route = 'alias' if model != requested else 'passthrough'
+        ollama_body = translate({**body, 'model': model} if route == 'alias' else body)
+        small = self.downgrade(ollama_body)
+        if small:
+            model, route = small, 'downgrade'
+            ollama_body = translate({**body, 'model': small})
+        return ollama_body, (matched, model, route)
+
+    @staticmethod
+    def header(decision: Optional[tuple]) -> dict:
+        '''The X-Model-Route header for a decision, without counting it.'''
+        if decision is None:
+            return {}
+        return {'X-Model-Route': f'{decision[2]}; model={decision[1]}'}
+
+    @classmethod
+    def accept(cls, decision: Optional[tuple]) -> dict:
+        '''Counts a decision that passed the catalog check and returns its X-Model-Route header.'''
+        if decision is not None: _metrics.routes.inc(decision)
+        return cls.header(decision)
+
+_router = _ModelRouter(MODEL_ALIASES, MODEL_DOWNGRADE, MODEL_DOWNGRADE_MAX_TOKENS,
+                       MODEL_DOWNGRADE_MAX_PROMPT_TOKENS, MODEL_DOWNGRADE_WITH_TOOLS)
+
 def _is_unsupported_thinking_response(resp: httpx.Response) -> bool:
     if resp.status_code < 400:
         return False
@@ -77,13 +1517,607 @@ async def _post_with_think_fallback(
     client: httpx.AsyncClient,
     url: str,
     ollama_body: dict,
+    timeout: Any = httpx.USE_CLIENT_DEFAULT,
 ) -> httpx.Response:
-    resp = await client.post(url, json=ollama_body)
+    resp = await client.post(url, content=_encode_chat(ollama_body), headers=_JSON_HEADERS, timeout=timeout)
     if ollama_body.get('think') and _is_unsupported_thinking_response(resp):
+        _think_registry.record(ollama_body.get('model', ''), False, 'upstream error')
         retry_body = {k: v for k, v in ollama_body.items() if k != 'think'}
-        return await client.post(url, json=retry_body)
+        return await client.post(url, content=_encode_chat(retry_body), headers=_JSON_HEADERS, timeout=timeout)
     return resp
 
+async def _open_stream(ollama_body: dict, cache_key: Optional[str], timeout: Any = httpx.USE_CLIENT_DEFAULT) -> tuple:
+    '''Admits one streaming /api/chat call; returns (chunks, release), raising _Overloaded.'''
+    model = ollama_body.get('model', '')
+    lease = await _admission.admit(model)
+    _warm_pool.touch(model)
+    chunks = _ollama_stream(ollama_body, lease, timeout)
+    if cache_key: chunks = _response_cache.record(cache_key, chunks)
+    return chunks, lease.release
+
+async def _post_chat(ollama_body: dict, timeout: Any = httpx.USE_CLIENT_DEFAULT) -> tuple:
+    '''Admits and sends one non-streaming /api/chat call; returns (response, parsed body or None).'''
+    model = ollama_body.get('model', '')
+    lease = await _admission.admit(model)
+    _warm_pool.touch(model)
+    async with lease as backend:
+        resp = await _post_with_think_fallback(_client(), backend.url + '/api/chat', ollama_body, timeout)
+        _backends.observe(backend, resp.status_code)
+    if resp.status_code != 200:
+        return resp, None
+    ollama_data = resp.json()
+    _warm_pool.observe(model, backend, ollama_data)
+    _token_counter.observe(ollama_body, ollama_data)
+    return resp, ollama_data
+
+def _request_timeout(headers) -> tuple:
+    '''(seconds, is_deadline) from the first valid client timeout header, capped at REQUEST_TIMEOUT_MAX.
+
+    Seconds is None without a header. Headers in _READ_TIMEOUT_HEADERS are not deadlines.
+    '''
+    for name in REQUEST_TIMEOUT_HEADERS:
+        try:
+            seconds = float(headers.get(name) or 0)
+        except ValueError:
+            continue
+        if seconds > 0 and math.isfinite(seconds):
+            seconds = min(seconds, REQUEST_TIMEOUT_MAX) if REQUEST_TIMEOUT_MAX > 0 else seconds
+            return seconds, name not in _READ_TIMEOUT_HEADERS
+    return None, False
+
+class _Cancelled(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+class _ClientGuard:
+    '''Stops a request's upstream work as soon as its client disconnects or its deadline passes.
+
+    A client timeout header replaces the global read timeout for this request; an explicit
+    one such as X-Request-Timeout is also a deadline for the whole response. Streams are read by a pump task, so the upstream connection is closed (and
+    Ollama stops generating) even while no chunk is pending delivery.
+    '''
+
+    def __init__(self, request: Request, labels: tuple, ollama_body: dict, started: float):
+        self.request = request
+        self.labels = labels
+        num_predict = (ollama_body.get('options') or {}).get('num_predict')
+        self.num_predict = num_predict if isinstance(num_predict, int) and num_predict > 0 else 0
+        seconds, is_deadline = _request_timeout(request.headers)
+        self.deadline = started + seconds if is_deadline else None
+        self.timeout = httpx.Timeout(OLLAMA_CONNECT_TIMEOUT, read=seconds, write=seconds, pool=OLLAMA_POOL_TIMEOUT) \
+            if seconds else httpx.USE_CLIENT_DEFAULT
+        self.reason: Optional[str] = None
+        self.tokens = 0
+        self._work: Optional[asyncio.Future] = None
+        self._watcher: Optional[asyncio.Task] = None
+
+    async def _watch(self):
+        async def disconnected():
+            while (await self.request.receive())['type'] != 'http.disconnect':
+                pass
+        timeout = max(0.0, self.deadline - time.monotonic()) if self.deadline else None
+        try:
+            await asyncio.wait_for(disconnected(), timeout)
+            self.reason = 'disconnect'
+        except asyncio.TimeoutError:
+            self.reason = 'deadline'
+        if self._work is not None: self._work.cancel()
+
+    def _start(self, work: asyncio.Future):
+        self._work = work
+        if self._watcher is None: self._watcher = asyncio.create_task(self._watch())
+
+    def close(self):
+        self._work = None
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+    def _record(self, reason: str):
+        saved = max(0, self.num_predict - self.tokens)
+        _metrics.cancelled.inc(self.labels + (reason,))
+        if saved: _metrics.tokens_saved.inc(self.labels, saved)
+        logger.info('Cancelled %s generation on %s after %d tokens (%s)', self.labels[0], self.labels[1], self.tokens, reason)
+
+    async def call(self, work):
+        '''Awaits work, raising _Cancelled if the client disconnects or the deadline passes first.'''
+        task = asyncio.ensure_future(work)
+        self._start(task)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if self.reason is None or not task.cancelled():
+                raise
+            self._record(self.reason)
+            raise _Cancelled(self.reason)
+        finally:
+            self.close()
+
+    async def stream(self, chunks: AsyncIterator[dict]) -> AsyncIterator[dict]:
+        '''Relays chunks; a disconnect ends the stream and a deadline raises httpx.ReadTimeout.'''
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def pump():
+            end = None
+            try:
+                async for chunk in chunks:
+                    queue.put_nowait(chunk)
+            except Exception as e:
+                end = e
+            finally:
+                queue.put_nowait(end)
+
+        self._start(asyncio.create_task(pump()))
+        finished = False
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    finished = self.reason is None
+                    break
+                if isinstance(item, Exception):
+                    finished = True
+                    raise item
+                if item.get('done'):
+                    finished = True
+                else:
+                    msg = item.get('message')
+                    if msg and (msg.get('content') or msg.get('thinking')): self.tokens += 1
+                yield item
+        finally:
+            work = self._work
+            self.close()
+            if work is not None and not work.done(): work.cancel()
+            if not finished: self._record(self.reason or 'disconnect')
+        if self.reason == 'deadline':
+            raise httpx.ReadTimeout('Request deadline exceeded')
+
+class _UpstreamError(Exception):
+    def __init__(self, status_code: int, text: str):
+        super().__init__(text)
+        self.status_code = status_code
+        self.text = text
+
+
+# Upstream NDJSON: lines are split on the raw byte buffer; without orjson, plain content/thinking deltas skip the JSON parser
+_json_loads = orjson.loads if orjson is not None else json.loads
+_NDJSON_CONTENT = b'"message":{"role":"assistant","content":"'
+_NDJSON_THINKING = b'","thinking":"'
+_NDJSON_TAIL = b'"},"done":false}'
+
+def _ndjson_text(raw: bytes) -> Optional[str]:
+    '''Decodes the body of a JSON string literal, or None if raw is not exactly one string.'''
+    text = raw.decode()
+    if '\\' not in text:
+        return None if '"' in text else text
+    try:
+        value, end = json.decoder.scanstring(text + '"', 0)
+    except ValueError:
+        return None
+    return value if end == len(text) + 1 else None
+
+class _NDJSONParser:
+    '''Incremental parser for Ollama's streamed /api/chat body.
+
+    Intermediate chunks that carry only message.content or message.thinking are recognised by
+    their fixed framing and decoded without building the full tree, so they hold just
+    ``message`` and ``done``. Everything else (done, tool_calls, unknown shapes) is fully parsed.
+    orjson parses whole lines faster than the fast path, so it is off when orjson is installed.
+    '''
+
+    def __init__(self, fast_path: bool = orjson is None):
+        self.fast_path = fast_path
+        self._buf = b''
+
+    def feed(self, data: bytes) -> List[dict]:
+        buf = self._buf + data if self._buf else data
+        chunks = []
+        pos = 0
+        find = buf.find
+        while True:
+            end = find(b'\n', pos)
+            if end < 0: break
+            chunk = self._parse(buf, pos, end)
+            if chunk is not None: chunks.append(chunk)
+            pos = end + 1
+        self._buf = buf[pos:]
+        return chunks
+
+    def close(self) -> List[dict]:
+        buf, self._buf = self._buf, b''
+        chunk = self._parse(buf, 0, len(buf))
+        return [chunk] if chunk is not None else []
+
+    def _parse(self, buf: bytes, pos: int, end: int) -> Optional[dict]:
+        if self.fast_path and buf.endswith(_NDJSON_TAIL, pos, end):
+            start = buf.find(_NDJSON_CONTENT, pos, end)
+            if start >= 0:
+                raw = buf[start + len(_NDJSON_CONTENT):end - len(_NDJSON_TAIL)]
+                if raw.startswith(_NDJSON_THINKING):
+                    text = _ndjson_text(raw[len(_NDJSON_THINKING):])
+                    if text is not None:
+                        return {'message': {'role': 'assistant', 'content': '', 'thinking': text}, 'done': False}
+                else:
+                    text = _ndjson_text(raw)
+                    if text is not None:
+                        return {'message': {'role': 'assistant', 'content': text}, 'done': False}
+        line = buf[pos:end]
+        if not line.strip():
+            return None
+        return _json_loads(line)
+
+def _observe_done(ollama_body: dict, backend: _Backend, chunk: dict):
+    _warm_pool.observe(ollama_body.get('model', ''), backend, chunk)
+    _token_counter.observe(ollama_body, chunk)
+
+async def _ollama_stream(ollama_body: dict, lease: _Lease, timeout: Any = httpx.USE_CLIENT_DEFAULT) -> AsyncIterator[dict]:
+    async with lease as backend:
+        for attempt in range(2):
+            content = _encode_chat(ollama_body)
+            async with _client().stream('POST', backend.url + '/api/chat', content=content, headers=_JSON_HEADERS, timeout=timeout) as resp:
+                lease.pool.observe(backend, resp.status_code)
+                if resp.status_code != 200:
+                    text = (await resp.aread()).decode()
+                    if attempt == 0 and ollama_body.get('think') and 'does not support thinking' in text.lower():
+                        _think_registry.record(ollama_body.get('model', ''), False, 'upstream error')
+                        ollama_body = {k: v for k, v in ollama_body.items() if k != 'think'}
+                        continue
+                    raise _UpstreamError(resp.status_code, text)
+                parser = _NDJSONParser()
+                async for data in resp.aiter_bytes():
+                    for chunk in parser.feed(data):
+                        if chunk.get('done'): _observe_done(ollama_body, backend, chunk)
+                        yield chunk
+                for chunk in parser.close():
+                    if chunk.get('done'): _observe_done(ollama_body, backend, chunk)
+                    yield chunk
+                return
+
+# Request codec: bodies are decoded from raw bytes and upstream bodies encoded straight to bytes, matching
+# httpx's json= (compact separators, UTF-8, no NaN; orjson only spells float exponents shorter, 1e-7 for 1e-07)
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+def _json_body_std(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), allow_nan=False).encode()
+
+def _json_body_orjson(obj: Any) -> bytes:
+    try:
+        return orjson.dumps(obj)
+    except TypeError:  # integers beyond 64 bits, non-string keys
+        return _json_body_std(obj)
+
+_json_body = _json_body_orjson if orjson is not None else _json_body_std
+
+async def _read_json(request: Request) -> Any:
+    return _json_loads(await request.body())
+
+def _encode_chat(ollama_body: dict) -> bytes:
+    '''Encodes an /api/chat body, reusing the wire bytes of messages held by the translation cache.'''
+    # One join over all fragments: the body is copied once, not once per nesting level
+    parts = []
+    for key, value in ollama_body.items():
+        parts.append(b',' + _json_body(key) + b':' if parts else b'{' + _json_body(key) + b':')
+        if key == 'messages':
+            parts.append(b'[')
+            for i, m in enumerate(value):
+                if i: parts.append(b',')
+                parts.append(_translation_cache.wire(m))
+            parts.append(b']')
+        else:
+            parts.append(_json_body(value))
+    parts.append(b'}' if parts else b'{}')
+    return b''.join(parts)
+
+# SSE encoding: frames are bytes; per-stream constant parts are rendered once and only delta text is escaped
+def _json_bytes_std(obj: Any) -> bytes:
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+def _json_str_std(text: str) -> bytes:
+    return encode_basestring_ascii(text).encode()
+
+_json_bytes = orjson.dumps if orjson is not None else _json_bytes_std
+_json_str = orjson.dumps if orjson is not None else _json_str_std
+
+_SSE_END = b'\n\n'
+
+def _sse(event: str, payload: Any) -> bytes:
+    return b'event: ' + event.encode() + b'\ndata: ' + _json_bytes(payload) + _SSE_END
+
+class _AnthropicEncoder:
+    _MESSAGE_STOP = b'event: message_stop\ndata: {"type":"message_stop"}' + _SSE_END
+
+    def __init__(self, mid: str, model: str):
+        self.mid = mid
+        self.model = model
+        self._delta_prefix: Dict[tuple, bytes] = {}
+
+    def message_start(self) -> bytes:
+        return _sse('message_start', {'type': 'message_start', 'message': {
+            'id': self.mid, 'type': 'message', 'role': 'assistant', 'content': [], 'model': self.model,
+            'stop_reason': None, 'stop_sequence': None, 'usage': {'input_tokens': 0, 'output_tokens': 0},
+        }})
+
+    def block_start(self, index: int, block: dict) -> bytes:
+        return _sse('content_block_start', {'type': 'content_block_start', 'index': index, 'content_block': block})
+
+    def block_stop(self, index: int) -> bytes:
+        return b'event: content_block_stop\ndata: {"type":"content_block_stop","index":%d}' % index + _SSE_END
+
+    def delta(self, index: int, kind: str, text: str) -> bytes:
+        # kind is 'text' or 'thinking'
+        prefix = self._delta_prefix.get((index, kind))
+        if prefix is None:
+            prefix = self._delta_prefix[(index, kind)] = (
+                b'event: content_block_delta\ndata: {"type":"content_block_delta","index":%d,'
+                b'"delta":{"type":"%s_delta","%s":' % (index, kind.encode(), kind.encode())
+            )
+        return prefix + _json_str(text) + b'}}' + _SSE_END
+
+    def input_json_delta(self, index: int, partial_json: str) -> bytes:
+        return (b'event: content_block_delta\ndata: {"type":"content_block_delta","index":%d,'
+                b'"delta":{"type":"input_json_delta","partial_json":' % index) + _json_str(partial_json) + b'}}' + _SSE_END
+
+    def message_delta(self, stop_reason: str, output_tokens: int) -> bytes:
+        return _sse('message_delta', {
+            'type': 'message_delta', 'delta': {'stop_reason': stop_reason, 'stop_sequence': None},
+            'usage': {'output_tokens': output_tokens},
+        })
+
+    def message_stop(self) -> bytes:
+        return self._MESSAGE_STOP
+
+    def error(self, message: str) -> bytes:
+        return b'data: ' + _json_bytes({'type': 'error', 'error': {'type': 'upstream_error', 'message': message}}) + _SSE_END
+
+class _OpenAIEncoder:
+    DONE = b'data: [DONE]' + _SSE_END
+
+    def __init__(self, cid: str, model: str, created: int):
+        self._head = {'id': cid, 'object': 'chat.completion.chunk', 'created': created, 'model': model}
+        prefix = b'data: ' + _json_bytes(self._head)[:-1] + b',"choices":[{"index":0,"delta":{'
+        self._content_prefix = prefix + b'"content":'
+        self._reasoning_prefix = prefix + b'"reasoning_content":'
+        self._suffix = b'},"finish_reason":null}]}' + _SSE_END
+
+    def content(self, text: str) -> bytes:
+        return self._content_prefix + _json_str(text) + self._suffix
+
+    def reasoning(self, text: str) -> bytes:
+        return self._reasoning_prefix + _json_str(text) + self._suffix
+
+    def tool_call(self, index: int, call_id: str, name: str, arguments: str) -> bytes:
+        return self.chunk({'tool_calls': [{
+            'index': index, 'id': call_id, 'type': 'function', 'function': {'name': name, 'arguments': arguments},
+        }]})
+
+    def chunk(self, delta: dict, finish_reason: Optional[str] = None, usage: Optional[dict] = None) -> bytes:
+        payload = {**self._head, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+        if usage is not None: payload['usage'] = usage
+        return b'data: ' + _json_bytes(payload) + _SSE_END
+
+    def error(self, message: str) -> bytes:
+        return b'data: ' + _json_bytes({'error': {'message': message, 'type': 'upstream_error', 'param': None, 'code': None}}) + _SSE_END
+
+def _delta_kind(chunk: dict) -> Optional[str]:
+    '''Returns 'content' or 'thinking' for chunks carrying only that delta, else None.'''
+    if chunk.get('done'):
+        return None
+    msg = chunk.get('message', {})
+    if msg.get('tool_calls'):
+        return None
+    content, thinking = msg.get('content'), msg.get('thinking')
+    if content and not thinking:
+        return 'content'
+    if thinking and not content:
+        return 'thinking'
+    return None
+
+async def _coalesce(chunks: AsyncIterator[dict], max_bytes: int, interval: float) -> AsyncIterator[dict]:
+    '''Merges consecutive same-kind delta chunks; the first delta is always passed through at once.'''
+    loop = asyncio.get_running_loop()
+    it = chunks.__aiter__()
+    pending: Optional[asyncio.Future] = None
+    kind, parts, size, started, template = None, [], 0, 0.0, None
+    first = True
+
+    def merged() -> dict:
+        msg = {**template.get('message', {}), kind: ''.join(parts)}
+        return {**template, 'message': msg}
+
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(it.__anext__())
+            if parts:
+                done, _ = await asyncio.wait({pending}, timeout=max(0.0, started + interval - loop.time()))
+                if not done:
+                    yield merged()
+                    kind, parts, size = None, [], 0
+                    continue
+            try:
+                chunk = await pending
+            except StopAsyncIteration:
+                break
+            finally:
+                if pending.done(): pending = None
+
+            chunk_kind = _delta_kind(chunk)
+            if chunk_kind is None:
+                msg = chunk.get('message', {})
+                if not (chunk.get('done') or msg.get('tool_calls') or msg.get('content') or msg.get('thinking')):
+                    continue
+                if parts:
+                    yield merged()
+                    kind, parts, size = None, [], 0
+                first = False
+                yield chunk
+                continue
+            if first:
+                first = False
+                yield chunk
+                continue
+            if parts and chunk_kind != kind:
+                yield merged()
+                kind, parts, size = None, [], 0
+            if not parts:
+                kind, template, started = chunk_kind, chunk, loop.time()
+            text = chunk['message'][chunk_kind]
+            parts.append(text)
+            size += len(text.encode())
+            if size >= max_bytes:
+                yield merged()
+                kind, parts, size = None, [], 0
+        if parts:
+            yield merged()
+    finally:
+        if pending is not None:
+            # __anext__ must finish unwinding before the upstream generator can be closed
+            pending.cancel()
+            try:
+                await pending
+            except (asyncio.CancelledError, StopAsyncIteration):
+                pass
+        if hasattr(it, 'aclose'):
+            await it.aclose()
+
+def _anthropic_error(status_code: int, error_type: str, message: str, headers: Optional[dict] = None) -> JSONResponse:
+    return JSONResponse(
+        {'type': 'error', 'error': {'type': error_type, 'message': message}},
+        status_code=status_code, headers=headers,
+    )
+
+def _openai_error(status_code: int, error_type: str, code: str, message: str, param: Optional[str] = None,
+                  headers: Optional[dict] = None) -> JSONResponse:
+    return JSONResponse(
+        {'error': {'message': message, 'type': error_type, 'param': param, 'code': code}},
+        status_code=status_code, headers=headers,
+    )
+
+def _anthropic_cancelled(e: _Cancelled) -> Response:
+    # Nobody reads the response to a disconnected client; 499 only shows up in access logs
+    if e.reason == 'disconnect': return Response(status_code=499)
+    return _anthropic_error(504, 'timeout_error', 'Request deadline exceeded')
+
+def _openai_cancelled(e: _Cancelled) -> Response:
+    if e.reason == 'disconnect': return Response(status_code=499)
+    return _openai_error(504, 'timeout_error', 'timeout', 'Request deadline exceeded')
+
+def _anthropic_overloaded(e: _Overloaded) -> JSONResponse:
+    return _anthropic_error(429, 'rate_limit_error', f'Adapter queue is full ({e})', {'Retry-After': str(e.retry_after)})
+
+def _openai_overloaded(e: _Overloaded) -> JSONResponse:
+    return _openai_error(
+        429, 'rate_limit_error', 'rate_limit_exceeded', f'Adapter queue is full ({e})',
+        headers={'Retry-After': str(e.retry_after)},
+    )
+
+def _freeze(value):
+    '''Hashable, type-tagged copy of a JSON value: equal only if the values are, so -1/-2, True/1 and 1.0/1 stay apart.'''
+    kind = type(value)
+    if kind is str:
+        return value
+    if kind is dict:
+        return ('d',) + tuple((k, _freeze(v)) for k, v in value.items())
+    if kind is list:
+        return ('l',) + tuple(_freeze(v) for v in value)
+    return (kind, value)
+
+def _anthropic_message_key(m: dict) -> tuple:
+    '''Exactly the fields _anthropic_message_to_ollama reads; a dict hit compares them, not just their hash.'''
+    parts = [m.get('role')]
+    for b in m['content']:
+        kind = b.get('type')
+        if kind == 'text':
+            parts.append(('t', b.get('text', '')))
+        elif kind == 'tool_result':
+            parts.append(('r', _freeze(b.get('tool_use_id')), _freeze(b.get('content', ''))))
+        else:
+            parts.append(kind)
+    return tuple(parts)
+
+def _anthropic_message_to_ollama(m: dict) -> list:
+    messages, parts = [], []
+    for b in m['content']:
+        if b.get('type') == 'text':
+            parts.append(b.get('text', ''))
+        elif b.get('type') == 'tool_result':
+            messages.append({
+                'role': 'tool',
+                'content': str(b.get('content', '')),
+                'tool_call_id': b.get('tool_use_id')
+            })
+    if parts:
+        messages.append({'role': m.get('role'), 'content': ' '.join(parts)})
+    return messages
+
+class _Translated:
+    __slots__ = ('messages', 'size', 'wire')
+
+    def __init__(self, messages: list, size: int):
+        self.messages = messages
+        self.size = size
+        self.wire: Optional[list] = None
+
+class _TranslationCache:
+    '''LRU of translated Ollama messages keyed by the source message's content hash, bounded by bytes.
+
+    Long sessions resend their whole history every turn; only the new tail is converted and the
+    rest reuses the Ollama message objects built on earlier turns, which callers must not mutate.
+    Their encoded JSON is kept alongside, so the upstream body is mostly joined, not re-serialized.
+    '''
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+        self._owners: Dict[int, _Translated] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def translate(self, m: dict) -> list:
+        if self.max_bytes <= 0:
+            return _anthropic_message_to_ollama(m)
+        key = _anthropic_message_key(m)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.messages
+        self.misses += 1
+        messages = _anthropic_message_to_ollama(m)
+        size = sum(len(msg['content']) + 128 for msg in messages) + 64
+        # The key keeps its source strings alive; count those the translation does not share
+        shared = {id(p[-1]) for p in key[1:] if type(p) is tuple and type(p[-1]) is str}
+        size += sum(len(msg['content']) for msg in messages if id(msg['content']) not in shared)
+        if size <= self.max_bytes:
+            entry = self._entries[key] = _Translated(messages, size)
+            for msg in messages: self._owners[id(msg)] = entry
+            self.size += size
+            self._evict()
+        return messages
+
+    def wire(self, msg: dict) -> bytes:
+        '''JSON bytes of an Ollama message, memoized while msg is one of this cache's own objects.'''
+        entry = self._owners.get(id(msg))
+        if entry is None:
+            return _json_body(msg)
+        if entry.wire is None:
+            entry.wire = [_json_body(m) for m in entry.messages]
+            grown = sum(len(b) for b in entry.wire)
+            entry.size += grown
+            self.size += grown
+            self._evict()  # may drop this entry; its bytes are still returned below
+        return next(b for m, b in zip(entry.messages, entry.wire) if m is msg)
+
+    def _evict(self):
+        while self.size > self.max_bytes:
+            entry = self._entries.popitem(last=False)[1]
+            self.size -= entry.size
+            for msg in entry.messages: self._owners.pop(id(msg), None)
+
+_translation_cache = _TranslationCache(TRANSLATION_CACHE_MAX_BYTES)
+
 def _anthropic_to_ollama(body: dict) -> dict:
     model = body.get('model', '')
     messages = []
@@ -96,25 +2130,19 @@ def _anthropic_to_ollama(body: dict) -> dict:
         messages.append({'role': 'system', 'content': system})
 
     for m in body.get('messages', []):
-        content = m.get('content')
-        role = m.get('role')
-        if isinstance(content, list):
-            parts = []
-            for b in content:
-                if b.get('type') == 'text':
-                    parts.append(b.get('text', ''))
-                elif b.get('type') == 'tool_result':
-                    messages.append({
-                        'role': 'tool',
-                        'content': str(b.get('content', '')),
-                        'tool_call_id': b.get('tool_use_id')
-                    })
-            if parts:
-                messages.append({'role': role, 'content': ' '.join(parts)})
+        if isinstance(m.get('content'), list):
+            messages.extend(_translation_cache.translate(m))
         else:
             messages.append(m)
 
     ollama_body = {'model': model, 'messages': messages, 'stream': body.get('stream', False)}
+
+    if _should_think(model, _anthropic_think(body.get('thinking'))):
+        ollama_body['think'] = True
+
+    keep_alive = _warm_pool.keep_alive(model)
+    if keep_alive is not None:
+        ollama_body['keep_alive'] = keep_alive
     
     if 'tools' in body:
         ollama_tools = []
@@ -129,142 +2157,245 @@ def _anthropic_to_ollama(body: dict) -> dict:
             })
         ollama_body['tools'] = ollama_tools
 
+    options = {}
     if 'max_tokens' in body:
-        ollama_body['options'] = {'num_predict': body['max_tokens']}
+        options['num_predict'] = body['max_tokens']
+    for key in ('temperature', 'top_p', 'top_k'):
+        if key in body: options[key] = body[key]
+    if 'stop_sequences' in body:
+        options['stop'] = body['stop_sequences']
+    if options: ollama_body['options'] = options
     
     return ollama_body
 
 @app.post('/v1/messages')
 async def anthropic_messages(request: Request):
-    body = await request.json()
+    started = time.monotonic()
+    body = await _read_json(request)
     model = body.get('model', '')
     stream = body.get('stream', False)
-    ollama_body = _anthropic_to_ollama(body)
-    url = OLLAMA_BASE_URL + '/api/chat'
+    ollama_body, route = _router.route(body, _anthropic_to_ollama)
+    if not await _catalog.knows(ollama_body['model']):
+        return _anthropic_error(404, 'not_found_error', f"model: {ollama_body['model']}")
+    ollama_body = _fit_context(ollama_body)
+    route_headers = _router.accept(route)
+    capture = _capture.start(request.url.path, body, ollama_body)
+
+    cache_key = _response_cache.key(ollama_body)
+    cached = await _response_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        _capture.finish(capture, 'cache_hit', started)
+        headers = {**route_headers, 'X-Cache': 'HIT'}
+        if stream:
+            return StreamingResponse(_stream_anthropic(model, _replay_chunks(cached)), media_type='text/event-stream', headers=headers)
+        return JSONResponse(_ollama_to_anthropic(cached, model), headers=headers)
+    headers = {**route_headers, 'X-Cache': 'MISS'} if cache_key else route_headers or None
+
+    flight_key = _single_flight.key(ollama_body)
+    labels = (ollama_body['model'], request.url.path, 'true' if stream else 'false')
+
+    guard = _ClientGuard(request, labels, ollama_body, started)
 
     if stream:
-        return StreamingResponse(_stream_anthropic(url, ollama_body, model), media_type='text/event-stream')
+        background = None
+        try:
+            if flight_key:
+                chunks = await guard.call(_single_flight.stream(flight_key, lambda: _open_stream(ollama_body, cache_key, guard.timeout)))
+            else:
+                chunks, release = await guard.call(_open_stream(ollama_body, cache_key, guard.timeout))
+                background = BackgroundTask(release)
+        except _Overloaded as e:
+            _capture.finish(capture, 'overloaded', started, status=429)
+            return _anthropic_overloaded(e)
+        except _Cancelled as e:
+            _capture.finish(capture, e.reason, started)
+            return _anthropic_cancelled(e)
+        chunks = guard.stream(chunks)
+        chunks = _metrics.track(labels, started, chunks)
+        if capture: chunks = _capture.track(capture, started, chunks)
+        if SSE_COALESCE_BYTES > 0: chunks = _coalesce(chunks, SSE_COALESCE_BYTES, SSE_COALESCE_INTERVAL)
+        return StreamingResponse(
+            _stream_anthropic(model, chunks), media_type='text/event-stream', headers=headers,
+            background=background,
+        )
 
-    async with httpx.AsyncClient(timeout=120) as client:
-        resp = await client.post(url, json=ollama_body)
-        if resp.status_code != 200:
-            return Response(content=resp.text, status_code=resp.status_code)
-        
-        ollama_data = resp.json()
-        ollama_msg = ollama_data.get('message', {})
-        content_blocks = []
-        
-        if ollama_msg.get('thinking'):
-            content_blocks.append({'type': 'thinking', 'thinking': ollama_msg['thinking']})
-
-        if ollama_msg.get('content'):
-            content_blocks.append({'type': 'text', 'text': ollama_msg['content']})
-        
-        stop_reason = 'end_turn'
-        if ollama_msg.get('tool_calls'):
-            stop_reason = 'tool_use'
-            for tc in ollama_msg['tool_calls']:
+    try:
+        if flight_key:
+            resp, ollama_data = await guard.call(_single_flight.call(flight_key, lambda: _post_chat(ollama_body, guard.timeout)))
+        else:
+            resp, ollama_data = await guard.call(_post_chat(ollama_body, guard.timeout))
+    except _Overloaded as e:
+        _capture.finish(capture, 'overloaded', started, status=429)
+        return _anthropic_overloaded(e)
+    except _Cancelled as e:
+        _capture.finish(capture, e.reason, started)
+        return _anthropic_cancelled(e)
+    _capture.finish(capture, 'ok' if ollama_data is not None else 'upstream_error', started, ollama_data, status=resp.status_code)
+    if resp.status_code != 200:
+        return Response(content=resp.text, status_code=resp.status_code)
+    _metrics.observe(labels, started, None, ollama_data)
+    if cache_key: await _response_cache.put(cache_key, ollama_data)
+    return JSONResponse(_ollama_to_anthropic(ollama_data, model), headers=headers)
+
+@app.post('/v1/messages/count_tokens')
+async def count_tokens(request: Request):
+    body = await _read_json(request)
+    ollama_body, route = _router.route(body, _anthropic_to_ollama)
+    if not await _catalog.knows(ollama_body['model']):
+        return _anthropic_error(404, 'not_found_error', f"model: {ollama_body['model']}")
+    # Token counts never reach a model, so they carry the route header but are not counted as routed requests
+    return JSONResponse({'input_tokens': _token_counter.count(ollama_body)}, headers=_router.header(route) or None)
+
+def _tool_input(args: Any) -> dict:
+    '''Ollama sends tool arguments as an object; some models return a JSON string instead.'''
+    if isinstance(args, str):
+        try: args = json.loads(args)
+        except ValueError: args = None
+    return args if isinstance(args, dict) else {}
+
+def _ollama_to_anthropic(ollama_data: dict, model: str) -> dict:
+    ollama_msg = ollama_data.get('message', {})
+    content_blocks = []
+    
+    if ollama_msg.get('thinking'):
+        content_blocks.append({'type': 'thinking', 'thinking': ollama_msg['thinking']})
+
+    if ollama_msg.get('content'):
+        content_blocks.append({'type': 'text', 'text': ollama_msg['content']})
+    
+    stop_reason = 'end_turn'
+    if ollama_msg.get('tool_calls'):
+        stop_reason = 'tool_use'
+        for tc in ollama_msg['tool_calls']:
+            fn = tc.get('function', {})
+            t_id = tc.get('id') or ('toolu_' + uuid.uuid4().hex[:12])
+            content_blocks.append({
+                'type': 'tool_use', 'id': t_id, 'name': fn.get('name'), 'input': _tool_input(fn.get('arguments'))
+            })
+    
+    return {
+        'id': 'msg_' + uuid.uuid4().hex[:12], 'type': 'message', 'role': 'assistant',
+        'content': content_blocks, 'model': model, 'stop_reason': stop_reason,
+        'usage': {
+            'input_tokens': ollama_data.get('prompt_eval_count', 0),
+            'output_tokens': ollama_data.get('eval_count', 0)
+        }
+    }
+
+async def _stream_anthropic(model: str, chunks: AsyncIterator[dict]):
+    enc = _AnthropicEncoder('msg_' + uuid.uuid4().hex[:12], model)
+    yield enc.message_start()
+    
+    try:
+        # Blocks get contiguous indices in the order they open; tool calls open as soon as Ollama reports them
+        index = -1
+        open_kind = None
+        tool_calls = 0
+
+        async for chunk in chunks:
+            msg = chunk.get('message', {})
+
+            for kind, text in (('thinking', msg.get('thinking')), ('text', msg.get('content'))):
+                if not text:
+                    continue
+                if open_kind != kind:
+                    if open_kind: yield enc.block_stop(index)
+                    index += 1
+                    open_kind = kind
+                    yield enc.block_start(index, {'type': kind, kind: ''})
+                yield enc.delta(index, kind, text)
+
+            for tc in msg.get('tool_calls') or ():
+                if open_kind: yield enc.block_stop(index)
+                open_kind = None
+                index += 1
+                tool_calls += 1
                 fn = tc.get('function', {})
-                args = fn.get('arguments', {})
-                if isinstance(args, str):
-                    try: args = json.loads(args)
-                    except: args = {}
                 t_id = tc.get('id') or ('toolu_' + uuid.uuid4().hex[:12])
-                content_blocks.append({
-                    'type': 'tool_use', 'id': t_id, 'name': fn.get('name'), 'input': args
-                })
-        
-        return JSONResponse({
-            'id': 'msg_' + uuid.uuid4().hex[:12], 'type': 'message', 'role': 'assistant',
-            'content': content_blocks, 'model': model, 'stop_reason': stop_reason,
-            'usage': {
-                'input_tokens': ollama_data.get('prompt_eval_count', 0),
-                'output_tokens': ollama_data.get('eval_count', 0)
-            }
-        })
+                yield enc.block_start(index, {'type': 'tool_use', 'id': t_id, 'name': fn.get('name'), 'input': {}})
+                yield enc.input_json_delta(index, json.dumps(_tool_input(fn.get('arguments'))))
+                yield enc.block_stop(index)
 
-async def _stream_anthropic(url: str, ollama_body: dict, model: str):
-    mid = 'msg_' + uuid.uuid4().hex[:12]
-    yield 'event: message_start' + chr(10) + f'data: {json.dumps({"type": "message_start", "message": {"id": mid, "type": "message", "role": "assistant", "content": [], "model": model, "stop_reason": None, "stop_sequence": None, "usage": {"input_tokens": 0, "output_tokens": 0}}})}' + _SSE_SEP
-    
-    async with httpx.AsyncClient(timeout=120) as client:
-        try:
-            async with client.stream('POST', url, json=ollama_body) as resp:
-                if resp.status_code != 200:
-                    yield f'data: {json.dumps({"type": "error", "error": {"type": "upstream_error", "message": (await resp.aread()).decode()}})}' + _SSE_SEP
-                    return
-                
-                content_started = False
-                thinking_started = False
-                content_idx = 0
-                last_tool_calls = []
-                
-                async for line in resp.aiter_lines():
-                    if not line.strip(): continue
-                    chunk = json.loads(line)
-                    msg = chunk.get('message', {})
-                    
-                    thinking = msg.get('thinking', '')
-                    if thinking:
-                        if not thinking_started:
-                            yield 'event: content_block_start' + chr(10) + f'data: {json.dumps({"type": "content_block_start", "index": 0, "content_block": {"type": "thinking", "thinking": ""}})}' + _SSE_SEP
-                            thinking_started = True
-                        yield 'event: content_block_delta' + chr(10) + f'data: {json.dumps({"type": "content_block_delta", "index": 0, "delta": {"type": "thinking_delta", "thinking": thinking}})}' + _SSE_SEP
-
-                    content = msg.get('content', '')
-                    if content:
-                        if thinking_started:
-                            yield 'event: content_block_stop' + chr(10) + f'data: {json.dumps({"type": "content_block_stop", "index": 0})}' + _SSE_SEP
-                            thinking_started = False
-                        
-                        if not content_started:
-                            content_idx = 1 if thinking_started else 0
-                            yield 'event: content_block_start' + chr(10) + f'data: {json.dumps({"type": "content_block_start", "index": content_idx, "content_block": {"type": "text", "text": ""}})}' + _SSE_SEP
-                            content_started = True
-                        
-                        yield 'event: content_block_delta' + chr(10) + f'data: {json.dumps({"type": "content_block_delta", "index": content_idx, "delta": {"type": "text_delta", "text": content}})}' + _SSE_SEP
-
-                    if msg.get('tool_calls'): last_tool_calls = msg['tool_calls']
-
-                    if chunk.get('done'):
-                        if thinking_started:
-                            yield 'event: content_block_stop' + chr(10) + f'data: {json.dumps({"type": "content_block_stop", "index": 0})}' + _SSE_SEP
-                        if content_started:
-                            yield 'event: content_block_stop' + chr(10) + f'data: {json.dumps({"type": "content_block_stop", "index": content_idx})}' + _SSE_SEP
-                        
-                        for i, tc in enumerate(last_tool_calls):
-                            fn = tc.get('function', {})
-                            args = fn.get('arguments', {})
-                            if isinstance(args, str):
-                                try: args = json.loads(args)
-                                except: args = {}
-                            t_id = tc.get('id') or ('toolu_' + uuid.uuid4().hex[:12])
-                            yield 'event: content_block_start' + chr(10) + f'data: {json.dumps({"type": "content_block_start", "index": 10+i, "content_block": {"type": "tool_use", "id": t_id, "name": fn.get("name"), "input": args}})}' + _SSE_SEP
-                            yield 'event: content_block_stop' + chr(10) + f'data: {json.dumps({"type": "content_block_stop", "index": 10+i})}' + _SSE_SEP
-
-                        stop_reason = 'tool_use' if last_tool_calls or chunk.get('done_reason') == 'tool_calls' else 'end_turn'
-                        yield 'event: message_delta' + chr(10) + f'data: {json.dumps({"type": "message_delta", "delta": {"stop_reason": stop_reason, "stop_sequence": None}, "usage": {"output_tokens": chunk.get("eval_count", 0)}})}' + _SSE_SEP
-                        yield 'event: message_stop' + chr(10) + 'data: {"type": "message_stop"}' + _SSE_SEP
-        except httpx.ReadTimeout:
-            yield f'data: {json.dumps({"type": "error", "error": {"type": "upstream_error", "message": "Ollama request timed out"}})}' + _SSE_SEP
+            if chunk.get('done'):
+                if open_kind: yield enc.block_stop(index)
+                open_kind = None
+                stop_reason = 'tool_use' if tool_calls or chunk.get('done_reason') == 'tool_calls' else 'end_turn'
+                yield enc.message_delta(stop_reason, chunk.get('eval_count', 0))
+                yield enc.message_stop()
+    except _UpstreamError as e:
+        yield enc.error(e.text)
+    except httpx.ReadTimeout:
+        yield enc.error('Ollama request timed out')
 
 @app.post('/v1/chat/completions')
 @app.post('/v1/responses')
 async def chat_completions(request: Request):
-    body = await request.json()
+    started = time.monotonic()
+    body = await _read_json(request)
     for p in _ANTHROPIC_DROP_PARAMS: body.pop(p, None)
     model = body.get('model', '')
     stream = body.get('stream', False)
-    ollama_body = _openai_to_ollama(body)
-    url = OLLAMA_BASE_URL + '/api/chat'
+    ollama_body, route = _router.route(body, _openai_to_ollama)
+    if not await _catalog.knows(ollama_body['model']):
+        return _openai_error(404, 'invalid_request_error', 'model_not_found', f"The model '{ollama_body['model']}' does not exist", 'model')
+    ollama_body = _fit_context(ollama_body)
+    route_headers = _router.accept(route)
+    capture = _capture.start(request.url.path, body, ollama_body)
+
+    cache_key = _response_cache.key(ollama_body)
+    cached = await _response_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        _capture.finish(capture, 'cache_hit', started)
+        headers = {**route_headers, 'X-Cache': 'HIT'}
+        if stream:
+            return StreamingResponse(_stream_openai(model, _replay_chunks(cached)), media_type='text/event-stream', headers=headers)
+        return JSONResponse(_ollama_to_openai(cached, model), headers=headers)
+    headers = {**route_headers, 'X-Cache': 'MISS'} if cache_key else route_headers or None
+
+    flight_key = _single_flight.key(ollama_body)
+    labels = (ollama_body['model'], request.url.path, 'true' if stream else 'false')
+
+    guard = _ClientGuard(request, labels, ollama_body, started)
 
     if stream:
-        return StreamingResponse(_stream_openai(url, ollama_body, model), media_type='text/event-stream')
+        background = None
+        try:
+            if flight_key:
+                chunks = await guard.call(_single_flight.stream(flight_key, lambda: _open_stream(ollama_body, cache_key, guard.timeout)))
+            else:
+                chunks, release = await guard.call(_open_stream(ollama_body, cache_key, guard.timeout))
+                background = BackgroundTask(release)
+        except _Overloaded as e:
+            _capture.finish(capture, 'overloaded', started, status=429)
+            return _openai_overloaded(e)
+        except _Cancelled as e:
+            _capture.finish(capture, e.reason, started)
+            return _openai_cancelled(e)
+        chunks = guard.stream(chunks)
+        chunks = _metrics.track(labels, started, chunks)
+        if capture: chunks = _capture.track(capture, started, chunks)
+        if SSE_COALESCE_BYTES > 0: chunks = _coalesce(chunks, SSE_COALESCE_BYTES, SSE_COALESCE_INTERVAL)
+        return StreamingResponse(
+            _stream_openai(model, chunks), media_type='text/event-stream', headers=headers,
+            background=background,
+        )
 
-    async with httpx.AsyncClient(timeout=120) as client:
-        resp = await _post_with_think_fallback(client, url, ollama_body)
-        resp.raise_for_status()
-        return JSONResponse(_ollama_to_openai(resp.json(), model))
+    try:
+        if flight_key:
+            resp, ollama_data = await guard.call(_single_flight.call(flight_key, lambda: _post_chat(ollama_body, guard.timeout)))
+        else:
+            resp, ollama_data = await guard.call(_post_chat(ollama_body, guard.timeout))
+    except _Overloaded as e:
+        _capture.finish(capture, 'overloaded', started, status=429)
+        return _openai_overloaded(e)
+    except _Cancelled as e:
+        _capture.finish(capture, e.reason, started)
+        return _openai_cancelled(e)
+    _capture.finish(capture, 'ok' if ollama_data is not None else 'upstream_error', started, ollama_data, status=resp.status_code)
+    resp.raise_for_status()
+    _metrics.observe(labels, started, None, ollama_data)
+    if cache_key: await _response_cache.put(cache_key, ollama_data)
+    return JSONResponse(_ollama_to_openai(ollama_data, model), headers=headers)
 
 def _ollama_to_openai(ollama_resp: dict, model: str) -> dict:
     msg = ollama_resp.get('message', {})
@@ -300,70 +2431,600 @@ def _ollama_to_openai(ollama_resp: dict, model: str) -> dict:
         }
     }
 
-async def _stream_openai(url: str, ollama_body: dict, model: str):
-    cid = 'chatcmpl-' + uuid.uuid4().hex[:12]
-    yield 'data: ' + json.dumps({
-        'id': cid, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
-        'choices': [{'index': 0, 'delta': {'role': 'assistant'}, 'finish_reason': None}]
-    }) + _SSE_SEP
+async def _stream_openai(model: str, chunks: AsyncIterator[dict]):
+    enc = _OpenAIEncoder('chatcmpl-' + uuid.uuid4().hex[:12], model, int(time.time()))
+    yield enc.chunk({'role': 'assistant'})
+
+    try:
+        tool_calls = 0
+        async for chunk in chunks:
+            msg = chunk.get('message', {})
+            thinking = msg.get('thinking')
+            content = msg.get('content')
+
+            if thinking and content:
+                yield enc.chunk({'reasoning_content': thinking, 'content': content})
+            elif content:
+                yield enc.content(content)
+            elif thinking:
+                yield enc.reasoning(thinking)
+
+            for tc in msg.get('tool_calls') or ():
+                fn = tc.get('function', {})
+                args = fn.get('arguments')
+                if not isinstance(args, str): args = json.dumps(args if args is not None else {})
+                yield enc.tool_call(tool_calls, tc.get('id') or ('call_' + uuid.uuid4().hex[:12]), fn.get('name'), args)
+                tool_calls += 1
+
+            if chunk.get('done'):
+                finish_reason = 'tool_calls' if tool_calls or chunk.get('done_reason') == 'tool_calls' else 'stop'
+                yield enc.chunk({}, finish_reason, {
+                    'prompt_tokens': chunk.get('prompt_eval_count', 0),
+                    'completion_tokens': chunk.get('eval_count', 0),
+                    'total_tokens': chunk.get('prompt_eval_count', 0) + chunk.get('eval_count', 0)
+                })
+        yield enc.DONE
+    except _UpstreamError as e:
+        yield enc.error(e.text)
+        yield enc.DONE
+    except httpx.ReadTimeout:
+        yield enc.error('Ollama request timed out')
+        yield enc.DONE
+
+class _EmbedBatcher:
+    '''Coalesces concurrent embedding requests with the same model and parameters into /api/embed calls.
+
+    A batch becomes due window seconds after its first request and is sent as soon as fewer
+    than concurrency calls for its key are in flight; until then it keeps absorbing requests,
+    so batches grow while the model is busy. A batch that reaches max_inputs is closed at once.
+    '''
+
+    def __init__(self, max_inputs: int, window: float, concurrency: int):
+        self.max_inputs = max_inputs
+        self.window = window
+        self.concurrency = max(1, concurrency)
+        self._keys: Dict[str, dict] = {}
+        self._tasks: set = set()
+        self.requests = 0
+        self.batches = 0
+        self.inputs = 0
+
+    async def embed(self, body: dict, inputs: List[str]) -> tuple:
+        '''Returns (vectors, prompt_tokens) for inputs; body holds the model and /api/embed parameters.'''
+        self.requests += 1
+        if self.window <= 0:
+            return (await self._send(body, [inputs]))[0]
+        key = json.dumps(body, sort_keys=True)
+        state = self._keys.get(key)
+        if state is None:
+            state = self._keys[key] = {'body': body, 'open': None, 'ready': collections.deque(), 'in_flight': 0}
+        batch = state['open']
+        if batch is not None and batch['size'] + len(inputs) > self.max_inputs:
+            self._close(key)
+            batch = None
+        loop = asyncio.get_running_loop()
+        if batch is None:
+            batch = state['open'] = {
+                'parts': [], 'futures': [], 'size': 0, 'due': False,
+                'timer': loop.call_later(self.window, self._due, key),
+            }
+        future = loop.create_future()
+        batch['parts'].append(inputs)
+        batch['futures'].append(future)
+        batch['size'] += len(inputs)
+        if batch['size'] >= self.max_inputs: self._close(key)
+        return await future
+
+    def _due(self, key: str):
+        state = self._keys.get(key)
+        if state is not None and state['open'] is not None:
+            state['open']['due'] = True
+            self._dispatch(key)
+
+    def _close(self, key: str):
+        state = self._keys[key]
+        batch, state['open'] = state['open'], None
+        batch['timer'].cancel()
+        state['ready'].append(batch)
+        self._dispatch(key)
 
-    async with httpx.AsyncClient(timeout=120) as client:
+    def _dispatch(self, key: str):
+        state = self._keys[key]
+        while state['in_flight'] < self.concurrency:
+            if state['ready']:
+                batch = state['ready'].popleft()
+            elif state['open'] is not None and state['open']['due']:
+                batch, state['open'] = state['open'], None
+            else:
+                break
+            state['in_flight'] += 1
+            task = asyncio.ensure_future(self._run(key, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if not state['in_flight'] and state['open'] is None and not state['ready']:
+            del self._keys[key]
+
+    async def _run(self, key: str, batch: dict):
+        state = self._keys[key]
         try:
-            async with client.stream('POST', url, json=ollama_body) as resp:
-                resp.raise_for_status()
-                last_tool_calls = []
-                async for line in resp.aiter_lines():
-                    if not line.strip(): continue
-                    chunk = json.loads(line)
-                    msg = chunk.get('message', {})
-                    delta = {}
-                    if msg.get('thinking'): delta['reasoning_content'] = msg['thinking']
-                    if msg.get('content'): delta['content'] = msg['content']
-                    
-                    if msg.get('tool_calls'):
-                        last_tool_calls = msg['tool_calls']
-                        fixed_calls = []
-                        for tc in last_tool_calls:
-                            fn = tc.get('function', {})
-                            args = fn.get('arguments')
-                            if isinstance(args, dict): args = json.dumps(args)
-                            fixed_calls.append({
-                                'index': 0, 'id': tc.get('id'), 'type': 'function',
-                                'function': {'name': fn.get('name'), 'arguments': args}
-                            })
-                        delta['tool_calls'] = fixed_calls
-                    
-                    if delta:
-                        yield 'data: ' + json.dumps({
-                            'id': cid, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
-                            'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]
-                        }) + _SSE_SEP
-                    
-                    if chunk.get('done'):
-                        finish_reason = 'tool_calls' if last_tool_calls or chunk.get('done_reason') == 'tool_calls' else 'stop'
-                        yield 'data: ' + json.dumps({
-                            'id': cid, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
-                            'choices': [{'index': 0, 'delta': {}, 'finish_reason': finish_reason}],
-                            'usage': {
-                                'prompt_tokens': chunk.get('prompt_eval_count', 0),
-                                'completion_tokens': chunk.get('eval_count', 0),
-                                'total_tokens': chunk.get('prompt_eval_count', 0) + chunk.get('eval_count', 0)
-                            }
-                        }) + _SSE_SEP
-                yield 'data: [DONE]' + _SSE_SEP
-        except httpx.ReadTimeout:
-            yield 'data: [DONE]' + _SSE_SEP
+            results = await self._send(state['body'], batch['parts'])
+        except Exception as e:
+            results = [e] * len(batch['futures'])
+        finally:
+            state['in_flight'] -= 1
+            self._dispatch(key)
+        for future, result in zip(batch['futures'], results):
+            if future.done():
+                continue
+            if isinstance(result, Exception): future.set_exception(result)
+            else: future.set_result(result)
+
+    async def _send(self, body: dict, parts: List[List[str]]) -> list:
+        '''One /api/embed call for all parts; returns (vectors, prompt_tokens) or an exception per part.'''
+        model = body['model']
+        inputs = [text for part in parts for text in part]
+        self.batches += 1
+        self.inputs += len(inputs)
+        _metrics.embed_batch.observe((model,), len(inputs))
+        lease = await _admission.admit(model)
+        _warm_pool.touch(model)
+        async with lease as backend:
+            resp = await _client().post(backend.url + '/api/embed', json={**body, 'input': inputs})
+            _backends.observe(backend, resp.status_code)
+        if resp.status_code != 200:
+            if len(parts) > 1 and resp.status_code < 500:
+                # One bad input fails the whole call; resend each request alone so only its caller gets the error
+                retried = await asyncio.gather(*(self._send(body, [part]) for part in parts), return_exceptions=True)
+                return [r if isinstance(r, Exception) else r[0] for r in retried]
+            raise _UpstreamError(resp.status_code, resp.text)
+        data = resp.json()
+        vectors = data.get('embeddings') or []
+        if len(vectors) != len(inputs):
+            raise _UpstreamError(502, f'/api/embed returned {len(vectors)} embeddings for {len(inputs)} inputs')
+        # Ollama reports one prompt_eval_count per call; callers get a share proportional to their input length
+        tokens = data.get('prompt_eval_count', 0)
+        chars = sum(len(text) for text in inputs) or 1
+        results, start = [], 0
+        for part in parts:
+            results.append((vectors[start:start + len(part)], round(tokens * sum(len(text) for text in part) / chars)))
+            start += len(part)
+        return results
+
+    def stats(self) -> dict:
+        return {
+            'max_inputs': self.max_inputs, 'window': self.window, 'concurrency': self.concurrency,
+            'requests': self.requests, 'batches': self.batches, 'inputs': self.inputs,
+            'pending': sum(len(st['ready']) + (st['open'] is not None) for st in self._keys.values()),
+        }
+
+_embed_batcher = _EmbedBatcher(EMBED_BATCH_MAX_INPUTS, EMBED_BATCH_WINDOW, EMBED_BATCH_CONCURRENCY)
+
+def _base64_floats(vector: List[float]) -> str:
+    return base64.b64encode(struct.pack(f'<{len(vector)}f', *vector)).decode()
+
+@app.post('/v1/embeddings')
+async def embeddings(request: Request):
+    started = time.monotonic()
+    body = await _read_json(request)
+    model = body.get('model', '')
+    if not await _catalog.knows(model):
+        return _openai_error(404, 'invalid_request_error', 'model_not_found', f"The model '{model}' does not exist", 'model')
+    inputs = body.get('input')
+    if isinstance(inputs, str): inputs = [inputs]
+    if not isinstance(inputs, list) or not inputs or not all(isinstance(text, str) for text in inputs):
+        # Ollama embeds text only, so token-id arrays are rejected here
+        return _openai_error(400, 'invalid_request_error', 'invalid_input', "'input' must be a string or a non-empty array of strings", 'input')
+    ollama_body = {'model': model}
+    if body.get('dimensions'): ollama_body['dimensions'] = body['dimensions']
+    keep_alive = _warm_pool.keep_alive(model)
+    if keep_alive is not None: ollama_body['keep_alive'] = keep_alive
+
+    try:
+        vectors, tokens = await _embed_batcher.embed(ollama_body, inputs)
+    except _Overloaded as e:
+        return _openai_overloaded(e)
+    except _UpstreamError as e:
+        return _openai_error(e.status_code, 'api_error', 'upstream_error', e.text)
+    _metrics.duration.observe((model, request.url.path, 'false'), time.monotonic() - started)
+    encode = _base64_floats if body.get('encoding_format') == 'base64' else None
+    return JSONResponse({
+        'object': 'list', 'model': model,
+        'data': [{'object': 'embedding', 'index': i, 'embedding': encode(v) if encode else v} for i, v in enumerate(vectors)],
+        'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+    })
+
+# Multi-worker mode: the supervisor process hosts a coordinator that owns admission, backend health, the
+# catalog, the response cache and the warm pool; workers reach it over a Unix socket with NDJSON messages
+class _Peer:
+    '''One worker connection, as seen by the coordinator.'''
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.leases: Dict[int, _Lease] = {}
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+
+    def send(self, msg: dict):
+        self.writer.write(_json_body(msg) + b'\n')
+
+    async def request(self, msg: dict, timeout: float) -> dict:
+        n = next(self._ids)
+        fut = self._pending[n] = asyncio.get_running_loop().create_future()
+        self.send({**msg, 'id': n})
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            self._pending.pop(n, None)
+
+    def resolve(self, msg: dict):
+        fut = self._pending.get(msg.get('id'))
+        if fut is not None and not fut.done(): fut.set_result(msg)
+
+class _Coordinator:
+    '''Shared state for worker processes, served on a Unix socket from the supervisor process.
+
+    Workers send {"op": ..., "id": n, ...} lines and get {"id": n, ...} replies; messages without an
+    id are notifications. A worker's leases are released when its connection drops, so a crashed
+    worker cannot leak admission slots.
+    '''
+
+    _SNAPSHOT_TIMEOUT = 2.0
+
+    def __init__(self, path: str):
+        self.path = path
+        self.peers: set = set()
+        self._background: set = set()
+
+    async def listen(self) -> asyncio.AbstractServer:
+        return await asyncio.start_unix_server(self._handle, path=self.path, limit=2 ** 26)
+
+    async def serve(self, ready: threading.Event):
+        global _http_client
+        _http_client = _build_http_client()
+        server = await self.listen()
+        tasks = [asyncio.create_task(_warm_up()), asyncio.create_task(_backends.probe_loop())]
+        ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks: task.cancel()
+
+    def start(self) -> threading.Thread:
+        '''Runs the coordinator on its own event loop in a daemon thread; returns once it is listening.'''
+        ready = threading.Event()
+        thread = threading.Thread(target=lambda: asyncio.run(self.serve(ready)), name='coordinator', daemon=True)
+        thread.start()
+        if not ready.wait(30):
+            raise RuntimeError('coordinator did not start')
+        return thread
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = _Peer(writer)
+        self.peers.add(peer)
+        try:
+            while line := await reader.readline():
+                msg = _json_loads(line)
+                op = msg.get('op')
+                if op is None:
+                    peer.resolve(msg)
+                elif 'id' in msg:
+                    peer.tasks[msg['id']] = asyncio.create_task(self._reply(peer, msg))
+                else:
+                    getattr(self, '_op_' + op)(peer, msg)
+        except (ConnectionError, ValueError) as e:
+            logger.warning('worker connection failed: %s', e)
+        finally:
+            self.peers.discard(peer)
+            for task in peer.tasks.values(): task.cancel()
+            for lease in peer.leases.values(): lease.release()
+            writer.close()
+
+    async def _reply(self, peer: _Peer, msg: dict):
+        n = msg['id']
+        try:
+            result = await getattr(self, '_op_' + msg['op'])(peer, msg)
+        except _Overloaded as e:
+            result = {'error': 'overloaded', 'message': str(e), 'retry_after': e.retry_after}
+        except Exception as e:
+            logger.exception('coordinator op %s failed', msg['op'])
+            result = {'error': 'internal', 'message': str(e)}
+        finally:
+            peer.tasks.pop(n, None)
+        peer.send({**result, 'id': n})
+
+    def _backend(self, url: str) -> Optional[_Backend]:
+        return next((b for b in _backends.backends if b.url == url), None)
+
+    async def _op_admit(self, peer: _Peer, msg: dict) -> dict:
+        lease = await _admission.admit(msg['model'])
+        _warm_pool.touch(msg['model'])
+        peer.leases[msg['id']] = lease
+        return {'backend': lease.backend.url}
+
+    def _op_release(self, peer: _Peer, msg: dict):
+        # Also sent for an admit the worker gave up on: stop waiting, or hand back the slot if it was granted
+        task = peer.tasks.pop(msg['ref'], None)
+        if task is not None: task.cancel()
+        lease = peer.leases.pop(msg['ref'], None)
+        if lease is not None: lease.release()
+
+    def _op_observe(self, peer: _Peer, msg: dict):
+        backend = self._backend(msg['backend'])
+        if backend is not None: _backends.observe(backend, msg['status'])
+
+    def _op_fail(self, peer: _Peer, msg: dict):
+        backend = self._backend(msg['backend'])
+        if backend is not None: _backends.mark_failure(backend)
+
+    def _op_loaded(self, peer: _Peer, msg: dict):
+        backend = self._backend(msg['backend'])
+        if backend is not None: _warm_pool.observe(msg['model'], backend, {'load_duration': msg['load_duration']})
+
+    async def _op_catalog(self, peer: _Peer, msg: dict) -> dict:
+        await _catalog.recheck()
+        return {'loaded': _catalog.loaded, 'models': list(_catalog.models.values())}
+
+    async def _op_cache_get(self, peer: _Peer, msg: dict) -> dict:
+        return {'data': await _response_cache.get(msg['key'])}
+
+    def _op_cache_put(self, peer: _Peer, msg: dict):
+        task = asyncio.create_task(_response_cache.put(msg['key'], msg['data']))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _op_stats(self, peer: _Peer, msg: dict) -> dict:
+        return {
+            'workers': len(self.peers), 'limiters': _admission.stats(), 'warm_pool': _warm_pool.stats(),
+            'backends': [b.status() for b in _backends.backends],
+        }
+
+    async def _op_metrics(self, peer: _Peer, msg: dict) -> dict:
+        merged = _Metrics()
+        merged.merge(_metrics.snapshot())
+        replies = await asyncio.gather(
+            *(p.request({'op': 'snapshot'}, self._SNAPSHOT_TIMEOUT) for p in list(self.peers)), return_exceptions=True,
+        )
+        for reply in replies:
+            if isinstance(reply, dict): merged.merge(reply['snapshot'])
+        return {'text': merged.render()}
+
+class _CoordinatorClient:
+    '''A worker's connection to the coordinator; replies are matched to requests by id.
+
+    A lost connection fails the calls waiting on it, and the next call reconnects, raising
+    ConnectionError at once if the coordinator is gone.
+    '''
+
+    # An admit may legitimately wait in the coordinator's queue for up to ADMISSION_QUEUE_TIMEOUT
+    _TIMEOUT = ADMISSION_QUEUE_TIMEOUT + 10.0
+
+    def __init__(self, path: str):
+        self.path = path
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        self._connecting = asyncio.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self):
+        reader, self._writer = await asyncio.open_unix_connection(self.path, limit=2 ** 26)
+        self._reader_task = asyncio.create_task(self._read(reader, self._writer))
+
+    async def close(self):
+        if self._reader_task is not None: self._reader_task.cancel()
+        if self._writer is not None: self._writer.close()
+
+    def send(self, msg: dict):
+        # Fire-and-forget messages are dropped while disconnected; the coordinator frees a lost worker's slots
+        if self.connected: self._writer.write(_json_body(msg) + b'\n')
+
+    async def _reconnect(self):
+        async with self._connecting:
+            if self.connected:
+                return
+            try:
+                await self.connect()
+            except OSError as e:
+                raise ConnectionError(f'coordinator unreachable: {e}') from e
+            logger.info('reconnected to coordinator %s', self.path)
+
+    async def call(self, op: str, **fields) -> dict:
+        if not self.connected: await self._reconnect()
+        n = next(self._ids)
+        fut = self._pending[n] = asyncio.get_running_loop().create_future()
+        self.send({'op': op, 'id': n, **fields})
+        try:
+            return await asyncio.wait_for(fut, self._TIMEOUT)
+        except asyncio.TimeoutError:
+            self.send({'op': 'release', 'ref': n})
+            raise ConnectionError(f'coordinator did not answer {op} within {self._TIMEOUT:.0f}s') from None
+        except asyncio.CancelledError:
+            self.send({'op': 'release', 'ref': n})
+            raise
+        finally:
+            self._pending.pop(n, None)
+
+    async def _read(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                msg = _json_loads(line)
+                if msg.get('op') == 'snapshot':
+                    self.send({'id': msg['id'], 'snapshot': _metrics.snapshot()})
+                    continue
+                fut = self._pending.get(msg['id'])
+                if fut is not None and not fut.done(): fut.set_result(msg)
+        except (ConnectionError, ValueError) as e:
+            logger.warning('coordinator connection failed: %s', e)
+        finally:
+            writer.close()
+            for fut in self._pending.values():
+                if not fut.done(): fut.set_exception(ConnectionError('coordinator connection lost'))
+
+class _SharedLease(_Lease):
+    def __init__(self, pool: _BackendPool, backend: _Backend, ref: int):
+        super().__init__(pool, backend)
+        self.ref = ref
+
+    def release(self):
+        if not self._released: _coordinator.send({'op': 'release', 'ref': self.ref})
+        super().release()
+
+class _RemoteOverloaded(_Overloaded):
+    def __init__(self, message: str, retry_after: int):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+
+class _SharedAdmission(_Admission):
+    '''Admission decided by the coordinator, so limits hold across all workers.'''
+
+    async def admit(self, model: str) -> _Lease:
+        reply = await _coordinator.call('admit', model=model)
+        if reply.get('error') == 'overloaded':
+            raise _RemoteOverloaded(reply['message'], reply['retry_after'])
+        if 'error' in reply:
+            raise RuntimeError(f"coordinator: {reply['message']}")
+        backend = next(b for b in self.pool.backends if b.url == reply['backend'])
+        return _SharedLease(self.pool, backend, reply['id'])
+
+class _SharedBackendPool(_BackendPool):
+    '''Worker view of the backends: health observations are forwarded to the coordinator, which routes.'''
+
+    def observe(self, backend: _Backend, status_code: int):
+        _coordinator.send({'op': 'observe', 'backend': backend.url, 'status': status_code})
+
+    def mark_failure(self, backend: _Backend):
+        _coordinator.send({'op': 'fail', 'backend': backend.url})
+
+class _SharedCatalog(_ModelCatalog):
+    async def refresh(self):
+        reply = await _coordinator.call('catalog')
+        if reply['loaded']: self._install(reply['models'])
+
+class _SharedResponseCache(_ResponseCache):
+    async def get(self, key: str) -> Optional[dict]:
+        data = (await _coordinator.call('cache_get', key=key))['data']
+        if data is None: self.misses += 1
+        else: self.hits += 1
+        return data
+
+    async def put(self, key: str, ollama_data: dict):
+        _coordinator.send({'op': 'cache_put', 'key': key, 'data': ollama_data})
+
+class _SharedWarmPool(_WarmPool):
+    def observe(self, model: str, backend: _Backend, ollama_data: dict):
+        if (ollama_data.get('load_duration') or 0) / 1e9 >= self._COLD_LOAD_SECONDS:
+            _coordinator.send({'op': 'loaded', 'model': model, 'backend': backend.url, 'load_duration': ollama_data['load_duration']})
+
+_coordinator: Optional[_CoordinatorClient] = None
+
+if ADAPTER_COORDINATOR:
+    # Translation, token-count, single-flight and embedding-batch state stays per worker
+    _coordinator = _CoordinatorClient(ADAPTER_COORDINATOR)
+    _backends = _SharedBackendPool([b.address for b in _backends.backends])
+    _admission = _SharedAdmission(_backends)
+    _catalog = _SharedCatalog(_backends, MODEL_CATALOG_TTL)
+    _response_cache = _SharedResponseCache(RESPONSE_CACHE, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL)
+    _warm_pool = _SharedWarmPool(_backends, WARM_MODELS, WARM_POOL_MEMORY_BUDGET_MB * 1024 * 1024)
+    if _capture.path:
+        root, ext = os.path.splitext(_capture.path)
+        _capture.path = f'{root}.{os.getpid()}{ext}'
+
+async def _shared_stats() -> Optional[dict]:
+    return await _coordinator.call('stats') if _coordinator is not None else None
 
 @app.get('/health')
-async def health(): return {'status': 'ok', 'ollama_base': OLLAMA_BASE_URL}
+async def health():
+    try:
+        shared = await _shared_stats()
+    except ConnectionError as e:
+        return JSONResponse({
+            'status': 'degraded', 'ollama_base': OLLAMA_BASE_URL, 'coordinator': str(e),
+            'backends': [b.status() for b in _backends.backends], 'pid': os.getpid(),
+        }, status_code=503)
+    return {
+        'status': 'ok', 'ollama_base': OLLAMA_BASE_URL,
+        'backends': shared['backends'] if shared else [b.status() for b in _backends.backends],
+        **({'workers': shared['workers'], 'pid': os.getpid()} if shared else {}),
+    }
+
+@app.get('/admission')
+async def admission_stats():
+    # Single-flight, embedding and token-count figures are this worker's own in multi-worker mode
+    shared = await _shared_stats()
+    return {
+        'queue_size': ADMISSION_QUEUE_SIZE, 'queue_timeout': ADMISSION_QUEUE_TIMEOUT,
+        'limiters': shared['limiters'] if shared else _admission.stats(), 'single_flight': _single_flight.stats(),
+        'embeddings': _embed_batcher.stats(), 'token_count': _token_counter.stats(),
+    }
+
+@app.get('/metrics')
+async def metrics():
+    text = (await _coordinator.call('metrics'))['text'] if _coordinator is not None else _metrics.render()
+    return Response(content=text, media_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.get('/warm-pool')
+async def warm_pool_stats():
+    shared = await _shared_stats()
+    return shared['warm_pool'] if shared else _warm_pool.stats()
+
+@app.get('/capabilities')
+async def capabilities():
+    return {'think_models': sorted(THINK_MODELS), 'models': _think_registry.snapshot()}
+
+@app.delete('/capabilities')
+async def invalidate_capabilities():
+    _think_registry.invalidate()
+    return {'invalidated': 'all'}
+
+@app.delete('/capabilities/{model:path}')
+async def invalidate_model_capabilities(model: str):
+    _think_registry.invalidate(model)
+    return {'invalidated': model}
 
 @app.get('/v1/models')
 async def list_models():
-    async with httpx.AsyncClient(timeout=30) as client:
-        r = await client.get(OLLAMA_BASE_URL + '/api/tags')
-        r.raise_for_status()
-        models = r.json().get('models', [])
-        return JSONResponse({
-            'object': 'list',
-            'data': [{'id': m['name'], 'object': 'model', 'created': 0, 'owned_by': 'ollama'} for m in models]
-        })
+    models = await _catalog.list()
+    if not _catalog.loaded:
+        raise HTTPException(status_code=502, detail='No Ollama backend reachable')
+    return JSONResponse({
+        'object': 'list',
+        'data': [
+            {
+                'id': m['id'], 'object': 'model', 'created': 0, 'owned_by': 'ollama',
+                'context_length': m['context_length'], 'capabilities': m['capabilities'],
+                'quantization': m['quantization'], 'parameter_size': m['parameter_size'], 'family': m['family'],
+            }
+            for m in models.values()
+        ]
+    })
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Claude Code Ollama adapter')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=4000)
+    parser.add_argument('--workers', type=int, default=ADAPTER_WORKERS)
+    parser.add_argument('--log-level', default='info')
+    args = parser.parse_args(argv)
+    import uvicorn
+    if args.workers <= 1:
+        uvicorn.run(app, host=args.host, port=args.port, log_level=args.log_level)
+        return
+    directory = tempfile.mkdtemp(prefix='ollama-adapter-')
+    try:
+        path = os.path.join(directory, 'coordinator.sock')
+        _Coordinator(path).start()
+        # Workers are spawned and re-import this module; the variable switches them to the shared state
+        os.environ['ADAPTER_COORDINATOR'] = path
+        uvicorn.run('proxy:app', host=args.host, port=args.port, workers=args.workers, log_level=args.log_level,
+                    app_dir=os.path.dirname(os.path.abspath(__file__)))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
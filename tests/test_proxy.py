@@ -1,7 +1,12 @@
 import asyncio
+import base64
+import json
+import struct
 import pytest
 import httpx
+import proxy
 from proxy import (
+    app,
     health,
     list_models,
     _normalize_messages,
@@ -9,6 +14,7 @@ from proxy import (
     _anthropic_to_ollama,
     _ollama_to_openai,
     _post_with_think_fallback,
+    _build_http_client,
 )
 
 def test_health():
@@ -159,12 +165,15 @@ class _FakeAsyncClient:
     async def __aexit__(self, exc_type, exc, tb):
         return False
 
-    async def post(self, url, json):
-        self.calls.append(json)
+    async def post(self, url, content, headers=None, timeout=None):
+        assert headers == {"Content-Type": "application/json"}
+        self.calls.append(json.loads(content))
         return self._responses.pop(0)
 
 
-def test_post_with_think_fallback_retries_without_think_on_unsupported_thinking():
+def test_post_with_think_fallback_retries_without_think_on_unsupported_thinking(monkeypatch):
+    registry = proxy._ThinkRegistry(60)
+    monkeypatch.setattr("proxy._think_registry", registry)
     fake_client = _FakeAsyncClient([
         _FakeResponse(400, text='{"error":"model does not support thinking"}'),
         _FakeResponse(
@@ -193,6 +202,8 @@ def test_post_with_think_fallback_retries_without_think_on_unsupported_thinking(
     assert response.status_code == 200
     assert fake_client.calls[0]["think"] is True
     assert "think" not in fake_client.calls[1]
+    assert registry.supports("glm-5:cloud") is False
+    assert "think" not in _openai_to_ollama({"model": "glm-5:cloud", "messages": []})
 
 
 def test_post_with_think_fallback_no_retry_without_think():
@@ -211,8 +222,9 @@ def test_post_with_think_fallback_no_retry_without_think():
 
 
 class _FakeAsyncGetClient:
-    def __init__(self, json_data):
+    def __init__(self, json_data, show_data=None):
         self._json_data = json_data
+        self._show_data = show_data or {}
 
     async def __aenter__(self):
         return self
@@ -220,16 +232,1738 @@ class _FakeAsyncGetClient:
     async def __aexit__(self, exc_type, exc, tb):
         return False
 
-    async def get(self, url):
+    async def get(self, url, **kwargs):
         return _FakeResponse(200, json_data=self._json_data)
 
+    async def post(self, url, json=None, **kwargs):
+        return _FakeResponse(200, json_data=self._show_data.get(json["model"], {}))
+
 
 def test_list_models_formats_ollama_tags(monkeypatch):
     fake_client = _FakeAsyncGetClient(
         {"models": [{"name": "model-a"}, {"name": "model-b"}]}
     )
-    monkeypatch.setattr("proxy.httpx.AsyncClient", lambda timeout=30: fake_client)
+    monkeypatch.setattr("proxy._http_client", fake_client)
+    monkeypatch.setattr("proxy._catalog", proxy._ModelCatalog(_backend_pool(set()), 60))
     response = asyncio.run(list_models())
     data = response.body.decode()
     assert "\"id\":\"model-a\"" in data
     assert "\"id\":\"model-b\"" in data
+
+
+def test_build_http_client_applies_pool_limits_and_timeouts(monkeypatch):
+    monkeypatch.setattr("proxy.OLLAMA_CONNECT_TIMEOUT", 3.0)
+    monkeypatch.setattr("proxy.OLLAMA_READ_TIMEOUT", 45.0)
+    monkeypatch.setattr("proxy.OLLAMA_POOL_TIMEOUT", 2.0)
+    client = _build_http_client()
+    try:
+        assert client.timeout.connect == 3.0
+        assert client.timeout.read == 45.0
+        assert client.timeout.pool == 2.0
+    finally:
+        asyncio.run(client.aclose())
+
+
+def test_lifespan_shares_one_client_and_closes_it_on_shutdown():
+    async def run():
+        async with app.router.lifespan_context(app):
+            client = proxy._client()
+            assert proxy._client() is client
+            assert not client.is_closed
+        return client
+
+    client = asyncio.run(run())
+    assert client.is_closed
+    assert proxy._http_client is None
+
+
+def test_upstream_target_maps_unix_and_h2c_addresses():
+    url, transport, path = proxy._upstream_target("unix:///run/ollama/ollama.sock")
+    assert transport == "unix" and path == "/run/ollama/ollama.sock"
+    assert url.startswith("http://ollama-") and url.endswith(".localhost")
+    assert proxy._upstream_target("h2c://gpu-1:8443") == ("http://gpu-1:8443", "h2c", None)
+    assert proxy._upstream_target("http://gpu-2:11434") == ("http://gpu-2:11434", None, None)
+
+
+def test_build_http_client_mounts_transport_per_unix_and_h2c_backend(monkeypatch):
+    pool = proxy._BackendPool(["unix:///tmp/ollama.sock", "h2c://gpu-1:8443", "http://gpu-2:11434"])
+    monkeypatch.setattr("proxy._backends", pool)
+    client = _build_http_client()
+    try:
+        unix, h2c, plain = pool.backends
+        assert unix.status()["url"] == "unix:///tmp/ollama.sock"
+        assert client._transport_for_url(httpx.URL(unix.url + "/api/chat")) is not client._transport
+        assert client._transport_for_url(httpx.URL(h2c.url + "/api/chat")) is not client._transport
+        assert client._transport_for_url(httpx.URL(plain.url + "/api/chat")) is client._transport
+    finally:
+        asyncio.run(client.aclose())
+
+
+def test_unix_socket_backend_serves_streaming_and_non_streaming_chat(monkeypatch, tmp_path):
+    path = str(tmp_path / "ollama.sock")
+    hosts = []
+
+    async def handle(reader, writer):
+        head = await reader.readuntil(b"\r\n\r\n")
+        headers = {k.lower(): v for k, v in (line.split(": ", 1) for line in head.decode().split("\r\n")[1:] if line)}
+        hosts.append(headers["host"])
+        body = json.loads(await reader.readexactly(int(headers["content-length"])))
+        if body.get("stream"):
+            data = b'{"message":{"content":"hi"},"done":false}\n{"done":true}\n'
+        else:
+            data = b'{"message":{"role":"assistant","content":"hi"},"done":true}'
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % len(data) + data)
+        await writer.drain()
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_unix_server(handle, path=path)
+        pool = proxy._BackendPool([f"unix://{path}"])
+        monkeypatch.setattr("proxy._backends", pool)
+        monkeypatch.setattr("proxy._http_client", _build_http_client())
+        try:
+            body = {"model": "m", "messages": []}
+            resp = await _post_with_think_fallback(proxy._client(), pool.backends[0].url + "/api/chat", body)
+            chunks = await _collect(proxy._ollama_stream({**body, "stream": True}, pool.lease("m")))
+        finally:
+            await proxy._client().aclose()
+            server.close()
+        return resp, chunks
+
+    resp, chunks = asyncio.run(run())
+    assert resp.json()["message"]["content"] == "hi"
+    assert [c.get("done") for c in chunks] == [False, True]
+    assert all(host.endswith(".localhost") for host in hosts) and len(hosts) == 2
+
+
+def _backend_pool(*models_per_backend):
+    pool = proxy._BackendPool([f"http://ollama-{i}:11434" for i in range(len(models_per_backend))])
+    for backend, models in zip(pool.backends, models_per_backend):
+        backend.models = set(models)
+    return pool
+
+
+def test_backend_pool_picks_least_outstanding_backend_serving_model():
+    pool = _backend_pool({"qwen3:14b"}, {"qwen3:14b", "llama3:latest"}, {"qwen3:14b"})
+    pool.backends[0].outstanding = 2
+    pool.backends[1].outstanding = 1
+    pool.backends[2].outstanding = 3
+    assert pool.pick("qwen3:14b") is pool.backends[1]
+    assert pool.pick("llama3") is pool.backends[1]
+
+
+def test_backend_pool_ejects_after_repeated_failures(monkeypatch):
+    monkeypatch.setattr("proxy.OLLAMA_BACKEND_MAX_FAILURES", 2)
+    pool = _backend_pool({"m:latest"}, {"m:latest"})
+    bad, good = pool.backends
+    good.outstanding = 5
+    pool.observe(bad, 502)
+    assert bad.healthy
+    pool.observe(bad, 503)
+    assert not bad.healthy
+    assert pool.pick("m") is good
+
+
+def test_backend_pool_falls_back_to_all_backends_when_all_ejected():
+    pool = _backend_pool({"m:latest"})
+    pool.backends[0].healthy = False
+    assert pool.pick("m") is pool.backends[0]
+
+
+def test_backend_pool_lease_tracks_outstanding_and_transport_failures():
+    pool = _backend_pool({"m:latest"})
+    backend = pool.backends[0]
+
+    async def run():
+        async with pool.lease("m") as leased:
+            assert leased.outstanding == 1
+        with pytest.raises(httpx.ConnectError):
+            async with pool.lease("m"):
+                raise httpx.ConnectError("refused")
+
+    asyncio.run(run())
+    assert backend.outstanding == 0
+    assert backend.failures == 1
+
+
+def test_backend_pool_refresh_restores_ejected_backend(monkeypatch):
+    pool = _backend_pool(set())
+    backend = pool.backends[0]
+    backend.healthy = False
+    backend.failures = 3
+    monkeypatch.setattr("proxy._http_client", _FakeAsyncGetClient({"models": [{"name": "qwen3:14b"}]}))
+    asyncio.run(pool.refresh(backend))
+    assert backend.healthy
+    assert backend.failures == 0
+    assert backend.models == {"qwen3:14b"}
+
+
+def test_limiter_admits_waiters_in_fifo_order():
+    limiter = proxy._Limiter("model:m", limit=1, queue_size=4)
+    order = []
+
+    async def worker(name, hold):
+        acquired_at = await limiter.acquire(timeout=1)
+        order.append(name)
+        await asyncio.sleep(hold)
+        limiter.release(acquired_at)
+
+    async def run():
+        first = asyncio.create_task(worker("a", 0.02))
+        await asyncio.sleep(0)
+        rest = [asyncio.create_task(worker(n, 0)) for n in ("b", "c", "d")]
+        await asyncio.gather(first, *rest)
+
+    asyncio.run(run())
+    assert order == ["a", "b", "c", "d"]
+    assert limiter.active == 0
+    assert limiter.stats()["admitted"] == 4
+
+
+def test_limiter_rejects_when_queue_full_and_on_deadline():
+    limiter = proxy._Limiter("model:m", limit=1, queue_size=1)
+
+    async def run():
+        await limiter.acquire(timeout=1)
+        waiter = asyncio.create_task(limiter.acquire(timeout=0.05))
+        await asyncio.sleep(0)
+        with pytest.raises(proxy._Overloaded) as full:
+            await limiter.acquire(timeout=1)
+        with pytest.raises(proxy._Overloaded):
+            await waiter
+        return full.value
+
+    error = asyncio.run(run())
+    assert error.retry_after >= 1
+    stats = limiter.stats()
+    assert stats["rejected"] == 1
+    assert stats["timed_out"] == 1
+    assert stats["queued"] == 0
+
+
+def test_admission_applies_model_limit_and_releases_on_lease_exit(monkeypatch):
+    monkeypatch.setattr("proxy.ADMISSION_MODEL_LIMITS", {"m": 1})
+    monkeypatch.setattr("proxy.ADMISSION_QUEUE_SIZE", 0)
+    admission = proxy._Admission(_backend_pool({"m:latest"}))
+
+    async def run():
+        lease = await admission.admit("m")
+        with pytest.raises(proxy._Overloaded):
+            await admission.admit("m")
+        async with lease:
+            pass
+        lease.release()
+        async with await admission.admit("m"):
+            pass
+
+    asyncio.run(run())
+    assert admission.stats()["model:m:latest"]["active"] == 0
+    assert admission.pool.backends[0].outstanding == 0
+
+
+def test_admission_shares_one_model_limit_across_tag_spellings(monkeypatch):
+    monkeypatch.setattr("proxy.ADMISSION_MODEL_LIMITS", {"m:latest": 1})
+    monkeypatch.setattr("proxy.ADMISSION_QUEUE_SIZE", 0)
+    admission = proxy._Admission(_backend_pool({"m:latest"}))
+
+    async def run():
+        async with await admission.admit("m"):
+            with pytest.raises(proxy._Overloaded):
+                await admission.admit("m:latest")
+
+    asyncio.run(run())
+    assert list(admission.stats()) == ["model:m:latest"]
+
+
+def test_overloaded_responses_are_protocol_shaped_429s():
+    limiter = proxy._Limiter("model:m", limit=1, queue_size=0)
+    error = proxy._Overloaded(limiter, "queue full")
+    anthropic = proxy._anthropic_overloaded(error)
+    openai = proxy._openai_overloaded(error)
+    assert anthropic.status_code == openai.status_code == 429
+    assert anthropic.headers["retry-after"] == openai.headers["retry-after"] == "1"
+    assert json.loads(anthropic.body)["error"]["type"] == "rate_limit_error"
+    assert json.loads(openai.body)["error"]["code"] == "rate_limit_exceeded"
+
+
+def test_anthropic_to_ollama_forwards_sampling_options():
+    body = {
+        "model": "m",
+        "messages": [{"role": "user", "content": "hi"}],
+        "temperature": 0,
+        "top_p": 0.9,
+        "stop_sequences": ["END"],
+    }
+    options = _anthropic_to_ollama(body)["options"]
+    assert options == {"temperature": 0, "top_p": 0.9, "stop": ["END"]}
+
+
+def test_response_cache_key_requires_deterministic_request():
+    cache = proxy._ResponseCache(True, 1024, 60)
+    base = {"model": "m", "messages": [{"role": "user", "content": "hi"}]}
+    assert cache.key({**base, "options": {"temperature": 0.7}}) is None
+    assert cache.key(base) is None
+    greedy = cache.key({**base, "stream": True, "options": {"temperature": 0}})
+    assert greedy == cache.key({**base, "stream": False, "options": {"temperature": 0}})
+    assert cache.key({**base, "options": {"seed": 42, "temperature": 0.7}}) is not None
+    assert proxy._ResponseCache(False, 1024, 60).key({**base, "options": {"temperature": 0}}) is None
+
+
+def test_response_cache_evicts_lru_by_bytes_and_expires_by_ttl(monkeypatch):
+    cache = proxy._ResponseCache(True, 150, 60)
+    entry = {"message": {"content": "x" * 40}}
+
+    async def run():
+        await cache.put("a", entry)
+        await cache.put("b", entry)
+        assert await cache.get("a") is not None
+        await cache.put("c", entry)
+        assert await cache.get("b") is None
+        assert await cache.get("a") is not None
+        now = proxy.time.time()
+        monkeypatch.setattr("proxy.time.time", lambda: now + 61)
+        assert await cache.get("a") is None
+
+    asyncio.run(run())
+    assert cache.size <= 150
+
+
+def test_response_cache_disk_tier_survives_memory_loss(tmp_path):
+    cache = proxy._ResponseCache(True, 1024, 60, str(tmp_path))
+    asyncio.run(cache.put("k", {"message": {"content": "hi"}}))
+    fresh = proxy._ResponseCache(True, 1024, 60, str(tmp_path))
+    assert asyncio.run(fresh.get("k")) == {"message": {"content": "hi"}}
+
+
+def test_response_cache_disk_hit_keeps_the_files_remaining_ttl(tmp_path):
+    cache = proxy._ResponseCache(True, 1024, 60, str(tmp_path))
+    asyncio.run(cache.put("k", {"message": {"content": "hi"}}))
+    aged = proxy.time.time() - 50
+    proxy.os.utime(tmp_path / "k.json", (aged, aged))
+    fresh = proxy._ResponseCache(True, 1024, 60, str(tmp_path))
+    assert asyncio.run(fresh.get("k")) is not None
+    assert fresh._entries["k"][0] == pytest.approx(aged + 60, abs=1)
+
+
+def _sse_data(frame):
+    return json.loads(frame.split(b"data: ", 1)[1])
+
+
+async def _chunks(items):
+    for item in items:
+        yield item
+
+
+async def _collect(agen):
+    return [item async for item in agen]
+
+
+def test_response_cache_replays_stream_as_framed_sse():
+    cache = proxy._ResponseCache(True, 4096, 60)
+    live = [
+        {"message": {"role": "assistant", "thinking": "hmm"}, "done": False},
+        {"message": {"role": "assistant", "content": "hel"}, "done": False},
+        {"message": {"role": "assistant", "content": "lo"}, "done": False},
+        {"message": {"role": "assistant", "content": ""}, "done": True, "done_reason": "stop", "prompt_eval_count": 3, "eval_count": 2},
+    ]
+    assert asyncio.run(_collect(cache.record("k", _chunks(live)))) == live
+    cached = asyncio.run(cache.get("k"))
+    assert cached["message"] == {"role": "assistant", "content": "hello", "thinking": "hmm"}
+
+    frames = asyncio.run(_collect(proxy._stream_anthropic("m", proxy._replay_chunks(cached))))
+    events = [f.split(b"\n")[0].decode() for f in frames]
+    assert events == [
+        "event: message_start", "event: content_block_start", "event: content_block_delta",
+        "event: content_block_stop", "event: content_block_start", "event: content_block_delta",
+        "event: content_block_stop", "event: message_delta", "event: message_stop",
+    ]
+    assert all(f.endswith(b"\n\n") for f in frames)
+    assert _sse_data(frames[5])["delta"]["text"] == "hello"
+    assert _sse_data(frames[7])["usage"]["output_tokens"] == 2
+
+
+_JSON_BACKENDS = [(proxy._json_bytes_std, proxy._json_str_std)]
+if proxy.orjson is not None:
+    _JSON_BACKENDS.append((proxy.orjson.dumps, proxy.orjson.dumps))
+
+
+@pytest.mark.parametrize("json_bytes,json_str", _JSON_BACKENDS)
+def test_anthropic_encoder_frames_match_reference_payloads(monkeypatch, json_bytes, json_str):
+    monkeypatch.setattr("proxy._json_bytes", json_bytes)
+    monkeypatch.setattr("proxy._json_str", json_str)
+    enc = proxy._AnthropicEncoder("msg_1", "m")
+    text = 'say "hi"\n\u00e9\u2028 \\ end'
+    frame = enc.delta(1, "text", text)
+    assert frame.startswith(b"event: content_block_delta\ndata: ")
+    assert frame.endswith(b"\n\n")
+    assert _sse_data(frame) == {
+        "type": "content_block_delta", "index": 1, "delta": {"type": "text_delta", "text": text}
+    }
+    assert _sse_data(enc.delta(0, "thinking", "t")) == {
+        "type": "content_block_delta", "index": 0, "delta": {"type": "thinking_delta", "thinking": "t"}
+    }
+    assert _sse_data(enc.block_stop(3)) == {"type": "content_block_stop", "index": 3}
+    assert _sse_data(enc.message_stop()) == {"type": "message_stop"}
+    assert _sse_data(enc.message_start())["message"]["id"] == "msg_1"
+
+
+@pytest.mark.parametrize("json_bytes,json_str", _JSON_BACKENDS)
+def test_openai_encoder_frames_match_reference_payloads(monkeypatch, json_bytes, json_str):
+    monkeypatch.setattr("proxy._json_bytes", json_bytes)
+    monkeypatch.setattr("proxy._json_str", json_str)
+    enc = proxy._OpenAIEncoder("chatcmpl-1", 'mod"el', 123)
+    head = {"id": "chatcmpl-1", "object": "chat.completion.chunk", "created": 123, "model": 'mod"el'}
+    assert _sse_data(enc.content("a\tb")) == {
+        **head, "choices": [{"index": 0, "delta": {"content": "a\tb"}, "finish_reason": None}]
+    }
+    assert _sse_data(enc.reasoning("r")) == {
+        **head, "choices": [{"index": 0, "delta": {"reasoning_content": "r"}, "finish_reason": None}]
+    }
+    final = _sse_data(enc.chunk({}, "stop", {"total_tokens": 1}))
+    assert final["choices"][0]["finish_reason"] == "stop"
+    assert final["usage"] == {"total_tokens": 1}
+    assert enc.DONE == b"data: [DONE]\n\n"
+
+
+def _tool_stream():
+    call = lambda name, args: {"function": {"name": name, "arguments": args}}
+    return [
+        {"message": {"role": "assistant", "thinking": "plan"}, "done": False},
+        {"message": {"role": "assistant", "content": "Reading"}, "done": False},
+        {"message": {"role": "assistant", "content": "", "tool_calls": [call("Read", {"path": "a.py"})]}, "done": False},
+        {"message": {"role": "assistant", "content": "", "tool_calls": [call("Read", '{"path": "b.py"}'), call("Ls", None)]}, "done": False},
+        {"message": {"role": "assistant", "content": ""}, "done": True, "done_reason": "stop", "eval_count": 9},
+    ]
+
+
+def test_stream_anthropic_opens_tool_use_blocks_incrementally_with_contiguous_indices():
+    frames = [_sse_data(f) for f in asyncio.run(_collect(proxy._stream_anthropic("m", _chunks(_tool_stream())))) if b"data: {" in f]
+    blocks = [(f["index"], f["content_block"]["type"]) for f in frames if f["type"] == "content_block_start"]
+    assert blocks == [(0, "thinking"), (1, "text"), (2, "tool_use"), (3, "tool_use"), (4, "tool_use")]
+    assert [f["index"] for f in frames if f["type"] == "content_block_stop"] == [0, 1, 2, 3, 4]
+    inputs = [f for f in frames if f["type"] == "content_block_delta" and f["delta"]["type"] == "input_json_delta"]
+    assert [(f["index"], json.loads(f["delta"]["partial_json"])) for f in inputs] == [(2, {"path": "a.py"}), (3, {"path": "b.py"}), (4, {})]
+    starts = [f for f in frames if f["type"] == "content_block_start" and f["content_block"]["type"] == "tool_use"]
+    assert all(f["content_block"]["input"] == {} and f["content_block"]["id"].startswith("toolu_") for f in starts)
+    assert frames[-2]["delta"]["stop_reason"] == "tool_use"
+    partial = asyncio.run(_collect(proxy._stream_anthropic("m", _chunks(_tool_stream()[:3]))))
+    assert b'"input_json_delta"' in partial[-2]
+
+
+def test_stream_openai_numbers_tool_calls_across_chunks():
+    frames = asyncio.run(_collect(proxy._stream_openai("m", _chunks(_tool_stream()))))
+    deltas = [_sse_data(f)["choices"][0] for f in frames[:-1]]
+    calls = [tc for d in deltas for tc in d["delta"].get("tool_calls", [])]
+    assert [(tc["index"], tc["function"]["name"], json.loads(tc["function"]["arguments"])) for tc in calls] == [
+        (0, "Read", {"path": "a.py"}), (1, "Read", {"path": "b.py"}), (2, "Ls", {})
+    ]
+    assert len({tc["id"] for tc in calls}) == 3
+    assert deltas[-1]["finish_reason"] == "tool_calls"
+    assert frames[-1] == b"data: [DONE]\n\n"
+
+
+def test_stream_openai_reports_upstream_errors_in_band():
+    async def failing():
+        yield {"message": {"content": "par"}, "done": False}
+        raise proxy._UpstreamError(502, "Upstream stream was closed before it finished")
+
+    frames = asyncio.run(_collect(proxy._stream_openai("m", failing())))
+    assert _sse_data(frames[-2])["error"]["message"] == "Upstream stream was closed before it finished"
+    assert frames[-1] == b"data: [DONE]\n\n"
+
+
+def test_response_cache_keeps_tool_calls_from_every_chunk():
+    cache = proxy._ResponseCache(True, 4096, 60)
+    asyncio.run(_collect(cache.record("k", _chunks(_tool_stream()))))
+    cached = asyncio.run(cache.get("k"))
+    assert [tc["function"]["name"] for tc in cached["message"]["tool_calls"]] == ["Read", "Read", "Ls"]
+
+
+async def _timed_chunks(items):
+    for delay, item in items:
+        if delay:
+            await asyncio.sleep(delay)
+        yield item
+
+
+def _delta(kind, text):
+    return {"message": {"role": "assistant", kind: text}, "done": False}
+
+
+def test_coalesce_flushes_first_token_then_merges_by_bytes():
+    items = [(0, _delta("content", "a"))] + [(0, _delta("content", "bc")) for _ in range(5)]
+    items.append((0, {"message": {"role": "assistant", "content": ""}, "done": True, "eval_count": 6}))
+    out = asyncio.run(_collect(proxy._coalesce(_timed_chunks(items), max_bytes=4, interval=10)))
+    assert [c["message"]["content"] for c in out] == ["a", "bcbc", "bcbc", "bc", ""]
+    assert out[-1]["done"] is True
+
+
+def test_coalesce_flushes_on_interval_and_kind_switch():
+    items = [
+        (0, _delta("thinking", "t1")),
+        (0, _delta("thinking", "t2")),
+        (0, _delta("thinking", "t3")),
+        (0, _delta("content", "c1")),
+        (0.1, _delta("content", "c2")),
+    ]
+    out = asyncio.run(_collect(proxy._coalesce(_timed_chunks(items), max_bytes=1024, interval=0.02)))
+    assert [(list(c["message"])[1], c["message"][list(c["message"])[1]]) for c in out] == [
+        ("thinking", "t1"), ("thinking", "t2t3"), ("content", "c1"), ("content", "c2"),
+    ]
+
+
+def test_coalesce_passes_tool_call_chunks_through_in_order():
+    tool_chunk = {"message": {"role": "assistant", "tool_calls": [{"function": {"name": "f"}}]}, "done": False}
+    items = [(0, _delta("content", "a")), (0, _delta("content", "b")), (0, _delta("content", "c")), (0, tool_chunk)]
+    out = asyncio.run(_collect(proxy._coalesce(_timed_chunks(items), max_bytes=1024, interval=10)))
+    assert out == [_delta("content", "a"), _delta("content", "bc"), tool_chunk]
+
+
+def test_coalesce_closes_upstream_when_client_leaves_during_pending_read():
+    pool = _backend_pool({"m:latest"})
+    closed = []
+
+    async def stalled_upstream():
+        async with pool.lease("m"):
+            try:
+                yield _delta("content", "a")
+                yield _delta("content", "b")
+                await asyncio.sleep(3600)
+                yield _delta("content", "never")
+            finally:
+                closed.append(True)
+
+    async def run():
+        coalescer = proxy._coalesce(stalled_upstream(), max_bytes=1024, interval=0.01)
+        assert (await coalescer.__anext__())["message"]["content"] == "a"
+        assert (await coalescer.__anext__())["message"]["content"] == "b"  # flushed by interval, read still pending
+        await coalescer.aclose()
+
+    asyncio.run(run())
+    assert closed == [True]
+    assert pool.backends[0].outstanding == 0
+
+
+def test_think_registry_vetoes_static_list_unlocks_opt_in_and_expires(monkeypatch):
+    registry = proxy._ThinkRegistry(60)
+    monkeypatch.setattr("proxy._think_registry", registry)
+    assert proxy._should_think("glm-5:cloud", None) is True
+    assert proxy._should_think("qwen3:14b", None) is False
+    registry.record("glm-5:cloud", False, "test")
+    registry.record("qwen3:latest", True, "test")
+    assert proxy._should_think("glm-5:cloud", True) is False
+    assert proxy._should_think("qwen3", None) is False
+    assert proxy._should_think("qwen3", True) is True
+    assert proxy._should_think("qwen3", False) is False
+    assert proxy._should_think("llama3", True) is False
+    now = proxy.time.time()
+    monkeypatch.setattr("proxy.time.time", lambda: now + 61)
+    assert registry.supports("glm-5:cloud") is None
+    assert proxy._should_think("glm-5:cloud", None) is True
+
+
+def test_think_registry_manual_invalidation(monkeypatch):
+    registry = proxy._ThinkRegistry(60)
+    monkeypatch.setattr("proxy._think_registry", registry)
+    registry.record("a:latest", False, "test")
+    registry.record("b:latest", True, "test")
+    asyncio.run(proxy.invalidate_model_capabilities("a"))
+    assert registry.supports("a") is None
+    assert registry.supports("b") is True
+    asyncio.run(proxy.invalidate_capabilities())
+    assert registry.snapshot() == {}
+
+
+_SHOW_QWEN = {
+    "capabilities": ["completion", "tools", "thinking"],
+    "details": {"family": "qwen3", "parameter_size": "14.8B", "quantization_level": "Q4_K_M"},
+    "model_info": {"general.architecture": "qwen3", "qwen3.context_length": 40960},
+}
+
+
+def _catalog_with(monkeypatch, tags, show):
+    registry = proxy._ThinkRegistry(60)
+    monkeypatch.setattr("proxy._think_registry", registry)
+    monkeypatch.setattr("proxy._http_client", _FakeAsyncGetClient({"models": tags}, show))
+    catalog = proxy._ModelCatalog(_backend_pool(set()), 60)
+    return catalog, registry
+
+
+def test_model_catalog_collects_api_show_metadata_and_thinking(monkeypatch):
+    catalog, registry = _catalog_with(
+        monkeypatch,
+        [{"name": "qwen3:14b", "digest": "d1", "size": 9}, {"name": "llama3:latest", "digest": "d2"}],
+        {"qwen3:14b": _SHOW_QWEN, "llama3:latest": {"capabilities": ["completion"]}},
+    )
+    models = asyncio.run(catalog.list())
+    assert models["qwen3:14b"]["context_length"] == 40960
+    assert models["qwen3:14b"]["quantization"] == "Q4_K_M"
+    assert models["qwen3:14b"]["capabilities"] == ["completion", "tools", "thinking"]
+    assert catalog.lookup("llama3")["id"] == "llama3:latest"
+    assert registry.supports("qwen3:14b") is True
+    assert registry.supports("llama3") is False
+
+
+def test_model_catalog_retries_failed_api_show_on_next_refresh(monkeypatch):
+    catalog, _ = _catalog_with(monkeypatch, [{"name": "qwen3:14b", "digest": "d1"}], {})
+    asyncio.run(catalog.refresh())
+    assert catalog.lookup("qwen3:14b")["context_length"] is None
+    proxy._http_client._show_data["qwen3:14b"] = _SHOW_QWEN
+    asyncio.run(catalog.refresh())
+    assert catalog.lookup("qwen3:14b")["context_length"] == 40960
+
+
+def test_model_catalog_serves_stale_while_revalidating(monkeypatch):
+    catalog, _ = _catalog_with(monkeypatch, [{"name": "a:latest"}], {})
+    refreshes = []
+    original = catalog.refresh
+
+    async def counting_refresh():
+        refreshes.append(1)
+        await original()
+
+    catalog.refresh = counting_refresh
+
+    async def run():
+        await catalog.list()
+        catalog.checked_at -= 120
+        stale = await catalog.list()
+        assert "a:latest" in stale
+        await asyncio.sleep(0)
+        await catalog._refreshing
+
+    asyncio.run(run())
+    assert len(refreshes) == 2
+
+
+def test_model_catalog_rejects_unknown_models_without_upstream_call(monkeypatch):
+    catalog, _ = _catalog_with(monkeypatch, [{"name": "a:latest"}], {})
+    asyncio.run(catalog.refresh())
+    monkeypatch.setattr("proxy._http_client", None)
+    assert asyncio.run(catalog.knows("a")) is True
+    assert asyncio.run(catalog.knows("missing:7b")) is False
+    monkeypatch.setattr("proxy.MODEL_CATALOG_REJECT_UNKNOWN", False)
+    assert asyncio.run(catalog.knows("missing:7b")) is True
+
+
+def test_model_catalog_unknown_models_share_one_recheck_and_failures_count_as_attempts(monkeypatch):
+    catalog, _ = _catalog_with(monkeypatch, [{"name": "a:latest"}], {})
+    asyncio.run(catalog.refresh())
+    sweeps = []
+
+    async def failing_sweep():
+        sweeps.append(1)
+        await asyncio.sleep(0.01)
+        return False
+
+    catalog.pool.refresh_all = failing_sweep
+
+    async def run():
+        assert await asyncio.gather(*(catalog.knows("missing:7b") for _ in range(5))) == [False] * 5
+        assert await catalog.knows("missing:7b") is False
+
+    asyncio.run(run())
+    assert len(sweeps) == 1
+
+
+def test_model_catalog_unloaded_does_not_reject(monkeypatch):
+    catalog = proxy._ModelCatalog(_backend_pool(set()), 60)
+    assert asyncio.run(catalog.knows("anything")) is True
+    assert catalog._refreshing is not None and catalog.checked_at > 0  # a load was started in the background
+
+
+def test_anthropic_thinking_param_controls_think(monkeypatch):
+    registry = proxy._ThinkRegistry(60)
+    monkeypatch.setattr("proxy._think_registry", registry)
+    base = {"model": "glm-5:cloud", "messages": [{"role": "user", "content": "hi"}]}
+    assert _anthropic_to_ollama(base)["think"] is True
+    assert "think" not in _anthropic_to_ollama({**base, "thinking": {"type": "disabled"}})
+    other = {**base, "model": "llama3:latest", "thinking": {"type": "enabled", "budget_tokens": 1024}}
+    assert "think" not in _anthropic_to_ollama(other)
+    registry.record("llama3:latest", True, "test")
+    assert _anthropic_to_ollama(other)["think"] is True
+    assert "think" not in _anthropic_to_ollama({**other, "thinking": None})
+
+
+class _FakeStreamResponse:
+    def __init__(self, status_code, lines=(), text=""):
+        self.status_code = status_code
+        self._lines = list(lines)
+        self._text = text
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+    async def aread(self):
+        return self._text.encode()
+
+    async def aiter_bytes(self):
+        for line in self._lines:
+            yield (line + "\n").encode()
+
+
+class _FakeStreamClient:
+    def __init__(self, responses):
+        self._responses = list(responses)
+        self.calls = []
+
+    def stream(self, method, url, content, headers=None, timeout=None):
+        self.calls.append(json.loads(content))
+        return self._responses.pop(0)
+
+
+def test_ollama_stream_retries_without_think_and_records_capability(monkeypatch):
+    registry = proxy._ThinkRegistry(60)
+    monkeypatch.setattr("proxy._think_registry", registry)
+    fake_client = _FakeStreamClient([
+        _FakeStreamResponse(400, text='{"error":"\\"m\\" does not support thinking"}'),
+        _FakeStreamResponse(200, lines=['{"message":{"content":"hi"},"done":false}', "", '{"done":true}']),
+    ])
+    monkeypatch.setattr("proxy._http_client", fake_client)
+    pool = _backend_pool({"m:latest"})
+    body = {"model": "m", "messages": [], "stream": True, "think": True}
+    chunks = asyncio.run(_collect(proxy._ollama_stream(body, pool.lease("m"))))
+    assert [c.get("done") for c in chunks] == [False, True]
+    assert fake_client.calls[0]["think"] is True
+    assert "think" not in fake_client.calls[1]
+    assert registry.supports("m") is False
+    assert pool.backends[0].outstanding == 0
+
+
+def test_warm_pool_keep_alive_resolution(monkeypatch):
+    monkeypatch.setattr("proxy.MODEL_KEEP_ALIVE", "10m")
+    monkeypatch.setattr("proxy.MODEL_KEEP_ALIVE_OVERRIDES", {"big:70b": "2m"})
+    warm = proxy._WarmPool(_backend_pool(set()), ["qwen3:latest"], 0)
+    assert warm.keep_alive("qwen3") == -1
+    assert warm.keep_alive("big:70b") == "2m"
+    assert warm.keep_alive("other:1b") == "10m"
+    monkeypatch.setattr("proxy.MODEL_KEEP_ALIVE_OVERRIDES", {"big:70b": "0", "mid:8b": "-1", "small:1b": "300"})
+    assert warm.keep_alive("big:70b") == 0
+    assert warm.keep_alive("mid:8b") == -1
+    assert warm.keep_alive("small:1b") == 300
+    monkeypatch.setattr("proxy.MODEL_KEEP_ALIVE", "")
+    assert warm.keep_alive("other:1b") is None
+
+
+def test_translators_inject_keep_alive(monkeypatch):
+    monkeypatch.setattr("proxy._warm_pool", proxy._WarmPool(_backend_pool(set()), ["m:latest"], 0))
+    body = {"model": "m", "messages": [{"role": "user", "content": "hi"}]}
+    assert _openai_to_ollama(body)["keep_alive"] == -1
+    assert _anthropic_to_ollama(body)["keep_alive"] == -1
+    assert "keep_alive" not in _openai_to_ollama({**body, "model": "n"})
+
+
+class _WarmPoolClient:
+    def __init__(self, running):
+        self.running = running
+        self.posts = []
+
+    async def get(self, url, **kwargs):
+        return _FakeResponse(200, json_data={"models": self.running})
+
+    async def post(self, url, json=None, **kwargs):
+        self.posts.append((url, json))
+        return _FakeResponse(200, json_data={"done": True, "load_duration": 3_000_000_000})
+
+
+def test_warm_pool_evicts_least_recently_used_cold_models_over_budget(monkeypatch):
+    gib = 1024 ** 3
+    client = _WarmPoolClient([
+        {"name": "warm:latest", "size": 6 * gib},
+        {"name": "old:latest", "size": 4 * gib},
+        {"name": "recent:latest", "size": 4 * gib},
+    ])
+    monkeypatch.setattr("proxy._http_client", client)
+    warm = proxy._WarmPool(_backend_pool(set()), ["warm:latest"], 11 * gib)
+    warm.touch("old")
+    warm.touch("recent")
+    asyncio.run(warm.poll())
+    assert client.posts == [("http://ollama-0:11434/api/generate", {"model": "old:latest", "keep_alive": 0})]
+    assert sorted(warm.resident["http://ollama-0:11434"]) == ["recent:latest", "warm:latest"]
+    assert warm.stats()["evictions"] == 1
+
+
+def test_warm_pool_preloads_configured_models_and_records_loads(monkeypatch):
+    client = _WarmPoolClient([])
+    monkeypatch.setattr("proxy._http_client", client)
+    warm = proxy._WarmPool(_backend_pool({"warm:latest"}, {"other:latest"}), ["warm:latest"], 0)
+    asyncio.run(warm.preload())
+    assert client.posts == [
+        ("http://ollama-0:11434/api/chat", {"model": "warm:latest", "messages": [], "keep_alive": -1})
+    ]
+    assert warm.loads == 1
+    assert warm.load_seconds == 3.0
+
+
+def _session(turns):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": f"t{i}", "content": [{"type": "text", "text": f"out {i}"}]},
+            {"type": "text", "text": f"turn {i}"},
+        ]})
+        messages.append({"role": "assistant", "content": [
+            {"type": "text", "text": f"ok {i}"},
+            {"type": "tool_use", "id": f"t{i + 1}", "name": "Read", "input": {}},
+        ]})
+    return {"model": "m", "system": "sys", "messages": messages, "max_tokens": 10}
+
+
+def test_translation_cache_matches_uncached_output_and_reuses_history(monkeypatch):
+    monkeypatch.setattr("proxy._translation_cache", proxy._TranslationCache(0))
+    expected = [_anthropic_to_ollama(_session(n))["messages"] for n in (3, 4)]
+    monkeypatch.setattr("proxy._translation_cache", proxy._TranslationCache(1024 * 1024))
+    first = _anthropic_to_ollama(_session(3))["messages"]
+    second = _anthropic_to_ollama(json.loads(json.dumps(_session(4))))["messages"]
+    assert [first, second] == expected
+    assert all(a is b for a, b in zip(first[1:], second[1:]))
+    assert proxy._translation_cache.hits == 6
+    assert proxy._translation_cache.misses == 8
+
+
+def test_translation_cache_keys_on_content_and_evicts_by_bytes():
+    cache = proxy._TranslationCache(400)
+    a = {"role": "user", "content": [{"type": "text", "text": "a" * 100}]}
+    b = {"role": "user", "content": [{"type": "text", "text": "b" * 100}]}
+    first = cache.translate(a)
+    assert cache.translate({**a, "id": "ignored"}) is first
+    assert cache.translate(b) == [{"role": "user", "content": "b" * 100}]
+    assert cache.size <= 400
+    assert cache.translate(a) is not first
+    assert cache.translate({"role": "user", "content": [{"type": "text", "text": "x" * 500}]})
+    assert len(cache._entries) == 1
+
+
+def test_translation_cache_does_not_confuse_values_python_hashes_alike():
+    cache = proxy._TranslationCache(1024 * 1024)
+
+    def result(content):
+        return {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "t1", "content": content}]}
+
+    for a, b in (({"exit": -1}, {"exit": -2}), ({"ok": True}, {"ok": 1}), ([1.0], [1])):
+        assert cache.translate(result(a))[0]["content"] == str(a)
+        assert cache.translate(result(b))[0]["content"] == str(b)
+
+
+_JSON_BODY_ENCODERS = [proxy._json_body_std] + ([proxy._json_body_orjson] if proxy.orjson is not None else [])
+
+
+@pytest.mark.parametrize("json_body", _JSON_BODY_ENCODERS)
+def test_encode_chat_matches_httpx_json_bytes(monkeypatch, json_body):
+    monkeypatch.setattr("proxy._json_body", json_body)
+    monkeypatch.setattr("proxy._translation_cache", proxy._TranslationCache(1024 * 1024))
+    body = _anthropic_to_ollama({**_session(3), "system": 'caf\u00e9 "quoted" \\ \u2028 \U0001f600 \x01\t</end>'})
+    body["options"] = {"temperature": 0.1, "top_p": 0.95, "seed": 2**40, "stop": ["\n\n"]}
+    body["tools"] = [{"type": "function", "function": {"name": "Read", "parameters": {"type": "object", "required": []}}}]
+    body["think"], body["keep_alive"] = True, None
+    reference = httpx.Request("POST", "http://ollama/api/chat", json=body).content
+    assert proxy._encode_chat(body) == reference
+    assert proxy._encode_chat(body) == reference  # second pass served from the wire memo
+    # orjson spells exponents without padding or sign (1e-7, not 1e-07); the value is the same
+    assert json.loads(json_body({"top_p": 1e-7})) == {"top_p": 1e-7}
+    assert json_body({"big": 2**70, 1: "k"}) == json.dumps({"big": 2**70, 1: "k"}, separators=(",", ":")).encode()
+
+
+def test_translation_cache_memoizes_wire_bytes_of_its_own_messages():
+    cache = proxy._TranslationCache(1024)
+    m = {"role": "user", "content": [{"type": "text", "text": "hi"}, {"type": "tool_result", "tool_use_id": "t", "content": "out"}]}
+    tool, text = cache.translate(m)
+    size = cache.size
+    wire = cache.wire(text)
+    assert wire == b'{"role":"user","content":"hi"}' and cache.wire(text) is wire
+    assert cache.size == size + len(wire) + len(cache.wire(tool))
+    assert cache.wire({**text}) is not wire and cache.wire({**text}) == wire
+    cache.translate({"role": "user", "content": [{"type": "text", "text": "x" * 700}]})
+    assert len(cache._entries) == 1 and id(text) not in cache._owners
+
+
+def test_read_json_decodes_raw_body():
+    assert asyncio.run(proxy._read_json(_JSONRequest({"model": "m", "messages": ["\u00e9"]}))) == {"model": "m", "messages": ["\u00e9"]}
+
+
+_JSON_LOADERS = [json.loads] + ([proxy.orjson.loads] if proxy.orjson is not None else [])
+
+
+@pytest.mark.parametrize("loads", _JSON_LOADERS)
+@pytest.mark.parametrize("fast_path", [True, False])
+def test_ndjson_parser_matches_json_loads_across_split_reads(monkeypatch, loads, fast_path):
+    monkeypatch.setattr("proxy._json_loads", loads)
+    head = {"model": "m", "created_at": "2025-01-01T00:00:00Z"}
+    lines = [
+        {**head, "message": {"role": "assistant", "content": "plain"}, "done": False},
+        {**head, "message": {"role": "assistant", "content": 'say "hi"\né \\'}, "done": False},
+        {**head, "message": {"role": "assistant", "content": "", "thinking": "hmm\t "}, "done": False},
+        {**head, "message": {"role": "assistant", "content": "a", "thinking": "b"}, "done": False},
+        {**head, "message": {"role": "assistant", "content": "", "tool_calls": [{"function": {"name": "f", "arguments": {}}}]}, "done": False},
+        {**head, "message": {"role": "assistant", "content": ""}, "done": True, "eval_count": 4},
+    ]
+    raw = b"".join(json.dumps(l, ensure_ascii=False, separators=(",", ":")).encode() + b"\n\n" for l in lines)
+    parser = proxy._NDJSONParser(fast_path)
+    chunks = []
+    for i in range(0, len(raw), 5):
+        chunks += parser.feed(raw[i:i + 5])
+    chunks += parser.close()
+    assert [c["message"] for c in chunks] == [l["message"] for l in lines]
+    assert [c["done"] for c in chunks] == [l["done"] for l in lines]
+    assert chunks[-1] == lines[-1]
+    assert (chunks[0] == lines[0]) is not fast_path
+    assert proxy._NDJSONParser(fast_path).feed(b'{"done":true}') == []
+
+
+def test_ndjson_parser_close_flushes_unterminated_last_line():
+    parser = proxy._NDJSONParser()
+    assert parser.feed(b'{"done":false}\n{"done":') == [{"done": False}]
+    assert parser.feed(b"true}") == []
+    assert parser.close() == [{"done": True}]
+    assert parser.close() == []
+
+
+def test_single_flight_is_opt_in_per_model_and_keys_on_translated_body():
+    flight = proxy._SingleFlight(["qwen3"])
+    body = {"model": "qwen3", "messages": [{"role": "user", "content": "hi"}], "stream": True}
+    assert flight.key({**body, "model": "llama3"}) is None
+    assert flight.key(body) == flight.key({**body, "keep_alive": "5m"})
+    assert flight.key(body) != flight.key({**body, "stream": False})
+    assert proxy._SingleFlight(["*"]).key({**body, "model": "llama3"}) is not None
+
+
+def test_single_flight_shares_one_non_streaming_call():
+    flight = proxy._SingleFlight(["*"])
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "response"
+
+    async def run():
+        return await asyncio.gather(*(flight.call("k", fetch) for _ in range(3)))
+
+    assert asyncio.run(run()) == ["response"] * 3
+    assert calls == [1]
+    assert flight.stats() == {"models": ["*"], "in_flight": 0, "leaders": 1, "shared": 2}
+
+
+def test_single_flight_stream_fans_out_prefix_then_live_tail():
+    flight = proxy._SingleFlight(["*"])
+    released, opened = [], []
+    gate = None
+
+    async def upstream():
+        for i in range(4):
+            if i == 2: await gate.wait()
+            yield {"message": {"content": str(i)}, "done": i == 3}
+
+    async def start():
+        opened.append(1)
+        return upstream(), lambda: released.append(1)
+
+    async def run():
+        nonlocal gate
+        gate = asyncio.Event()
+        leader = await flight.stream("k", start)
+        seen = [await leader.__anext__(), await leader.__anext__()]
+        follower = await flight.stream("k", start)
+        gate.set()
+        leader_rest, follower_all = await asyncio.gather(_collect(leader), _collect(follower))
+        return seen + leader_rest, follower_all
+
+    leader_chunks, follower_chunks = asyncio.run(run())
+    assert [c["message"]["content"] for c in leader_chunks] == ["0", "1", "2", "3"]
+    assert follower_chunks == leader_chunks
+    assert opened == [1] and released == [1]
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_single_flight_stream_shares_overload_and_closes_when_abandoned():
+    flight = proxy._SingleFlight(["*"])
+    limiter = proxy._Limiter("model:m", limit=1, queue_size=0)
+    closed, released = [], []
+
+    async def overloaded():
+        await asyncio.sleep(0.01)
+        raise proxy._Overloaded(limiter, "queue full")
+
+    async def endless():
+        try:
+            while True:
+                await asyncio.sleep(0)
+                yield {"message": {"content": "x"}, "done": False}
+        finally:
+            closed.append(1)
+
+    async def start():
+        return endless(), lambda: released.append(1)
+
+    async def run():
+        results = await asyncio.gather(flight.stream("a", overloaded), flight.stream("a", overloaded), return_exceptions=True)
+        assert all(isinstance(r, proxy._Overloaded) for r in results)
+        chunks = await flight.stream("b", start)
+        await chunks.__anext__()
+        await chunks.aclose()
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert closed == [1] and released == [1]
+
+
+def test_single_flight_follower_counts_from_join_when_leader_leaves_first():
+    flight = proxy._SingleFlight(["*"])
+    gate = None
+
+    async def upstream():
+        for i in range(3):
+            if i == 1: await gate.wait()
+            yield {"message": {"content": str(i)}, "done": i == 2}
+
+    async def start():
+        return upstream(), lambda: None
+
+    async def run():
+        nonlocal gate
+        gate = asyncio.Event()
+        leader = await flight.stream("k", start)
+        await leader.__anext__()
+        follower = await flight.stream("k", start)
+        await leader.aclose()  # before the follower's first __anext__
+        await asyncio.sleep(0.01)
+        gate.set()
+        return await _collect(follower)
+
+    chunks = asyncio.run(run())
+    assert [c["message"]["content"] for c in chunks] == ["0", "1", "2"]
+    assert chunks[-1]["done"] is True
+
+
+def test_single_flight_stream_survives_leader_leaving_during_admission():
+    flight = proxy._SingleFlight(["*"])
+    admitted, released = None, []
+
+    async def upstream():
+        yield {"message": {"content": "ok"}, "done": True}
+
+    async def start():
+        await admitted.wait()
+        return upstream(), lambda: released.append(1)
+
+    async def run():
+        nonlocal admitted
+        admitted = asyncio.Event()
+        leader = asyncio.ensure_future(flight.stream("k", start))
+        follower = asyncio.ensure_future(flight.stream("k", start))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        await asyncio.sleep(0.01)
+        admitted.set()
+        return await _collect(await follower)
+
+    chunks = asyncio.run(run())
+    assert [c["message"]["content"] for c in chunks] == ["ok"]
+    assert released == [1] and flight.stats()["in_flight"] == 0
+
+
+def test_single_flight_stream_start_is_cancelled_when_every_waiter_leaves():
+    flight = proxy._SingleFlight(["*"])
+    cancelled = []
+
+    async def start():
+        try:
+            await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def run():
+        waiters = [asyncio.ensure_future(flight.stream("k", start)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for waiter in waiters: waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        assert cancelled == [1] and flight.stats()["in_flight"] == 0
+
+    asyncio.run(run())
+
+
+def test_broadcast_closed_by_cancellation_fails_later_subscribers():
+    async def endless():
+        while True:
+            await asyncio.sleep(0)
+            yield {"message": {"content": "x"}, "done": False}
+
+    async def run():
+        broadcast = proxy._Broadcast(endless(), lambda: None)
+        first = broadcast.subscribe()
+        await first.__anext__()
+        await first.aclose()
+        await asyncio.sleep(0.01)
+        with pytest.raises(proxy._UpstreamError):
+            await _collect(broadcast.subscribe())
+
+    asyncio.run(run())
+
+
+def test_single_flight_call_is_cancelled_when_its_last_waiter_leaves():
+    flight = proxy._SingleFlight(["*"])
+    cancelled = []
+
+    async def fetch():
+        try:
+            await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def run():
+        waiters = [asyncio.ensure_future(flight.call("k", fetch)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        waiters[0].cancel()
+        await asyncio.sleep(0.01)
+        assert cancelled == []
+        waiters[1].cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        assert cancelled == [1]
+
+    asyncio.run(run())
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_histogram_renders_cumulative_prometheus_buckets():
+    histogram = proxy._Histogram("x_seconds", "help text", ("model",), (0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(('q"wen\\3',), value)
+    assert histogram.render() == [
+        "# HELP x_seconds help text",
+        "# TYPE x_seconds histogram",
+        'x_seconds_bucket{model="q\\"wen\\\\3",le="0.1"} 2',
+        'x_seconds_bucket{model="q\\"wen\\\\3",le="1.0"} 3',
+        'x_seconds_bucket{model="q\\"wen\\\\3",le="+Inf"} 4',
+        'x_seconds_sum{model="q\\"wen\\\\3"} 3.65',
+        'x_seconds_count{model="q\\"wen\\\\3"} 4',
+    ]
+
+
+def test_metrics_track_stream_timings_from_done_chunk(monkeypatch):
+    clock = iter([10.0, 10.5, 12.0])
+    monkeypatch.setattr("proxy.time", type("Clock", (), {"monotonic": staticmethod(lambda: next(clock))}))
+    metrics = proxy._Metrics()
+    labels = ("qwen3", "/v1/messages", "true")
+    done = {
+        "done": True, "eval_count": 30, "eval_duration": 1_500_000_000, "total_duration": 1_900_000_000,
+        "load_duration": 100_000_000, "prompt_eval_duration": 200_000_000,
+    }
+    chunks = [{"message": {"content": ""}, "done": False}, {"message": {"content": "hi"}, "done": False}, done]
+    started = proxy.time.monotonic()
+    assert asyncio.run(_collect(metrics.track(labels, started, _chunks(chunks)))) == chunks
+    assert metrics.ttft.series[labels][1] == 0.5
+    assert metrics.duration.series[labels][1] == 2.0
+    assert metrics.tokens_per_second.series[labels][1] == 20.0
+    assert metrics.overhead.series[labels][1] == pytest.approx(0.1)
+    assert metrics.load.series[labels][1] == 0.1
+    text = metrics.render()
+    assert 'adapter_output_tokens_per_second_bucket{model="qwen3",endpoint="/v1/messages",stream="true",le="20.0"} 1' in text
+    assert "# TYPE ollama_prompt_eval_duration_seconds histogram" in text
+
+
+def test_metrics_non_streaming_ttft_excludes_generation_and_endpoint_serves_text(monkeypatch):
+    monkeypatch.setattr("proxy._metrics", proxy._Metrics())
+    now = proxy.time.monotonic()
+    proxy._metrics.observe(("m", "/v1/chat/completions", "false"), now - 3.0, None, {"eval_duration": 2_000_000_000})
+    ttft = proxy._metrics.ttft.series[("m", "/v1/chat/completions", "false")][1]
+    assert ttft == pytest.approx(1.0, abs=0.05)
+    resp = asyncio.run(proxy.metrics())
+    assert resp.media_type.startswith("text/plain; version=0.0.4")
+    assert b'adapter_request_duration_seconds_count{model="m",endpoint="/v1/chat/completions",stream="false"} 1' in resp.body
+
+
+def test_traffic_capture_samples_and_records_stream_timings(monkeypatch, tmp_path):
+    path = str(tmp_path / "capture.jsonl")
+    assert proxy._TrafficCapture("", 1.0, 1024, 1).start("/v1/messages", {}, {}) is None
+    assert proxy._TrafficCapture(path, 0.0, 1024, 1).start("/v1/messages", {}, {}) is None
+    capture = proxy._TrafficCapture(path, 1.0, 1 << 20, 1)
+    body = {"model": "m", "stream": True, "messages": []}
+    entry = capture.start("/v1/messages", body, {"model": "m", "messages": []})
+    chunks = [{"message": {"content": "a"}, "done": False}, {"done": True, "eval_count": 2, "prompt_eval_count": 5}]
+    started = proxy.time.monotonic()
+    assert asyncio.run(_collect(capture.track(entry, started, _chunks(chunks)))) == chunks
+    asyncio.run(capture.flush())
+    with open(path) as f:
+        record = json.loads(f.read())
+    assert record["request"] == body and record["ollama_request"]["model"] == "m"
+    assert record["outcome"] == "ok" and record["status"] == 200
+    assert len(record["chunk_ms"]) == 2 and record["chunk_ms"][0] <= record["chunk_ms"][1]
+    assert record["usage"] == {"eval_count": 2, "prompt_eval_count": 5}
+
+
+def test_traffic_capture_batches_rotates_and_drops_when_full(tmp_path):
+    path = str(tmp_path / "capture.jsonl")
+    capture = proxy._TrafficCapture(path, 1.0, 300, 2, max_pending=3)
+    started = proxy.time.monotonic()
+    for round_ in range(4):
+        for i in range(4):
+            capture.finish({"n": round_, "pad": "x" * 40}, "ok", started)
+        asyncio.run(capture.flush())
+    assert capture.captured == 12 and capture.dropped == 4
+    files = sorted(p.name for p in tmp_path.iterdir())
+    assert files == ["capture.jsonl", "capture.jsonl.1", "capture.jsonl.2"]
+    with open(path) as f:
+        assert [json.loads(line)["n"] for line in f] == [3, 3, 3]
+
+
+def _tool_session(results):
+    messages = []
+    for i, text in enumerate(results):
+        messages.append({"role": "assistant", "content": [{"type": "tool_use", "id": f"t{i}", "name": "Read", "input": {}}]})
+        messages.append({"role": "user", "content": [{"type": "tool_result", "tool_use_id": f"t{i}", "content": text}]})
+    return {"model": "m", "max_tokens": 1000, "messages": [{"role": "user", "content": "go"}] + messages}
+
+
+def test_fit_context_trims_old_tool_results_and_picks_num_ctx_bucket(monkeypatch):
+    monkeypatch.setattr("proxy.CONTEXT_COMPACTION", "trim")
+    monkeypatch.setattr("proxy.CONTEXT_TOOL_RESULT_MAX_TOKENS", 100)
+    monkeypatch.setattr("proxy.CONTEXT_KEEP_RECENT", 2)
+    monkeypatch.setattr("proxy.NUM_CTX_BUCKETS", [2048, 4096, 8192, 16384])
+    monkeypatch.setattr(proxy._catalog, "models", {"m": {"id": "m", "context_length": 8192}})
+    body = _tool_session(["a" * 12000, "b" * 8000, "c" * 8000, "d" * 8000])
+    translated = _anthropic_to_ollama(body)
+    shared = list(translated["messages"])
+    fitted = proxy._fit_context(_anthropic_to_ollama(body))
+
+    tools = [m for m in fitted["messages"] if m["role"] == "tool"]
+    assert tools[0]["content"].startswith("a" * 266) and "11601 characters trimmed" in tools[0]["content"]
+    assert tools[0]["content"].endswith("a" * 133) and tools[0]["tool_call_id"] == "t0"
+    assert [len(m["content"]) for m in tools[1:]] == [8000] * 3
+    assert [len(m["content"]) for m in shared if m["role"] == "tool"] == [12000, 8000, 8000, 8000]
+    assert fitted["options"] == {"num_predict": 1000, "num_ctx": 8192}
+
+
+def test_fit_context_elides_only_over_budget_and_respects_client_num_ctx(monkeypatch):
+    monkeypatch.setattr("proxy.CONTEXT_COMPACTION", "elide")
+    monkeypatch.setattr("proxy.CONTEXT_KEEP_RECENT", 0)
+    monkeypatch.setattr("proxy.NUM_CTX_BUCKETS", [4096, 32768])
+    monkeypatch.setattr(proxy._catalog, "models", {"m": {"id": "m", "context_length": 8192}})
+    small = proxy._fit_context(_anthropic_to_ollama(_tool_session(["x" * 4000])))
+    assert small["messages"][-1]["content"] == "x" * 4000
+    assert small["options"]["num_ctx"] == 4096
+
+    big = proxy._fit_context(_anthropic_to_ollama(_tool_session(["x" * 40000, "y" * 100])))
+    assert big["messages"][1]["content"] == "[tool result elided: 40000 characters]"
+    assert big["messages"][-1]["content"] == "y" * 100
+    assert big["options"]["num_ctx"] == 4096
+
+    monkeypatch.setattr(proxy._catalog, "models", {})
+    body = _openai_to_ollama({"model": "m", "messages": [{"role": "user", "content": "z" * 200000}]})
+    body["options"] = {"num_ctx": 2048}
+    assert proxy._fit_context(body)["options"] == {"num_ctx": 2048}
+    assert proxy._fit_context(_openai_to_ollama({"model": "m", "messages": [{"role": "user", "content": "z" * 200000}]}))["options"]["num_ctx"] == 32768
+
+
+class _FakeRequest:
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+        self.gone = asyncio.Event()
+
+    async def receive(self):
+        await self.gone.wait()
+        return {"type": "http.disconnect"}
+
+
+class _JSONRequest:
+    url = httpx.URL("http://adapter/")
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    async def body(self):
+        return json.dumps(self.payload).encode()
+
+
+def test_request_timeout_reads_first_valid_header_and_caps_it(monkeypatch):
+    monkeypatch.setattr("proxy.REQUEST_TIMEOUT_MAX", 900)
+    assert proxy._request_timeout({}) == (None, False)
+    assert proxy._request_timeout({"x-stainless-timeout": "600"}) == (600, False)
+    assert proxy._request_timeout({"x-request-timeout": "abc", "x-stainless-timeout": "30.5"}) == (30.5, False)
+    assert proxy._request_timeout({"x-request-timeout": "86400", "x-stainless-timeout": "600"}) == (900, True)
+    assert proxy._request_timeout({"x-request-timeout": "inf"}) == (None, False)
+
+
+def test_client_guard_closes_upstream_stream_on_disconnect(monkeypatch):
+    monkeypatch.setattr("proxy._metrics", proxy._Metrics())
+    closed = []
+
+    async def upstream():
+        try:
+            yield _delta("content", "a")
+            yield _delta("content", "b")
+            await asyncio.sleep(60)
+            yield {"message": {}, "done": True}
+        finally:
+            closed.append(True)
+
+    async def run():
+        request = _FakeRequest()
+        guard = proxy._ClientGuard(request, ("m", "/v1/messages", "true"), {"options": {"num_predict": 100}}, proxy.time.monotonic())
+        got = []
+        async for chunk in guard.stream(upstream()):
+            got.append(chunk)
+            if len(got) == 2: request.gone.set()
+        await asyncio.sleep(0)
+        return got
+
+    assert len(asyncio.run(run())) == 2
+    assert closed == [True]
+    assert proxy._metrics.cancelled.series == {("m", "/v1/messages", "true", "disconnect"): 1}
+    assert proxy._metrics.tokens_saved.series == {("m", "/v1/messages", "true"): 98}
+    assert "adapter_cancelled_tokens_saved_total{model=\"m\"" in proxy._metrics.render()
+
+
+def test_client_guard_enforces_header_deadline_for_calls_and_streams(monkeypatch):
+    monkeypatch.setattr("proxy._metrics", proxy._Metrics())
+    labels = ("m", "/v1/chat/completions", "false")
+
+    async def stalled():
+        yield _delta("content", "a")
+        await asyncio.sleep(60)
+
+    async def run():
+        request = _FakeRequest({"x-request-timeout": "0.05"})
+        guard = proxy._ClientGuard(request, labels, {}, proxy.time.monotonic())
+        assert guard.timeout.read == 0.05
+        with pytest.raises(proxy._Cancelled) as e:
+            await guard.call(asyncio.sleep(60))
+        assert e.value.reason == "deadline"
+
+        guard = proxy._ClientGuard(request, labels, {}, proxy.time.monotonic())
+        got = []
+        with pytest.raises(httpx.ReadTimeout):
+            async for chunk in guard.stream(stalled()):
+                got.append(chunk)
+        assert len(got) == 1
+        assert await proxy._ClientGuard(_FakeRequest(), labels, {}, proxy.time.monotonic()).call(asyncio.sleep(0, "ok")) == "ok"
+
+    asyncio.run(run())
+    assert proxy._metrics.cancelled.series == {labels + ("deadline",): 2}
+    assert proxy._metrics.tokens_saved.series == {}
+
+
+def test_client_guard_stainless_timeout_bounds_reads_not_a_live_stream(monkeypatch):
+    monkeypatch.setattr("proxy._metrics", proxy._Metrics())
+    labels = ("m", "/v1/messages", "true")
+
+    async def steady():
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+            yield _delta("content", "a")
+        yield {"message": {}, "done": True}
+
+    async def run():
+        guard = proxy._ClientGuard(_FakeRequest({"x-stainless-timeout": "0.03"}), labels, {}, proxy.time.monotonic())
+        assert guard.timeout.read == 0.03 and guard.deadline is None
+        return [chunk async for chunk in guard.stream(steady())]
+
+    chunks = asyncio.run(run())
+    assert len(chunks) == 11 and chunks[-1]["done"] is True
+    assert proxy._metrics.cancelled.series == {}
+
+
+class _FakeEmbedClient:
+    def __init__(self):
+        self.calls = []
+
+    async def post(self, url, json=None, **kwargs):
+        self.calls.append(json["input"])
+        await asyncio.sleep(0)
+        request = httpx.Request("POST", url)
+        if "bad" in json["input"]:
+            return httpx.Response(400, json={"error": "bad input"}, request=request)
+        return httpx.Response(200, request=request, json={
+            "embeddings": [[float(len(text)), 0.5] for text in json["input"]],
+            "prompt_eval_count": sum(len(text) for text in json["input"]),
+        })
+
+
+def test_embed_batcher_coalesces_requests_by_size_and_window(monkeypatch):
+    client = _FakeEmbedClient()
+    monkeypatch.setattr("proxy._client", lambda: client)
+    batcher = proxy._EmbedBatcher(4, 0.01, 1)
+    body = {"model": "nomic-embed-text"}
+    requests = [["a"], ["bb", "ccc"], ["dddd"], ["e"], ["f"] * 5, ["g"]]
+
+    async def run():
+        first = await asyncio.gather(*(batcher.embed(body, inputs) for inputs in requests[:5]))
+        return first + [await batcher.embed(body, requests[5])]
+
+    results = asyncio.run(run())
+    assert client.calls == [["a", "bb", "ccc", "dddd"], ["e"], ["f"] * 5, ["g"]]
+    assert [vectors for vectors, _ in results] == [[[len(t), 0.5] for t in inputs] for inputs in requests]
+    assert [tokens for _, tokens in results] == [1, 5, 4, 1, 5, 1]
+    assert batcher.stats() == {
+        "max_inputs": 4, "window": 0.01, "concurrency": 1, "requests": 6, "batches": 4, "inputs": 11, "pending": 0,
+    }
+
+
+def test_embed_batcher_keeps_filling_while_a_call_is_in_flight(monkeypatch):
+    client = _FakeEmbedClient()
+    release = None
+
+    async def post(url, json=None, **kwargs):
+        if not client.calls: await release.wait()
+        return await _FakeEmbedClient.post(client, url, json)
+
+    monkeypatch.setattr(client, "post", post)
+    monkeypatch.setattr("proxy._client", lambda: client)
+    batcher = proxy._EmbedBatcher(64, 0.001, 1)
+
+    async def run():
+        nonlocal release
+        release = asyncio.Event()
+        first = asyncio.ensure_future(batcher.embed({"model": "m"}, ["a"]))
+        await asyncio.sleep(0.01)
+        rest = [asyncio.ensure_future(batcher.embed({"model": "m"}, [t])) for t in "bcd"]
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(first, *rest)
+
+    asyncio.run(run())
+    assert client.calls == [["a"], ["b", "c", "d"]]
+
+
+def test_embed_batcher_isolates_a_failing_request(monkeypatch):
+    client = _FakeEmbedClient()
+    monkeypatch.setattr("proxy._client", lambda: client)
+    batcher = proxy._EmbedBatcher(16, 0.01, 1)
+
+    async def run():
+        return await asyncio.gather(*(batcher.embed({"model": "m"}, [text]) for text in ("ok", "bad")), return_exceptions=True)
+
+    good, bad = asyncio.run(run())
+    assert good == ([[2.0, 0.5]], 2)
+    assert isinstance(bad, proxy._UpstreamError) and bad.status_code == 400
+    assert client.calls == [["ok", "bad"], ["ok"], ["bad"]]
+
+
+def test_embeddings_endpoint_returns_openai_list_and_base64(monkeypatch):
+    monkeypatch.setattr("proxy._client", lambda: _FakeEmbedClient())
+    monkeypatch.setattr("proxy._embed_batcher", proxy._EmbedBatcher(64, 0, 1))
+
+    resp = asyncio.run(proxy.embeddings(_JSONRequest({"model": "m", "input": ["hi", "there"]})))
+    payload = json.loads(resp.body)
+    assert payload["object"] == "list" and payload["usage"] == {"prompt_tokens": 7, "total_tokens": 7}
+    assert [(d["index"], d["embedding"]) for d in payload["data"]] == [(0, [2.0, 0.5]), (1, [5.0, 0.5])]
+
+    resp = asyncio.run(proxy.embeddings(_JSONRequest({"model": "m", "input": "hi", "encoding_format": "base64"})))
+    encoded = json.loads(resp.body)["data"][0]["embedding"]
+    assert list(struct.unpack("<2f", base64.b64decode(encoded))) == [2.0, 0.5]
+
+    resp = asyncio.run(proxy.embeddings(_JSONRequest({"model": "m", "input": [[1, 2, 3]]})))
+    assert resp.status_code == 400 and json.loads(resp.body)["error"]["param"] == "input"
+
+
+def test_model_router_aliases_exact_names_then_patterns():
+    router = proxy._ModelRouter({"claude-*haiku*": "qwen3:4b", "claude-sonnet-4-5": "qwen3-coder:30b", "claude-*": "qwen3:14b"}, "", 0, 0, False)
+    assert router.alias("claude-sonnet-4-5") == "qwen3-coder:30b"
+    assert router.alias("claude-3-5-haiku-20241022") == "qwen3:4b"
+    assert router.alias("claude-opus-4-1-20250805") == "qwen3:14b"
+    assert router.alias("llama3") == "llama3"
+    assert router.downgrade_model == ""
+    assert not proxy._ModelRouter({}, "qwen3:4b", 0, 0, False).enabled
+
+
+def test_model_router_downgrades_lightweight_requests_and_reports_route(monkeypatch):
+    monkeypatch.setattr("proxy._metrics", proxy._Metrics())
+    router = proxy._ModelRouter({"claude-*": "qwen3:14b"}, "qwen3:4b", 512, 200, False)
+    base = {"model": "claude-sonnet-4-5", "messages": [{"role": "user", "content": "Write a title"}]}
+
+    ollama_body, route = router.route({**base, "max_tokens": 32}, _anthropic_to_ollama)
+    assert (ollama_body["model"], router.accept(route)) == ("qwen3:4b", {"X-Model-Route": "downgrade; model=qwen3:4b"})
+    assert ollama_body["options"] == {"num_predict": 32}
+
+    tools = [{"name": "Read", "input_schema": {"type": "object"}}]
+    for body in ({**base, "max_tokens": 4096}, {**base, "max_tokens": 32, "tools": tools},
+                 {**base, "max_tokens": 32, "messages": [{"role": "user", "content": "x" * 4000}]}, base):
+        ollama_body, route = router.route(body, _anthropic_to_ollama)
+        assert (ollama_body["model"], router.accept(route)) == ("qwen3:14b", {"X-Model-Route": "alias; model=qwen3:14b"})
+
+    ollama_body, route = router.route({"model": "llama3", "messages": [], "max_tokens": 4096}, proxy._openai_to_ollama)
+    assert (ollama_body["model"], router.accept(route)) == ("llama3", {"X-Model-Route": "passthrough; model=llama3"})
+    assert proxy._metrics.routes.series == {
+        ("claude-*", "qwen3:4b", "downgrade"): 1, ("claude-*", "qwen3:14b", "alias"): 4,
+        ("", "llama3", "passthrough"): 1,
+    }
+    assert proxy._ModelRouter({}, "qwen3:4b", 512, 0, True).downgrade({"model": "m", "tools": [{}], "options": {"num_predict": 1}}) == "qwen3:4b"
+
+
+def _true_prompt_tokens(ollama_body):
+    """Stand-in for a real tokenizer: long words split every 5 characters, plus chat-template tokens."""
+    total = 3
+    for m in ollama_body["messages"]:
+        total += 5 + sum(-(-len(piece) // 5) if piece[0].isalnum() else 1 for piece in proxy._TOKEN_PIECES.findall(m["content"]))
+    return total
+
+
+def test_token_counter_calibrates_against_observed_prompt_eval_count(record_property):
+    import random
+
+    rng = random.Random(0)
+    with open(proxy.__file__) as f:
+        source = f.read()
+    with open(proxy.os.path.join(proxy.os.path.dirname(proxy.__file__), "README.md")) as f:
+        prose = f.read()
+
+    def prompt():
+        turns = []
+        for role in ("system", "user", "assistant", "user")[: rng.randint(2, 4)]:
+            text = rng.choice((source, prose))
+            start = rng.randrange(len(text) - 4000)
+            turns.append({"role": role, "content": text[start:start + rng.randint(200, 4000)]})
+        return {"model": "m", "messages": turns}
+
+    counter = proxy._TokenCounter()
+    for _ in range(40):
+        body = prompt()
+        counter.observe(body, {"prompt_eval_count": _true_prompt_tokens(body)})
+        counter.observe(body, {"prompt_eval_count": 12})  # prompt cache hit: ignored
+    assert counter.samples == {"m:latest": 40} and counter.skipped == 40
+
+    errors = []
+    for _ in range(100):
+        body = prompt()
+        actual = _true_prompt_tokens(body)
+        errors.append(abs(counter.count(body) - actual) / actual)
+    mean_error = sum(errors) / len(errors)
+    record_property("count_tokens_mean_abs_error", round(mean_error, 4))
+    assert mean_error < 0.08
+    assert sorted(errors)[94] < 0.15
+
+
+def test_token_counter_memoizes_messages_so_history_is_costed_once(monkeypatch):
+    counter = proxy._TokenCounter(max_entries=3)
+    scans = []
+    monkeypatch.setattr("proxy._TOKEN_PIECES", type("P", (), {"findall": lambda self, text: scans.append(text) or text.split()})())
+    history = [{"role": "user", "content": "one two"}, {"role": "assistant", "content": "three"}]
+    assert counter.pieces({"messages": history}) == 3 + 2 * proxy._MESSAGE_OVERHEAD_TOKENS
+    history.append({"role": "user", "content": "four five six"})
+    assert counter.pieces({"messages": history}) == 6 + 3 * proxy._MESSAGE_OVERHEAD_TOKENS
+    assert scans == ["one two", "three", "four five six"]
+    counter.pieces({"messages": history + [{"role": "user", "content": "seven"}]})
+    assert len(counter._memo) == 3 and ("user", 7, hash("one two")) not in counter._memo
+
+
+def test_count_tokens_endpoint_uses_routed_model_calibration(monkeypatch):
+    counter = proxy._TokenCounter()
+    counter.ratios["qwen3:14b"] = 2.0
+    monkeypatch.setattr("proxy._token_counter", counter)
+    monkeypatch.setattr("proxy._router", proxy._ModelRouter({"claude-*": "qwen3:14b"}, "", 0, 0, False))
+    monkeypatch.setattr("proxy._metrics", proxy._Metrics())
+
+    body = {"model": "claude-sonnet-4-5", "system": "Be brief.", "messages": [{"role": "user", "content": "Hello, world"}]}
+    resp = asyncio.run(proxy.count_tokens(_JSONRequest(body)))
+    pieces = counter.pieces(_anthropic_to_ollama({**body, "model": "qwen3:14b"}))
+    assert json.loads(resp.body) == {"input_tokens": 2 * pieces}
+    assert resp.headers["x-model-route"] == "alias; model=qwen3:14b"
+
+
+def test_model_routes_are_counted_after_catalog_check_with_bounded_labels(monkeypatch):
+    catalog = proxy._ModelCatalog(_backend_pool(set()), 60)
+    catalog.models, catalog.loaded, catalog.checked_at = {"qwen3:14b": {"id": "qwen3:14b"}}, True, proxy.time.time()
+    monkeypatch.setattr("proxy._catalog", catalog)
+    monkeypatch.setattr("proxy._router", proxy._ModelRouter({"claude-*": "qwen3:14b"}, "", 0, 0, False))
+    monkeypatch.setattr("proxy._metrics", proxy._Metrics())
+
+    for i in range(3):
+        resp = asyncio.run(proxy.count_tokens(_JSONRequest({"model": f"random-{i}", "messages": []})))
+        assert resp.status_code == 404
+    # count_tokens reports the route but is not a routed request
+    resp = asyncio.run(proxy.count_tokens(_JSONRequest({"model": "claude-sonnet-4-5", "messages": []})))
+    assert resp.headers["x-model-route"] == "alias; model=qwen3:14b"
+    assert proxy._metrics.routes.series == {}
+    for model in ("claude-sonnet-4-5", "claude-opus-4-1"):
+        _, decision = proxy._router.route({"model": model, "messages": []}, _anthropic_to_ollama)
+        assert proxy._router.accept(decision) == {"X-Model-Route": "alias; model=qwen3:14b"}
+    assert proxy._metrics.routes.series == {("claude-*", "qwen3:14b", "alias"): 2}
+
+
+def test_metrics_snapshots_merge_across_workers():
+    workers = [proxy._Metrics(), proxy._Metrics()]
+    for i, m in enumerate(workers):
+        m.queue_wait.observe(("m",), 0.001 * (i + 1))
+        m.routes.inc(("a", "b", "alias"), i + 1)
+    merged = proxy._Metrics()
+    for m in workers:
+        merged.merge(json.loads(json.dumps(m.snapshot())))
+    counts, total, count = merged.queue_wait.series[("m",)]
+    assert (sum(counts), round(total, 6), count) == (2, 0.003, 2)
+    assert merged.routes.series == {("a", "b", "alias"): 3}
+    assert 'adapter_queue_wait_seconds_count{model="m"} 2' in merged.render()
+
+
+def _coordinated(monkeypatch, scenario):
+    """Runs scenario(coordinator, connect) against a coordinator on a temporary Unix socket."""
+    import shutil
+    import tempfile
+
+    directory = tempfile.mkdtemp(prefix="coord")
+    coordinator = proxy._Coordinator(proxy.os.path.join(directory, "c.sock"))
+
+    async def main():
+        server = await coordinator.listen()
+        clients = []
+
+        async def connect():
+            client = proxy._CoordinatorClient(coordinator.path)
+            await client.connect()
+            clients.append(client)
+            return client
+
+        try:
+            await scenario(coordinator, connect)
+        finally:
+            for client in clients: await client.close()
+            server.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_coordinator_enforces_limits_across_workers_and_frees_slots_of_lost_workers(monkeypatch):
+    monkeypatch.setattr("proxy.ADMISSION_MODEL_CONCURRENCY", 1)
+    pool = _backend_pool({"m:latest"})
+    monkeypatch.setattr("proxy._backends", pool)
+    monkeypatch.setattr("proxy._admission", proxy._Admission(pool))
+    monkeypatch.setattr("proxy._warm_pool", proxy._WarmPool(pool, [], 0))
+    limiter = lambda: proxy._admission.limiters["model:m:latest"]
+
+    async def scenario(coordinator, connect):
+        a, b = await connect(), await connect()
+        granted = await a.call("admit", model="m")
+        assert granted["backend"] == "http://ollama-0:11434"
+        waiting = asyncio.create_task(b.call("admit", model="m"))
+        await asyncio.sleep(0.05)
+        assert not waiting.done() and limiter().stats()["queued"] == 1
+
+        # A worker that gives up while queued leaves the queue
+        waiting.cancel()
+        await asyncio.sleep(0.05)
+        assert limiter().stats()["queued"] == 0
+
+        # A worker that dies hands its slot to the next one in line
+        waiting = asyncio.create_task(b.call("admit", model="m"))
+        await asyncio.sleep(0.05)
+        await a.close()
+        assert (await asyncio.wait_for(waiting, 1))["backend"] == "http://ollama-0:11434"
+        assert limiter().stats()["active"] == 1 and len(coordinator.peers) == 1
+
+        # The worker-side admission maps the lease onto its own backend objects and releases it remotely
+        monkeypatch.setattr("proxy._coordinator", b)
+        b.send({"op": "release", "ref": (await waiting)["id"]})
+        shared_pool = proxy._SharedBackendPool(["http://ollama-0:11434"])
+        lease = await proxy._SharedAdmission(shared_pool).admit("m")
+        assert lease.backend is shared_pool.backends[0] and lease.backend.outstanding == 1
+        lease.release()
+        lease.release()
+        await asyncio.sleep(0.05)
+        assert limiter().stats()["active"] == 0 and limiter().stats()["admitted"] == 3
+
+    _coordinated(monkeypatch, scenario)
+
+
+def test_coordinator_client_fails_fast_reconnects_and_times_out(monkeypatch):
+    monkeypatch.setattr("proxy.ADMISSION_MODEL_CONCURRENCY", 1)
+    pool = _backend_pool({"m:latest"})
+    monkeypatch.setattr("proxy._backends", pool)
+    monkeypatch.setattr("proxy._admission", proxy._Admission(pool))
+    monkeypatch.setattr("proxy._warm_pool", proxy._WarmPool(pool, [], 0))
+    monkeypatch.setattr("proxy._CoordinatorClient._TIMEOUT", 0.1)
+
+    async def scenario(coordinator, connect):
+        client = await connect()
+        monkeypatch.setattr("proxy._coordinator", client)
+        await client.call("admit", model="m")
+        waiting = asyncio.create_task(client.call("admit", model="m"))
+        with pytest.raises(ConnectionError, match="did not answer"):
+            await waiting
+
+        # A dropped connection fails waiting calls, and the next call reconnects
+        waiting = asyncio.create_task(client.call("stats"))
+        for peer in list(coordinator.peers): peer.writer.close()
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(waiting, 1)
+        await asyncio.sleep(0.05)
+        assert not client.connected
+        assert "backends" in await asyncio.wait_for(client.call("stats"), 1)
+
+        # With the coordinator gone, calls fail at once and /health reports it
+        proxy.os.unlink(coordinator.path)
+        for peer in list(coordinator.peers): peer.writer.close()
+        await asyncio.sleep(0.05)
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(client.call("stats"), 1)
+        resp = await proxy.health()
+        assert resp.status_code == 503 and json.loads(resp.body)["status"] == "degraded"
+
+    _coordinated(monkeypatch, scenario)
+
+
+def test_worker_lifespan_loads_the_coordinators_catalog(monkeypatch):
+    registry = proxy._ThinkRegistry(60)
+    monkeypatch.setattr("proxy._think_registry", registry)
+    supervisor = proxy._ModelCatalog(_backend_pool({"m:latest"}), 60)
+    supervisor._install([{"id": "m:latest", "context_length": 4096, "capabilities": ["completion", "thinking"]}])
+    worker = proxy._SharedCatalog(proxy._SharedBackendPool(["http://ollama-0:11434"]), 60)
+    monkeypatch.setattr("proxy._catalog", worker)
+    registry._entries.clear()
+
+    async def scenario(coordinator, connect):
+        # The coordinator answers from its own catalog; in-process, proxy._catalog is the worker's
+        async def op_catalog(peer, msg):
+            return {"loaded": supervisor.loaded, "models": list(supervisor.models.values())}
+
+        coordinator._op_catalog = op_catalog
+        monkeypatch.setattr("proxy._coordinator", proxy._CoordinatorClient(coordinator.path))
+        async with proxy._lifespan(proxy.app):
+            assert worker.loaded and worker.lookup("m")["context_length"] == 4096
+            assert await worker.knows("does-not-exist") is False
+            assert registry.supports("m") is True
+
+    _coordinated(monkeypatch, scenario)
+
+
+def test_coordinator_shares_catalog_response_cache_health_and_metrics(monkeypatch):
+    pool = _backend_pool({"m:latest"})
+    monkeypatch.setattr("proxy._backends", pool)
+    catalog = proxy._ModelCatalog(pool, 60)
+    catalog._install([{"id": "m:latest", "context_length": 4096, "capabilities": ["completion"]}])
+    monkeypatch.setattr("proxy._catalog", catalog)
+    monkeypatch.setattr("proxy._response_cache", proxy._ResponseCache(True, 1 << 20, 60))
+    monkeypatch.setattr("proxy._metrics", proxy._Metrics())
+    monkeypatch.setattr("proxy.OLLAMA_BACKEND_MAX_FAILURES", 2)
+    proxy._metrics.routes.inc(("a", "m", "alias"))
+
+    async def scenario(coordinator, connect):
+        monkeypatch.setattr("proxy._coordinator", await connect())
+        shared = proxy._SharedCatalog(proxy._SharedBackendPool(["http://ollama-0:11434"]), 60)
+        await shared.refresh()
+        assert shared.lookup("m")["context_length"] == 4096
+
+        cache = proxy._SharedResponseCache(True, 1 << 20, 60)
+        assert await cache.get("k") is None
+        await cache.put("k", {"message": {"content": "hi"}, "done": True})
+        await asyncio.sleep(0.05)
+        assert await cache.get("k") == {"message": {"content": "hi"}, "done": True}
+        assert (cache.hits, cache.misses, proxy._response_cache.size > 0) == (1, 1, True)
+
+        shared.pool.observe(shared.pool.backends[0], 502)
+        shared.pool.mark_failure(shared.pool.backends[0])
+        await asyncio.sleep(0.05)
+        assert not pool.backends[0].healthy
+
+        # The coordinator's own series plus the one connected worker's (the same registry here)
+        text = (await proxy._coordinator.call("metrics"))["text"]
+        assert 'adapter_model_routes_total{alias="a",model="m",route="alias"} 2' in text
+
+    _coordinated(monkeypatch, scenario)